@@ -11,30 +11,64 @@ function getPriceById(id: string): number {
     return f ? Number(f.priceTax) || 0 : 0;
 }
 
+function toBudgetSummary(budget: number, spent: number) {
+    const remainingAmount = budget - spent;
+    const usageRate = budget > 0 ? Math.min(100, Math.round((spent * 100) / budget)) : 0;
+    return { budget, remainingAmount, usageRate };
+}
+
+// 今月（JST）の "yyyy-mm"。historySummary/rolling.months のキーと同じ
+function currentMonthJst(): string {
+    return new Date(Date.now() + 9 * 60 * 60 * 1000).toISOString().slice(0, 7);
+}
+
+// 履歴アイテムの timeStamp（ISO文字列 / Firestore Timestamp）の月。無ければ null
+function itemMonthJst(ts: any): string | null {
+    let ms: number | null = null;
+    if (typeof ts === 'string') ms = Date.parse(ts);
+    else if (ts && typeof ts.toMillis === 'function') ms = ts.toMillis();
+    else if (ts && typeof ts._seconds === 'number') ms = ts._seconds * 1000;
+    if (ms === null || !Number.isFinite(ms)) return null;
+    return new Date(ms + 9 * 60 * 60 * 1000).toISOString().slice(0, 7);
+}
+
 export const GET = withAuth(async (_req: NextRequest, uid: string) => {
     // ユーザー 予算:monthlyBudgetを参照
     const userDoc = await db.doc(`users/${uid}/userInformation/profile`).get();
     const udata: any = userDoc.data() || {};
     const budget = Number(udata.monthlyBudget) || 0;
+    const month = currentMonthJst();
+
+    // チェックアウト時に更新される集計ドキュメントの今月分だけを読む（履歴本体は読まない）。
+    // backfilled が無い集計は集計以前の履歴を含まないので使わない
+    const summarySnap = await db.doc(`users/${uid}/historySummary/rolling`).get();
+    const summary: any = summarySnap.exists ? summarySnap.data() : null;
+    if (summary?.backfilled) {
+        const spent = Number(summary.months?.[month]?.spent) || 0;
+        return NextResponse.json(toBudgetSummary(budget, spent));
+    }
 
-    // 履歴は users/{uid}/history 配下の全ドキュメントを単純合算
-	// あとで時間でフィルタを追加する
+    // 集計が無い（まだ backfill されていない）ユーザーは users/{uid}/history を走査して今月分を合算。
+    // ドキュメントは items 配列（チェックアウト単位）か1商品1ドキュメント。日時の無い古い商品は合算に含める
     const histSnap = await db.collection(`users/${uid}/history`).get();
     let spent = 0;
 
     for (const doc of histSnap.docs) {
         const data: any = doc.data() || {};
+        const items: any[] = Array.isArray(data.items) ? data.items : [{ ...data, id: data.id ?? doc.id }];
 
-        const pid = String(data.id ?? doc.id);
-        const price = Number(data.price);
-        const qty = Number(data.quantity ?? 1);
-        const unit = Number.isFinite(price) && price > 0 ? price : getPriceById(pid);
-        const q = Number.isFinite(qty) && qty > 0 ? qty : 1;
-        spent += unit * q;
-    }
+        for (const item of items) {
+            const m = itemMonthJst(item?.timeStamp ?? data.updatedAt);
+            if (m !== null && m !== month) continue;
 
-    const remainingAmount = budget - spent;
-    const usageRate = budget > 0 ? Math.min(100, Math.round((spent * 100) / budget)) : 0;
+            const pid = String(item?.id ?? '');
+            const price = Number(item?.price);
+            const qty = Number(item?.quantity ?? 1);
+            const unit = Number.isFinite(price) && price > 0 ? price : getPriceById(pid);
+            const q = Number.isFinite(qty) && qty > 0 ? qty : 1;
+            spent += unit * q;
+        }
+    }
 
-    return NextResponse.json({ budget, remainingAmount, usageRate });
+    return NextResponse.json(toBudgetSummary(budget, spent));
 });
@@ -1,5 +1,7 @@
 #あらとも
 
+from __future__ import annotations
+
 import os
 import re
 import sys
@@ -10,42 +12,100 @@ import argparse
 import logging
 import contextlib
 import tempfile
+import hashlib
+import importlib.util
+import zlib
 import subprocess
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from typing import List, Dict, Any, Optional, Tuple, Set
-from datetime import datetime, timezone
-
-# Selenium
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.support.ui import WebDriverWait, Select
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import (
-    WebDriverException, NoSuchWindowException, StaleElementReferenceException
-)
-from webdriver_manager.chrome import ChromeDriverManager
-
-# Firebase Admin (lazy import later)
-try:
-    import firebase_admin
-    from firebase_admin import credentials as fb_credentials
-    from firebase_admin import firestore as fb_firestore
-except Exception:
-    firebase_admin = None
-    fb_credentials = None
-    fb_firestore = None
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from pathlib import Path
+
+from cart_trace import Tracer, NOOP_TRACER
+from cart_ids import id_from_url, normalize_id, stable_key, with_key
+from cart_retry import RetryScheduler, PermanentAddError, UnconfirmedAddError
+
+# Selenium / webdriver_manager / firebase_admin are imported on first use (_load_selenium /
+# _load_firebase), so postprocess and dry-plan runs never pay for the browser stack.
+webdriver = By = Keys = Service = ChromeOptions = WebDriverWait = Select = EC = None
+WebDriverException = NoSuchWindowException = StaleElementReferenceException = None
+ChromeDriverManager = None
+firebase_admin = fb_credentials = fb_firestore = None
+
+
+def _load_selenium() -> None:
+    global webdriver, By, Keys, Service, ChromeOptions, WebDriverWait, Select, EC
+    global WebDriverException, NoSuchWindowException, StaleElementReferenceException, ChromeDriverManager
+    if webdriver is not None:
+        return
+    from selenium import webdriver as _webdriver
+    from selenium.webdriver.common.by import By as _By
+    from selenium.webdriver.common.keys import Keys as _Keys
+    from selenium.webdriver.chrome.service import Service as _Service
+    from selenium.webdriver.chrome.options import Options as _ChromeOptions
+    from selenium.webdriver.support.ui import WebDriverWait as _WebDriverWait, Select as _Select
+    from selenium.webdriver.support import expected_conditions as _EC
+    from selenium.common import exceptions as _exc
+    By, Keys, Service, ChromeOptions = _By, _Keys, _Service, _ChromeOptions
+    WebDriverWait, Select, EC = _WebDriverWait, _Select, _EC
+    WebDriverException = _exc.WebDriverException
+    NoSuchWindowException = _exc.NoSuchWindowException
+    StaleElementReferenceException = _exc.StaleElementReferenceException
+    try:
+        from webdriver_manager.chrome import ChromeDriverManager as _ChromeDriverManager
+        ChromeDriverManager = _ChromeDriverManager
+    except Exception:
+        ChromeDriverManager = None
+    webdriver = _webdriver
+
+
+def _load_firebase() -> bool:
+    global firebase_admin, fb_credentials, fb_firestore
+    if fb_firestore is not None:
+        return True
+    try:
+        import firebase_admin as _firebase_admin
+        from firebase_admin import credentials as _fb_credentials
+        from firebase_admin import firestore as _fb_firestore
+    except Exception:
+        return False
+    firebase_admin, fb_credentials, fb_firestore = _firebase_admin, _fb_credentials, _fb_firestore
+    return True
+
 
 # ====== Config / constants ======
 STORE_ID = "01050000036000"
-BASE = f"https://shop.aeon.com/netsuper/{STORE_ID}"
+# AEON_ORIGIN / --aeon-origin points the driver at another storefront (e.g. fake_aeon_server.py)
+AEON_ORIGIN = os.environ.get("AEON_ORIGIN", "https://shop.aeon.com").rstrip("/")
+BASE = f"{AEON_ORIGIN}/netsuper/{STORE_ID}"
 HOME_URL = f"{BASE}/"
-LOGIN_URL = "https://shop.aeon.com/netsuper/customer/account/login/"
+LOGIN_URL = f"{AEON_ORIGIN}/netsuper/customer/account/login/"
+CART_URL = f"{AEON_ORIGIN}/netsuper/checkout/cart/"
 
 DEFAULT_USER_DATA_DIR = os.path.expanduser("~/ChromeSeleniumCart")
+DEFAULT_CHECKPOINT_DIR = os.path.expanduser("~/.cache/kaitasu/checkpoints")
+# CHROMEDRIVER / --chromedriver pins the binary; otherwise the resolved path is cached here
+CHROMEDRIVER_PATH = os.environ.get("CHROMEDRIVER", "")
+CHROMEDRIVER_CACHE = os.path.expanduser("~/.cache/kaitasu/chromedriver.json")
+CHROMEDRIVER_CACHE_TTL = 7 * 24 * 3600
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger("aeon-cart")
+# replaced in main() by a collecting tracer (spans also go to --trace-file when given);
+# library callers keep the no-op one
+TRACER: Tracer = NOOP_TRACER
+
+
+def configure_site(origin: str) -> None:
+    """Re-point BASE / HOME_URL / LOGIN_URL / CART_URL at another origin."""
+    global AEON_ORIGIN, BASE, HOME_URL, LOGIN_URL, CART_URL
+    AEON_ORIGIN = origin.rstrip("/")
+    BASE = f"{AEON_ORIGIN}/netsuper/{STORE_ID}"
+    HOME_URL = f"{BASE}/"
+    LOGIN_URL = f"{AEON_ORIGIN}/netsuper/customer/account/login/"
+    CART_URL = f"{AEON_ORIGIN}/netsuper/checkout/cart/"
 
 
 # ====== Firestore helpers ======
@@ -54,9 +114,16 @@ def init_firebase_admin(cred_path: str = "", project_id: Optional[str] = None):
     Initialize firebase_admin and return a firestore client.
     If cred_path is provided, uses that certificate. Otherwise relies on ADC env var.
     """
-    if firebase_admin is None:
+    if not _load_firebase():
         raise RuntimeError("firebase-admin not installed. Install via: pip install firebase-admin")
 
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        # Firestore emulator: no service account needed (firebase_admin would insist on ADC)
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import firestore as gc_firestore
+        return gc_firestore.Client(project=project_id or os.environ.get("GCLOUD_PROJECT") or "demo-kaitasu",
+                                   credentials=AnonymousCredentials())
+
     if not firebase_admin._apps:
         if cred_path:
             cp = os.path.expanduser(cred_path)
@@ -75,38 +142,6 @@ def is_collection_path(p: str) -> bool:
     return len(segs) % 2 == 1
 
 
-# ====== ID and key helpers ======
-def id_from_url(url: str) -> str:
-    if not url:
-        return ""
-    m = re.search(r"/(\d{6,})\.html(?:[?#].*)?$", url)
-    return m.group(1) if m else ""
-
-
-def normalize_id(v: Any, url: str = "") -> str:
-    if url:
-        u = id_from_url(url)
-        if u:
-            return u
-    if isinstance(v, str) and re.fullmatch(r"\d{6,}", v.strip()):
-        return v.strip()
-    if isinstance(v, int):
-        s = str(v)
-        return s if re.fullmatch(r"\d{6,}", s) else ""
-    return ""
-
-
-def stable_key(item: Dict[str, Any]) -> str:
-    pid = normalize_id(item.get("id"), item.get("url") or "")
-    if pid:
-        return f"id:{pid}"
-    uid = id_from_url(item.get("url") or "")
-    if uid:
-        return f"id:{uid}"
-    nm = (item.get("name") or "").strip().lower()
-    return f"name:{nm}" if nm else f"row:{time.time_ns()}"
-
-
 # ====== Browser helpers ======
 def _try_clear_quarantine(binary_path: str):
     try:
@@ -116,15 +151,105 @@ def _try_clear_quarantine(binary_path: str):
         pass
 
 
+def _read_driver_cache() -> str:
+    with contextlib.suppress(Exception):
+        with open(CHROMEDRIVER_CACHE, "r", encoding="utf-8") as f:
+            c = json.load(f)
+        if time.time() - float(c.get("resolvedAt", 0)) < CHROMEDRIVER_CACHE_TTL and os.path.exists(c["path"]):
+            return c["path"]
+    return ""
+
+
+# batch workers start drivers concurrently: one download / cache write at a time
+_DRIVER_LOCK = threading.Lock()
+
+
+def resolve_chromedriver(refresh: bool = False, stale: str = "") -> str:
+    """
+    Pinned path (CHROMEDRIVER / --chromedriver) > cached webdriver_manager result > fresh resolve.
+    "" lets Selenium Manager find the driver itself.
+    refresh: resolve again, unless another thread already replaced the stale path.
+    """
+    if CHROMEDRIVER_PATH:
+        return os.path.expanduser(CHROMEDRIVER_PATH)
+    with _DRIVER_LOCK:
+        cached = _read_driver_cache()
+        if cached and (not refresh or cached != stale):
+            return cached
+        if ChromeDriverManager is None:
+            return ""
+        path = ChromeDriverManager().install()
+        _try_clear_quarantine(path)
+        with contextlib.suppress(Exception):
+            os.makedirs(os.path.dirname(CHROMEDRIVER_CACHE), exist_ok=True)
+            tmp = CHROMEDRIVER_CACHE + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"path": path, "resolvedAt": time.time()}, f)
+            os.replace(tmp, CHROMEDRIVER_CACHE)
+        return path
+
+
 def _spawn_with_options(options: ChromeOptions) -> webdriver.Chrome:
-    path = ChromeDriverManager().install()
-    _try_clear_quarantine(path)
-    service = Service(path)
-    return webdriver.Chrome(service=service, options=options)
+    path = resolve_chromedriver()
+    try:
+        return webdriver.Chrome(service=(Service(path) if path else Service()), options=options)
+    except WebDriverException as e:
+        # Chrome updated under a cached driver -> resolve again once
+        if CHROMEDRIVER_PATH or "only supports Chrome version" not in str(e):
+            raise
+        logger.warning("chromedriver と Chrome のバージョン不一致 → 再取得します。")
+        path = resolve_chromedriver(refresh=True, stale=path)
+        return webdriver.Chrome(service=(Service(path) if path else Service()), options=options)
+
+
+# --fast-profile: the driver only needs forms, buttons and the cart badge
+FAST_PROFILE_ARGS = [
+    "--blink-settings=imagesEnabled=false",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--mute-audio",
+    "--no-first-run",
+    "--disable-features=Translate,MediaRouter,OptimizationHints,AutofillServerCommunication",
+]
+FAST_PROFILE_PREFS = {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.managed_default_content_settings.media_stream": 2,
+    "profile.default_content_setting_values.notifications": 2,
+    "profile.default_content_setting_values.geolocation": 2,
+    "webkit.webprefs.fonts_enabled": False,
+}
+# Network.setBlockedURLs patterns (images/media/fonts + third-party trackers)
+# Patterns match the whole URL, so each extension also gets a "?query" variant. SVG stays
+# allowed (icons / buttons); third parties are named by host, not by a loose substring.
+BLOCKED_EXTENSIONS = ("png", "jpg", "jpeg", "gif", "webp", "ico", "mp4", "webm", "mp3",
+                      "woff", "woff2", "ttf", "otf", "eot")
+BLOCKED_URL_PATTERNS = [p for ext in BLOCKED_EXTENSIONS for p in (f"*.{ext}", f"*.{ext}?*")] + [
+    "*://www.google-analytics.com/*", "*://*.google-analytics.com/*", "*://www.googletagmanager.com/*",
+    "*://*.doubleclick.net/*", "*://www.googleadservices.com/*", "*://*.googlesyndication.com/*",
+    "*://connect.facebook.net/*", "*://*.criteo.com/*", "*://*.criteo.net/*",
+    "*://*.yimg.jp/images/listing/*", "*://*.ads.yahoo.co.jp/*", "*://*.clarity.ms/*",
+    "*://*.hotjar.com/*", "*://*.karte.io/*", "*://analytics.tiktok.com/*",
+    "*://d.line-scdn.net/n/line_tag/*", "*://tr.line.me/*",
+]
+
+
+def apply_resource_blocking(driver: webdriver.Chrome) -> bool:
+    """Block heavy / third-party requests through CDP (also works on an attached browser)."""
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+        return True
+    except Exception as e:
+        logger.warning("Network.setBlockedURLs を適用できません: %s", e)
+        return False
 
 
 def _make_options(browser: str, user_data_dir: Optional[str], profile_dir: Optional[str],
-                  headless: bool, debugger_address: Optional[str] = None) -> ChromeOptions:
+                  headless: bool, debugger_address: Optional[str] = None,
+                  fast_profile: bool = False) -> ChromeOptions:
     opts = ChromeOptions()
     if headless:
         # use new headless flag
@@ -143,58 +268,226 @@ def _make_options(browser: str, user_data_dir: Optional[str], profile_dir: Optio
             opts.add_argument(f"--profile-directory={profile_dir}")
     if debugger_address:
         opts.debugger_address = debugger_address
+    # launch-time switches/prefs are ignored by an attached browser (CDP blocking still applies)
+    if fast_profile and not debugger_address:
+        for a in FAST_PROFILE_ARGS:
+            opts.add_argument(a)
+        opts.add_experimental_option("prefs", FAST_PROFILE_PREFS)
+        # return from driver.get() at DOMContentLoaded; wait_dom_stable still checks readyState
+        opts.page_load_strategy = "eager"
     opts.add_experimental_option("excludeSwitches", ["enable-automation"])
     opts.add_experimental_option("useAutomationExtension", False)
     return opts
 
 
 def build_driver(browser: str, user_data_dir: Optional[str], profile_dir: Optional[str],
-                 headless: bool, auto_attach: bool, debugger_address: Optional[str]) -> webdriver.Chrome:
+                 headless: bool, auto_attach: bool, debugger_address: Optional[str],
+                 fast_profile: bool = False) -> webdriver.Chrome:
+    _load_selenium()
     if browser == "auto":
         logger.info("browser=auto → chrome を使用")
         browser = "chrome"
     opts = _make_options(browser, user_data_dir, profile_dir, headless,
-                         (debugger_address if auto_attach else None))
+                         (debugger_address if auto_attach else None), fast_profile)
     try:
-        return _spawn_with_options(opts)
+        driver = _spawn_with_options(opts)
     except WebDriverException as e:
         msg = str(e)
         if "user data directory is already in use" in msg or "session not created" in msg:
             tmp = tempfile.mkdtemp(prefix="selenium-profile-")
             logger.warning("指定プロファイルが使用中 → 一時プロファイルで再試行: %s", tmp)
             opts2 = _make_options(browser, tmp, None, headless,
-                                  (debugger_address if auto_attach else None))
-            return _spawn_with_options(opts2)
-        if "unexpectedly exited" in msg:
-            logger.warning("WebDriver service が即終了: %s", msg)
-        raise
+                                  (debugger_address if auto_attach else None), fast_profile)
+            driver = _spawn_with_options(opts2)
+        else:
+            if "unexpectedly exited" in msg:
+                logger.warning("WebDriver service が即終了: %s", msg)
+            raise
+    if fast_profile:
+        apply_resource_blocking(driver)
+    return driver
+
+
+# ====== Single-pass page probe ======
+# Every selector the driver looks at, evaluated in ONE execute_script round trip.
+# The lists are the same ones the per-element helpers used to walk with find_elements.
+PROBE_CONFIG = {
+    "notFoundPhrases": [
+        "指定のページが見つかりませんでした",
+        "お探しのページは見つかりません",
+        "この商品は現在取り扱っておりません",
+        "在庫がありません",
+        "ページが見つかりません",
+        "404",
+    ],
+    "badgeSelectors": [
+        'span.header-cart-count', 'span.cart-count-badge', 'a[href*="cart"] .count',
+        '[aria-label*="カート"] .count', '.header-cart .count',
+    ],
+    "buttonCss": [
+        "button.tocart", "button#tocart", "form[action*='checkout/cart'] button[type='submit']",
+        "button[title*='カゴ']", "button[title*='カート']",
+        "button[aria-label*='カゴ']", "button[aria-label*='カート']",
+        "button.add-to-cart",
+    ],
+    "buttonXPaths": [
+        "//button[contains(.,'カゴ') or contains(.,'カート') or contains(.,'追加') or contains(.,'購入')]",
+        "//a[contains(.,'カゴ') or contains(.,'カート') or contains(.,'追加') or contains(.,'購入')]",
+    ],
+    "qtySelectors": ["input#qty", "input[name='qty']", "input.qty"],
+    "toastXPaths": [
+        "//*[contains(.,'カートに入れました')]",
+        "//*[contains(.,'カートに追加')]",
+        "//*[contains(.,'追加しました')]",
+        "//*[contains(.,'カゴに入れました')]",
+        "//*[contains(@class,'message-success') and contains(.,'カート')]",
+    ],
+    "popupXPaths": [
+        "//button[contains(.,'同意') or contains(.,'OK') or contains(.,'閉じる')]",
+        "//div[contains(@class,'cookie')]//button",
+        "//button[contains(@aria-label,'閉じる')]",
+    ],
+    "placeholderOptions": ["選択してください", "選択", "--"],
+}
+
+_PROBE_LIB_JS = r"""
+const cfg = arguments[0];
+const vis = (el) => {
+  if (!el || !el.isConnected) return false;
+  const cs = window.getComputedStyle(el);
+  if (cs.visibility === 'hidden' || cs.display === 'none' || parseFloat(cs.opacity) === 0) return false;
+  return el.getClientRects().length > 0;
+};
+const xpAll = (xp) => {
+  const out = [];
+  try {
+    const r = document.evaluate(xp, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    for (let i = 0; i < r.snapshotLength; i++) out.push(r.snapshotItem(i));
+  } catch (e) {}
+  return out;
+};
+const xpFirst = (xp) => xpAll(xp)[0] || null;
+"""
+
+PAGE_PROBE_JS = _PROBE_LIB_JS + r"""
+const st = {url: location.href, readyState: document.readyState};
+const body = document.body ? (document.body.innerText || '') : '';
+const title = document.title || '';
+st.notFound = cfg.notFoundPhrases.some(p => body.includes(p)) || title.includes('404') || title.includes('見つかりません');
+st.loginPage = location.href.includes('/customer/account/login')
+  || !!document.querySelector('form[action*="login"] input[type="password"]');
+st.loggedIn = !!document.querySelector('a[href*="/customer/account/logout"]');
+st.cartCount = null;
+for (const sel of cfg.badgeSelectors) {
+  const el = document.querySelector(sel);
+  const t = el ? (el.innerText || '').trim() : '';
+  if (/^[0-9]+$/.test(t)) { st.cartCount = parseInt(t, 10); break; }
+}
+st.button = null;
+for (const sel of cfg.buttonCss) {
+  for (const el of document.querySelectorAll(sel)) {
+    if (vis(el) && !el.disabled) { st.button = el; break; }
+  }
+  if (st.button) break;
+}
+if (!st.button) {
+  for (const xp of cfg.buttonXPaths) {
+    for (const el of xpAll(xp)) {
+      if (vis(el) && !el.disabled) { st.button = el; break; }
+    }
+    if (st.button) break;
+  }
+}
+st.qtyField = null;
+for (const sel of cfg.qtySelectors) {
+  const el = document.querySelector(sel);
+  if (el && vis(el)) { st.qtyField = el; break; }
+}
+st.toast = cfg.toastXPaths.some(xp => vis(xpFirst(xp)));
+st.popups = cfg.popupXPaths.filter(xp => vis(xpFirst(xp))).length;
+st.unselectedSelects = Array.from(document.querySelectorAll('select')).filter(s => vis(s)
+  && !Array.from(s.options).some(o => o.selected && o.value)).length;
+const groups = {};
+for (const r of document.querySelectorAll("input[type='radio']")) {
+  if (!r.name) continue;
+  (groups[r.name] = groups[r.name] || []).push(r);
+}
+st.unselectedRadios = Object.values(groups).filter(g => !g.some(r => r.checked)).length;
+return st;
+"""
+
+PICK_OPTIONS_JS = _PROBE_LIB_JS + r"""
+let changed = 0;
+for (const s of document.querySelectorAll('select')) {
+  if (!vis(s)) continue;
+  if (Array.from(s.options).some(o => o.selected && o.value)) continue;
+  for (const o of s.options) {
+    const val = (o.value || '').trim(), txt = (o.text || '').trim();
+    if (!val || cfg.placeholderOptions.includes(txt)) continue;
+    s.value = o.value;
+    s.dispatchEvent(new Event('input', {bubbles: true}));
+    s.dispatchEvent(new Event('change', {bubbles: true}));
+    changed++;
+    break;
+  }
+}
+const groups = {};
+for (const r of document.querySelectorAll("input[type='radio']")) {
+  if (!r.name) continue;
+  (groups[r.name] = groups[r.name] || []).push(r);
+}
+for (const g of Object.values(groups)) {
+  if (g.some(r => r.checked)) continue;
+  const r = g.find(r => vis(r) && !r.disabled);
+  if (r) { r.click(); changed++; }
+}
+return changed;
+"""
+
+CLOSE_POPUPS_JS = _PROBE_LIB_JS + r"""
+let clicked = 0;
+for (const xp of cfg.popupXPaths) {
+  const el = xpFirst(xp);
+  if (vis(el)) { el.click(); clicked++; }
+}
+return clicked;
+"""
+
+
+def probe_page(driver: webdriver.Chrome) -> Dict[str, Any]:
+    """
+    One round trip: {url, readyState, notFound, loginPage, loggedIn, cartCount,
+    button (WebElement|None), qtyField (WebElement|None), toast, popups,
+    unselectedSelects, unselectedRadios}
+    """
+    return driver.execute_script(PAGE_PROBE_JS, PROBE_CONFIG) or {}
 
 
-# ====== Login helpers ======
-def is_login_page(driver: webdriver.Chrome) -> bool:
+def safe_probe(driver: webdriver.Chrome) -> Dict[str, Any]:
     try:
-        url = driver.current_url or ""
+        return probe_page(driver)
     except Exception:
-        url = ""
-    if "/customer/account/login" in url:
-        return True
+        return {}
+
+
+# ====== Login helpers ======
+def is_login_page(driver: webdriver.Chrome, state: Optional[Dict[str, Any]] = None) -> bool:
     try:
-        if driver.find_elements(By.CSS_SELECTOR, 'form[action*="login"] input[type="password"]'):
-            return True
+        return bool((state or probe_page(driver)).get("loginPage"))
     except Exception:
         pass
-    return False
+    try:
+        url = driver.current_url or ""
+    except Exception:
+        url = ""
+    return "/customer/account/login" in url
 
 
-def dom_has_logout_marker(driver: webdriver.Chrome) -> bool:
+def dom_has_logout_marker(driver: webdriver.Chrome, state: Optional[Dict[str, Any]] = None) -> bool:
     try:
-        if driver.find_elements(By.CSS_SELECTOR, 'a[href*="/customer/account/logout"]'):
-            return True
-        if driver.find_elements(By.XPATH, "//a[contains(@href,'/customer/account/logout')]"):
-            return True
+        return bool((state or probe_page(driver)).get("loggedIn"))
     except Exception:
-        pass
-    return False
+        return False
 
 
 def wait_dom_stable(driver: webdriver.Chrome, duration=0.8, timeout=15) -> bool:
@@ -241,33 +534,23 @@ def ensure_logged_in(driver: webdriver.Chrome, wait: WebDriverWait, force: bool,
     raise RuntimeError("ログイン待機がタイムアウトしました。")
 
 
-def assert_authenticated_or_relogin(driver: webdriver.Chrome, wait: WebDriverWait):
-    if dom_has_logout_marker(driver) and not is_login_page(driver):
+def assert_authenticated_or_relogin(driver: webdriver.Chrome, wait: WebDriverWait,
+                                    state: Optional[Dict[str, Any]] = None):
+    with contextlib.suppress(Exception):
+        state = state or probe_page(driver)
+    if state and state.get("loggedIn") and not state.get("loginPage"):
         return
     logger.info("セッションが切れている可能性 → ログインページへ移動して待機します。")
     ensure_logged_in(driver, wait, force=True, max_wait_sec=300)
 
 
 # ====== Page / UI helpers ======
-def is_not_found_page(driver: webdriver.Chrome) -> bool:
+def is_not_found_page(driver: webdriver.Chrome, state: Optional[Dict[str, Any]] = None) -> bool:
     try:
-        body_text = driver.find_element(By.TAG_NAME, "body").text
+        return bool((state or probe_page(driver)).get("notFound"))
     except Exception:
-        body_text = ""
-    phrases = [
-        "指定のページが見つかりませんでした",
-        "お探しのページは見つかりません",
-        "この商品は現在取り扱っておりません",
-        "在庫がありません",
-        "ページが見つかりません",
-        "404"
-    ]
-    if any(p in body_text for p in phrases):
-        return True
-    title = (driver.title or "")
-    if "404" in title or "見つかりません" in title:
-        return True
-    return False
+        title = (driver.title or "")
+        return "404" in title or "見つかりません" in title
 
 
 def open_home_and_search(driver: webdriver.Chrome, wait: WebDriverWait, query: str) -> bool:
@@ -347,186 +630,272 @@ def click_first_search_result(driver: webdriver.Chrome, wait: WebDriverWait, pid
 
 
 def try_close_common_popups(driver: webdriver.Chrome) -> None:
-    for xp in [
-        "//button[contains(.,'同意') or contains(.,'OK') or contains(.,'閉じる')]",
-        "//div[contains(@class,'cookie')]//button",
-        "//button[contains(@aria-label,'閉じる')]",
-    ]:
-        with contextlib.suppress(Exception):
-            el = driver.find_element(By.XPATH, xp)
-            if el and el.is_displayed():
-                driver.execute_script("arguments[0].click();", el)
-                time.sleep(0.2)
+    with contextlib.suppress(Exception):
+        if driver.execute_script(CLOSE_POPUPS_JS, PROBE_CONFIG):
+            time.sleep(0.2)
 
 
-def get_cart_count(driver: webdriver.Chrome) -> Optional[int]:
-    sels = [
-        'span.header-cart-count', 'span.cart-count-badge', 'a[href*="cart"] .count',
-        '[aria-label*="カート"] .count', '.header-cart .count',
-    ]
-    for sel in sels:
-        with contextlib.suppress(Exception):
-            el = driver.find_element(By.CSS_SELECTOR, sel)
-            txt = (el.text or "").strip()
-            if txt.isdigit():
-                return int(txt)
+def get_cart_count(driver: webdriver.Chrome, state: Optional[Dict[str, Any]] = None) -> Optional[int]:
+    with contextlib.suppress(Exception):
+        n = (state or probe_page(driver)).get("cartCount")
+        return int(n) if n is not None else None
     return None
 
 
-def wait_cart_added(driver: webdriver.Chrome, before_count=None, expected_delta=1, timeout=14):
+def wait_cart_added(driver: webdriver.Chrome, before_count=None, expected_delta=1, timeout=14,
+                    badge_only: bool = False):
     end = time.time() + timeout
-    xps = [
-        "//*[contains(.,'カートに入れました')]",
-        "//*[contains(.,'カートに追加')]",
-        "//*[contains(.,'追加しました')]",
-        "//*[contains(.,'カゴに入れました')]",
-        "//*[contains(@class,'message-success') and contains(.,'カート')]",
-    ]
     while time.time() < end:
-        for xp in xps:
-            with contextlib.suppress(Exception):
-                el = driver.find_element(By.XPATH, xp)
-                if el.is_displayed():
-                    return True
-        after = get_cart_count(driver)
-        if before_count is not None and after is not None and after - before_count >= expected_delta:
-            return True
+        # toast + badge in one round trip per poll
+        with contextlib.suppress(Exception):
+            st = probe_page(driver)
+            if st.get("toast") and not badge_only:
+                return True
+            after = st.get("cartCount")
+            if before_count is not None and after is not None and after - before_count >= expected_delta:
+                return True
         time.sleep(0.3)
     return False
 
 
-def set_qty_if_field_exists(driver: webdriver.Chrome, wait: WebDriverWait, qty: int):
-    for sel in ["input#qty", "input[name='qty']", "input.qty"]:
-        with contextlib.suppress(Exception):
-            el = driver.find_element(By.CSS_SELECTOR, sel)
-            if el and el.is_displayed():
-                driver.execute_script("arguments[0].focus();", el)
-                el.clear()
-                el.send_keys(str(qty))
-                return True
+def set_qty_if_field_exists(driver: webdriver.Chrome, wait: WebDriverWait, qty: int,
+                            state: Optional[Dict[str, Any]] = None):
+    with contextlib.suppress(Exception):
+        el = (state or probe_page(driver)).get("qtyField")
+        if el is not None:
+            driver.execute_script("arguments[0].focus();", el)
+            el.clear()
+            el.send_keys(str(qty))
+            return True
     return False
 
 
-def pick_simple_options_if_needed(driver: webdriver.Chrome, wait: WebDriverWait) -> None:
-    # selects
-    for sel in driver.find_elements(By.CSS_SELECTOR, "select"):
-        with contextlib.suppress(Exception):
-            if not sel.is_displayed():
-                continue
-            s = Select(sel)
-            if any(o.is_selected() and o.get_attribute("value") for o in s.options):
-                continue
-            for o in s.options:
-                val = (o.get_attribute("value") or "").strip()
-                txt = (o.text or "").strip()
-                if not val:
-                    continue
-                if txt in ("選択してください", "選択", "--"):
-                    continue
-                s.select_by_value(val)
-                time.sleep(0.2)
-                break
-    # radios
-    radios = driver.find_elements(By.CSS_SELECTOR, "input[type='radio']")
-    by_name: Dict[str, List[Any]] = {}
-    for r in radios:
-        with contextlib.suppress(Exception):
-            name = r.get_attribute("name") or ""
-            if not name:
-                continue
-            by_name.setdefault(name, []).append(r)
-    for name, group in by_name.items():
-        if any((r.is_selected() for r in group)):
-            continue
-        for r in group:
-            with contextlib.suppress(Exception):
-                if r.is_displayed() and r.is_enabled():
-                    driver.execute_script("arguments[0].click();", r)
-                    time.sleep(0.2)
-                    break
+def pick_simple_options_if_needed(driver: webdriver.Chrome, wait: WebDriverWait,
+                                  state: Optional[Dict[str, Any]] = None) -> None:
+    if state is not None and not (state.get("unselectedSelects") or state.get("unselectedRadios")):
+        return
+    # selects + radios picked in the page (one round trip)
+    with contextlib.suppress(Exception):
+        if driver.execute_script(PICK_OPTIONS_JS, PROBE_CONFIG):
+            time.sleep(0.2)
 
 
-def find_add_to_cart_button(driver: webdriver.Chrome):
-    csses = [
-        "button.tocart", "button#tocart", "form[action*='checkout/cart'] button[type='submit']",
-        "button[title*='カゴ']", "button[title*='カート']",
-        "button[aria-label*='カゴ']", "button[aria-label*='カート']",
-        "button.add-to-cart",
-    ]
-    for sel in csses:
-        with contextlib.suppress(Exception):
-            for e in driver.find_elements(By.CSS_SELECTOR, sel):
-                if e.is_displayed() and e.is_enabled():
-                    return e
-    xps = [
-        "//button[contains(.,'カゴ') or contains(.,'カート') or contains(.,'追加') or contains(.,'購入')]",
-        "//a[contains(.,'カゴ') or contains(.,'カート') or contains(.,'追加') or contains(.,'購入')]",
-    ]
-    for xp in xps:
-        with contextlib.suppress(Exception):
-            for e in driver.find_elements(By.XPATH, xp):
-                if e.is_displayed() and e.is_enabled():
-                    return e
+def find_add_to_cart_button(driver: webdriver.Chrome, state: Optional[Dict[str, Any]] = None):
+    with contextlib.suppress(Exception):
+        return (state or probe_page(driver)).get("button")
     return None
 
 
 # ====== Adding logic ======
+QTY_STRATEGIES = ("auto", "pipeline", "cart", "click")
+
+
 def add_to_cart_via_url(driver: webdriver.Chrome, wait: WebDriverWait, *,
                         url: str, pid: str, name: str, qty: int = 1,
-                        max_retries: int = 3):
-    assert_authenticated_or_relogin(driver, wait)
-
-    # 1) go to url
-    driver.get(url)
-    wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-    wait_dom_stable(driver, duration=0.6, timeout=10)
-    try_close_common_popups(driver)
+                        max_retries: int = 3, sched: Optional[RetryScheduler] = None,
+                        qty_strategy: str = "auto") -> int:
+    """
+    Add qty units of one product; returns the units confirmed (== qty).
+    Raises UnconfirmedAddError(confirmed=n) when fewer units were confirmed, PermanentAddError when
+    the product cannot be found.
+    """
+    with TRACER.span("add_item", pid=pid, qty=qty) as item_span:
+        return _add_to_cart_via_url(driver, wait, url=url, pid=pid, name=name, qty=qty,
+                             max_retries=max_retries, sched=sched or RetryScheduler(),
+                             qty_strategy=qty_strategy, item_span=item_span)
+
+
+def _add_to_cart_via_url(driver: webdriver.Chrome, wait: WebDriverWait, *,
+                         url: str, pid: str, name: str, qty: int, max_retries: int,
+                         sched: RetryScheduler, qty_strategy: str = "auto", item_span=None) -> int:
+    tr = TRACER
+    with tr.span("auth_check"):
+        assert_authenticated_or_relogin(driver, wait)
+
+    # 1) go to url (page latency feeds the retry backoff)
+    t0 = time.time()
+    with tr.span("navigate", url=url):
+        driver.get(url)
+        wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+    with tr.span("dom_stable"):
+        wait_dom_stable(driver, duration=0.6, timeout=10)
+    sched.observe(time.time() - t0)
+    with tr.span("close_popups"):
+        try_close_common_popups(driver)
 
     # 2) 404 -> search fallback
-    if is_not_found_page(driver):
+    with tr.span("not_found_check"):
+        state = safe_probe(driver)
+        not_found = is_not_found_page(driver, state)
+    if not_found:
         q = pid or (name[:20] if name else "")
         logger.info("指定URLが無効っぽい → 検索で再特定: %s", q)
-        if not open_home_and_search(driver, wait, q):
-            raise RuntimeError("検索ボックスが見つからない（404 fallback 失敗）")
-        if not click_first_search_result(driver, wait, pid, name):
-            raise RuntimeError("検索しても商品ページを特定できない（404 fallback 失敗）")
+        with tr.span("fallback_search", query=q):
+            if not open_home_and_search(driver, wait, q):
+                raise RuntimeError("検索ボックスが見つからない（404 fallback 失敗）")
+            if not click_first_search_result(driver, wait, pid, name):
+                raise PermanentAddError("検索しても商品ページを特定できない（404 fallback 失敗）")
+
+        state = safe_probe(driver)
 
     # 3) pick options
-    pick_simple_options_if_needed(driver, wait)
-
-    # 4) set qty -> click add
-    logger.info("Adding: %s x%d (ID=%s)", (name or "(no-name)"), qty, (pid or "N/A"))
-    before = get_cart_count(driver)
-    clicks_needed = 1 if set_qty_if_field_exists(driver, wait, qty) else max(1, int(qty))
-
-    success_any = False
-    for _ in range(clicks_needed):
-        attempt = 0
-        while attempt < max_retries:
-            attempt += 1
-            assert_authenticated_or_relogin(driver, wait)
-            pick_simple_options_if_needed(driver, wait)
-
-            btn = find_add_to_cart_button(driver)
-            if not btn:
-                time.sleep(0.8)
-                btn = find_add_to_cart_button(driver)
+    with tr.span("pick_options"):
+        if state.get("unselectedSelects") or state.get("unselectedRadios"):
+            pick_simple_options_if_needed(driver, wait, state)
+            state = safe_probe(driver)
+
+    # 4) set qty -> click add (see choose_qty_strategy)
+    qty = max(1, int(qty))
+    before = get_cart_count(driver, state)
+    with tr.span("set_qty"):
+        has_field = qty > 1 and qty_strategy != "click" and set_qty_if_field_exists(driver, wait, qty, state)
+    mode = choose_qty_strategy(qty_strategy, qty, has_field, before)
+    logger.info("Adding: %s x%d (ID=%s, qty=%s)", (name or "(no-name)"), qty, (pid or "N/A"), mode)
+
+    kw = dict(tr=tr, sched=sched, max_retries=max_retries)
+    attempts_total = 0
+    if mode == "click":
+        # legacy: one full click + confirmation cycle per unit
+        confirmed = 0
+        for click_no in range(qty):
+            got, before, n = _click_and_confirm(driver, wait, before=before, units=1, click_no=click_no + 1, **kw)
+            confirmed += got
+            attempts_total += n
+    elif mode == "pipeline":
+        confirmed, before, attempts_total = _click_and_confirm(driver, wait, before=before, units=qty,
+                                                               badge_only=True, **kw)
+    else:
+        confirmed, before, attempts_total = _click_and_confirm(driver, wait, before=before, units=1, **kw)
+        if mode == "single":
+            confirmed = qty if confirmed else 0
+        elif confirmed and qty > 1:
+            badge_before_cart = before
+            with tr.span("cart_qty", extra=qty - 1):
+                moved = set_qty_in_cart(driver, wait, pid, extra=qty - 1)
+            if moved == qty - 1:
+                confirmed = qty
+            else:
+                badge_after_cart = get_cart_count(driver)
+                missing = 0
+                if moved is None and (badge_after_cart is None or badge_before_cart is None):
+                    # submitted but neither the row nor the badge can be read: clicking more could double the units
+                    logger.warning("カートの数量更新を確認できません（追加クリックはしません）。")
+                else:
+                    if moved is None:
+                        # submitted but the row was not read back: count what the form added from the badge
+                        moved = max(0, min(qty - 1, badge_after_cart - badge_before_cart))
+                    confirmed += moved
+                    missing = qty - confirmed
+                    logger.info("カートで %d 点しか増やせず → 商品ページで残り %d 点をクリックします。", moved, missing)
+                if missing:
+                    # back through the full product-page path (404 -> search fallback, options), one click per unit
+                    with tr.span("cart_qty_shortfall", missing=missing):
+                        try:
+                            confirmed += _add_to_cart_via_url(driver, wait, url=url, pid=pid, name=name, qty=missing,
+                                                              max_retries=max_retries, sched=sched,
+                                                              qty_strategy="click")
+                        except UnconfirmedAddError as e:
+                            confirmed += e.confirmed
+                        except Exception as e:
+                            # keep the units already confirmed; the caller sees the shortfall below
+                            logger.warning("残り %d 点の追加に失敗: %s", missing, e)
+
+    if item_span is not None:
+        item_span.set(attempts=attempts_total, qtyMode=mode, confirmed=confirmed, fallback=not_found)
+    if not confirmed:
+        raise UnconfirmedAddError("トースト/バッジ変化が検知できず、投入に失敗した可能性", confirmed=0)
+    if confirmed < qty:
+        logger.warning("%s: %d/%d 点のみ投入を確認", (name or pid or "N/A"), confirmed, qty)
+        raise UnconfirmedAddError(f"{confirmed}/{qty} 点のみ投入を確認", confirmed=confirmed)
+    return confirmed
+
+
+def choose_qty_strategy(strategy: str, qty: int, has_field: bool, badge: Optional[int]) -> str:
+    """
+    single   : qty 1, or the product page's qty field already holds the amount -> one add
+    pipeline : click qty times back to back, verify the badge delta once (needs a readable badge)
+    cart     : one add, then raise the row's quantity on the cart page
+    click    : legacy, one click + confirmation wait per unit
+    """
+    if qty <= 1 or has_field:
+        return "single"
+    if strategy in ("click", "cart"):
+        return strategy
+    # auto / pipeline: the badge is the only way to count pipelined clicks
+    return "pipeline" if badge is not None else "cart"
+
+
+def _fire_clicks(driver: webdriver.Chrome, wait: WebDriverWait, btn, n: int) -> int:
+    """
+    Click the same button n times, each as soon as it is enabled again (it is disabled while the
+    add XHR runs). The page is never re-probed mid-pipeline: while button.tocart is disabled the
+    probe's fallback XPath would return the header cart link instead.
+    A stale button raises StaleElementReferenceException (the caller retries with the badge delta).
+    """
+    fired = 0
+    for i in range(n):
+        if i:
+            end = time.time() + 5
+            enabled = btn.is_enabled()
+            while not enabled and time.time() < end:
+                time.sleep(0.1)
+                enabled = btn.is_enabled()
+            if not enabled:
+                break
+        else:
+            driver.execute_script("arguments[0].scrollIntoView({block:'center'});", btn)
+            wait.until(EC.element_to_be_clickable(btn))
+        try:
+            btn.click()
+        except Exception:
+            driver.execute_script("arguments[0].click();", btn)
+        fired += 1
+    return fired
+
+
+def _click_and_confirm(driver: webdriver.Chrome, wait: WebDriverWait, *, tr: Tracer, sched: RetryScheduler,
+                       before: Optional[int], units: int, max_retries: int, click_no: int = 1,
+                       badge_only: bool = False) -> Tuple[int, Optional[int], int]:
+    """
+    Click the add button `units` times and confirm them with ONE wait; a shortfall seen on the
+    badge is clicked again on the next attempt. badge_only=False accepts the success toast
+    (only meaningful for units=1). Returns (units_confirmed, badge_after, attempts).
+    """
+    confirmed = 0
+    attempt = 0
+    while attempt < max_retries and confirmed < units:
+        attempt += 1
+        if attempt > 1:
+            tr.count("retry")
+        remaining = units - confirmed
+        with tr.span("attempt", attempt=attempt, click=click_no, units=remaining) as att:
+            st = safe_probe(driver)
+            assert_authenticated_or_relogin(driver, wait, st)
+            if st.get("unselectedSelects") or st.get("unselectedRadios"):
+                pick_simple_options_if_needed(driver, wait, st)
+                st = safe_probe(driver)
+
+            with tr.span("find_button"):
+                btn = find_add_to_cart_button(driver, st)
             if not btn:
+                if att is not None:
+                    att.set(outcome="no_button")
                 if attempt >= max_retries:
                     raise RuntimeError("カゴ追加ボタンが見つかりません")
+                sched.wait(attempt + 1)
                 continue
 
             try:
-                driver.execute_script("arguments[0].scrollIntoView({block:'center'});", btn)
-                wait.until(EC.element_to_be_clickable(btn))
-                try:
-                    btn.click()
-                except Exception:
-                    driver.execute_script("arguments[0].click();", btn)
+                with tr.span("click", clicks=remaining):
+                    fired = _fire_clicks(driver, wait, btn, remaining)
             except StaleElementReferenceException:
-                time.sleep(0.6)
+                if att is not None:
+                    att.set(outcome="stale")
+                sched.wait(attempt + 1)
                 continue
             except NoSuchWindowException:
+                if att is not None:
+                    att.set(outcome="no_window")
                 handles = driver.window_handles
                 if handles:
                     driver.switch_to.window(handles[-1])
@@ -535,82 +904,208 @@ def add_to_cart_via_url(driver: webdriver.Chrome, wait: WebDriverWait, *,
 
             # If clicking sent to login page -> relogin and retry
             if is_login_page(driver):
+                if att is not None:
+                    att.set(outcome="login")
                 logger.info("クリック後にログインへ遷移。復帰して再実行します。")
                 ensure_logged_in(driver, wait, force=True, max_wait_sec=300)
                 continue
 
-            ok = wait_cart_added(driver, before_count=before, expected_delta=1, timeout=14)
-            if ok:
-                success_any = True
-                now = get_cart_count(driver)
-                if now is not None:
-                    before = now
-                break
+            t0 = time.time()
+            with tr.span("confirm_wait", expected=fired):
+                ok = wait_cart_added(driver, before_count=before, expected_delta=fired, timeout=14,
+                                     badge_only=badge_only)
+            now = get_cart_count(driver)
+            if badge_only:
+                got = max(0, min(remaining, (now - before) if (now is not None and before is not None) else 0))
             else:
-                time.sleep(0.8)
+                got = remaining if ok else 0
+            if got:
+                sched.observe(time.time() - t0)
+            if now is not None:
+                before = now
+            confirmed += got
+            if att is not None:
+                att.set(outcome=("ok" if confirmed >= units else ("partial" if got else "unconfirmed")))
+            if confirmed < units:
+                sched.wait(attempt + 1)
+    return confirmed, before, attempt
+
+
+# ====== Cart page quantity ======
+_SET_CART_QTY_JS = r"""
+const pid = arguments[0], extra = arguments[1];
+const rowSels = ['#shopping-cart-table tbody.cart.item', 'tbody.cart.item', '[data-role="cart-item"]'];
+for (const sel of rowSels) {
+  for (const row of document.querySelectorAll(sel)) {
+    const a = row.querySelector('a[href*=".html"]');
+    const m = a ? a.href.match(/\/(\d{6,})\.html(?:[?#].*)?$/) : null;
+    if (!m || m[1] !== pid) continue;
+    const q = row.querySelector('input.qty, input[name*="qty"], input[data-role="cart-item-qty"]');
+    if (!q) return null;
+    const from = parseInt(q.value, 10) || 0;
+    q.value = String(from + extra);
+    q.dispatchEvent(new Event('input', {bubbles: true}));
+    q.dispatchEvent(new Event('change', {bubbles: true}));
+    const btn = document.querySelector("button.action.update, button[name='update_cart_action'], "
+      + "button[title*='更新'], button[value='update_qty']")
+      || document.evaluate("//button[contains(.,'更新')]", document, null,
+                           XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    if (btn) { btn.click(); } else if (q.form) { q.form.submit(); } else { return null; }
+    return {from: from, to: from + extra};
+  }
+}
+return null;
+"""
+
+
+def _cart_row_qty(driver: webdriver.Chrome, pid: str) -> Optional[int]:
+    with contextlib.suppress(Exception):
+        for r in driver.execute_script(_SCRAPE_CART_JS) or []:
+            if id_from_url(r.get("href") or "") == pid:
+                return int(r.get("qty") or 0)
+    return None
 
-    if not success_any:
-        raise RuntimeError("トースト/バッジ変化が検知できず、投入に失敗した可能性")
+
+def set_qty_in_cart(driver: webdriver.Chrome, wait: WebDriverWait, pid: str, extra: int) -> Optional[int]:
+    """
+    Raise the quantity of pid's row on the cart page by `extra` and submit the cart form once.
+    Returns the units the row actually gained (0..extra), read back from the cart page: 0 if the
+    row / field / update button is missing, None if the form was submitted but the row could not
+    be read back (the caller then has to count from the badge).
+    """
+    if not pid or extra <= 0:
+        return 0
+    try:
+        driver.get(CART_URL)
+        wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+        wait_dom_stable(driver, duration=0.4, timeout=10)
+        res = driver.execute_script(_SET_CART_QTY_JS, pid, extra)
+    except Exception:
+        return 0
+    if not res:
+        return 0
+    end = time.time() + 14
+    while time.time() < end:
+        time.sleep(0.3)
+        with contextlib.suppress(Exception):
+            wait_dom_stable(driver, duration=0.3, timeout=5)
+        now = _cart_row_qty(driver, pid)
+        if now is not None and now >= res["to"]:
+            return extra
+    # timed out: the update may still have gone through -> read the row once more from a fresh load
+    with contextlib.suppress(Exception):
+        driver.get(CART_URL)
+        wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+        wait_dom_stable(driver, duration=0.4, timeout=10)
+    now = _cart_row_qty(driver, pid)
+    if now is None:
+        return None
+    return max(0, min(extra, now - res["from"]))
 
 
 # ====== Firestore read helpers (cart) ======
-def fetch_cart_items(db: fb_firestore.Client, cart_path: str, from_all: bool) -> Tuple[int, List[Dict[str, Any]]]:
+# Only these fields are transferred when reading a cart (Firestore field projection).
+# Aliases (title/qty/pid/imgUrl) are kept because older cart docs still use them.
+CART_FIELDS = ["id", "pid", "url", "name", "title", "quantity", "qty", "price", "image", "imgUrl", "items"]
+CART_PAGE_SIZE = 300
+
+
+def _stream_pages(query, page_size: int) -> List[Any]:
+    """Cursor-paged read (start_after the last snapshot) so large carts are not one giant RPC."""
+    docs: List[Any] = []
+    last = None
+    while True:
+        q = query.limit(page_size)
+        if last is not None:
+            q = q.start_after(last)
+        page = list(q.stream())
+        docs.extend(page)
+        if len(page) < page_size:
+            return docs
+        last = page[-1]
+
+
+def read_cart(db: fb_firestore.Client, cart_path: str, from_all: bool,
+              page_size: int = CART_PAGE_SIZE) -> Dict[str, Any]:
     """
-    Read cart docs from cart_path (collection or document)
-    Returns (docs_count_read, items_list) where each item is normalized: {id,url,name,quantity}
+    Read cart_path (collection or document) once with field projection.
+    Returns a cart snapshot shared by the add step and the postprocess step:
+      {"path", "reads", "records": [(doc_id, data)], "items": [{id,url,name,quantity,key}]}
     """
+    records: List[Tuple[str, Dict[str, Any]]] = []
     if is_collection_path(cart_path):
-        col = db.collection(cart_path)
+        col = db.collection(cart_path).select(CART_FIELDS)
         if from_all:
-            docs = list(col.stream())
+            docs = _stream_pages(col.order_by("__name__"), page_size)
         else:
             # try to get latest by createdAt if present
             try:
-                docs = list(col.order_by("createdAt", direction=fb_firestore.Query.DESCENDING).limit(1000).stream())
+                docs = list(col.order_by("createdAt", direction="DESCENDING").limit(1000).stream())
             except Exception:
-                docs = list(col.stream())
+                docs = _stream_pages(col.order_by("__name__"), page_size)
+        for d in docs:
+            records.append((d.id, d.to_dict() or {}))
     else:
-        doc = db.document(cart_path).get()
+        doc = db.document(cart_path).get(field_paths=CART_FIELDS)
         docs = [doc] if doc.exists else []
+        if doc.exists:
+            records.append((doc.id, doc.to_dict() or {}))
+
+    return {
+        "path": cart_path,
+        "reads": len(docs),
+        "records": records,
+        "items": items_from_cart_records(records),
+    }
+
+
+def fetch_cart_items(db: fb_firestore.Client, cart_path: str, from_all: bool) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    Read cart docs from cart_path (collection or document)
+    Returns (docs_count_read, items_list) where each item is normalized: {id,url,name,quantity,key}
+    """
+    snap = read_cart(db, cart_path, from_all)
+    return (snap["reads"], snap["items"])
+
+
+def _cart_item(it: Dict[str, Any], doc_id: str = "") -> Optional[Dict[str, Any]]:
+    url = (it.get("url") or "").strip()
+    # cart docs written by the web app are keyed by product id and carry no "id" field
+    pid = normalize_id(it.get("id") or doc_id, url)
+    nm = (it.get("name") or it.get("title") or "").strip()
+    q = it.get("quantity") or it.get("qty") or 1
+    try:
+        q = max(1, int(q))
+    except Exception:
+        q = 1
+    page = url or (f"{BASE}/{pid}.html" if pid else "")
+    if not page:
+        return None
+    return with_key({"id": pid, "url": page, "name": nm, "quantity": q})
 
+
+def items_from_cart_records(records: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Normalize (doc_id, data) pairs into items: {id,url,name,quantity,key}
+    """
     items: List[Dict[str, Any]] = []
-    for d in docs:
-        # d may be a DocumentSnapshot
-        data = d.to_dict() if hasattr(d, "to_dict") else (d or {})
+    for doc_id, data in records:
         if not data:
             continue
         # If doc directly contains item fields, support both shape {items:[...]} and direct item doc
         if isinstance(data.get("items"), list):
-            arr = data.get("items")
-            for it in arr:
+            for it in data.get("items"):
                 if not isinstance(it, dict):
                     continue
-                url = (it.get("url") or "").strip()
-                pid = normalize_id(it.get("id"), url)
-                nm = (it.get("name") or it.get("title") or "").strip()
-                q = it.get("quantity") or it.get("qty") or 1
-                try:
-                    q = max(1, int(q))
-                except Exception:
-                    q = 1
-                page = url or (f"{BASE}/{pid}.html" if pid else "")
-                if not page:
-                    continue
-                items.append({"id": pid, "url": page, "name": nm, "quantity": q})
+                item = _cart_item(it)
+                if item:
+                    items.append(item)
         else:
             # document is single item-like object
-            url = (data.get("url") or "").strip()
-            pid = normalize_id(data.get("id"), url)
-            nm = (data.get("name") or data.get("title") or "").strip()
-            q = data.get("quantity") or data.get("qty") or 1
-            try:
-                q = max(1, int(q))
-            except Exception:
-                q = 1
-            page = url or (f"{BASE}/{pid}.html" if pid else "")
-            if page:
-                items.append({"id": pid, "url": page, "name": nm, "quantity": q})
-    return (len(docs), items)
+            item = _cart_item(data, doc_id)
+            if item:
+                items.append(item)
+    return items
 
 
 def dedupe_items(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
@@ -625,91 +1120,987 @@ def dedupe_items(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     return out
 
 
-# ====== Postprocess: move cart -> history ======
-def move_cart_to_history(db: fb_firestore.Client, uid: str, history_doc: str,
-                         dry: bool = False, logger_obj: Optional[logging.Logger] = None) -> dict:
+def read_carts_bulk(db: fb_firestore.Client, uids: List[str], from_all: bool,
+                    workers: int = 8) -> Dict[str, Dict[str, Any]]:
     """
-    - Reads users/{uid}/cart (all docs)
-    - Appends items to users/{uid}/history/{history_doc}.items (ArrayUnion)
-    - Sets updatedAt = SERVER_TIMESTAMP on history doc
-    - Deletes cart docs (batched; 500/document limit)
+    Read users/{uid}/cart for many uids in parallel (one Firestore client shared).
+    Returns {uid: cart snapshot}
     """
-    log = (logger_obj.info if logger_obj else print)
-    errlog = (logger_obj.error if logger_obj else print)
+    out: Dict[str, Dict[str, Any]] = {}
+    if not uids:
+        return out
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(uids)))) as ex:
+        futs = {ex.submit(read_cart, db, f"users/{u}/cart", from_all): u for u in uids}
+        for fut in as_completed(futs):
+            u = futs[fut]
+            try:
+                out[u] = fut.result()
+            except Exception as e:
+                logger.error("cart 読み取り失敗 uid=%s: %s", u, e)
+                out[u] = {"path": f"users/{u}/cart", "reads": 0, "records": [], "items": []}
+    return out
 
-    cart_col = f"users/{uid}/cart"
-    history_doc_path = f"users/{uid}/history/{history_doc}"
 
-    col = db.collection(cart_col)
-    docs = list(col.stream())
-    if not docs:
-        log(f"[INFO] cart is empty: {cart_col}")
-        return {"appended": 0, "deleted": 0, "historyDocPath": history_doc_path}
+def read_carts_by_collection_group(db: fb_firestore.Client,
+                                   uids: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Read every users/{uid}/cart/* doc with a single projected collection-group query.
+    If uids is given, other users' carts are dropped. Returns {uid: cart snapshot}
+    """
+    wanted = set(uids) if uids else None
+    grouped: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+    for d in db.collection_group("cart").select(CART_FIELDS).stream():
+        user_ref = d.reference.parent.parent
+        if user_ref is None or user_ref.parent.id != "users":
+            continue
+        if wanted is not None and user_ref.id not in wanted:
+            continue
+        grouped.setdefault(user_ref.id, []).append((d.id, d.to_dict() or {}))
+    return {
+        u: {"path": f"users/{u}/cart", "reads": len(recs), "records": recs, "items": items_from_cart_records(recs)}
+        for u, recs in grouped.items()
+    }
+
 
+# ====== Postprocess: move cart -> history ======
+# Firestore rejects batches over 500 writes. The history write carries field
+# transforms (ArrayUnion / SERVER_TIMESTAMP), which count as an extra write.
+BATCH_WRITE_LIMIT = 500
+HISTORY_WRITE_COST = 2
+COMMIT_RETRIES = 3
+
+# Sharded history layout:
+#   users/{uid}/history/{yyyymmddTHHMMSS}-{checkoutId}  one doc per checkout (bounded by cart size)
+#   users/{uid}/historySummary/rolling                  months / totals / top items / recent checkout
+#                                                       doc ids (what readers load)
+#   users/{uid}/historySummary/items-{00..15}           per-product counters behind topItems, hashed by
+#                                                       product id; a chunk reads only the shards it touches
+#                                                       and each shard is bounded by the catalog size / 16
+HISTORY_LAYOUTS = ("sharded", "single")
+SUMMARY_ITEM_SHARDS = 16
+SUMMARY_WRITE_COST = 2 + SUMMARY_ITEM_SHARDS  # rolling (set + SERVER_TIMESTAMP) + touched counter shards
+SUMMARY_MONTHS_KEPT = 24
+SUMMARY_TOP_ITEMS = 20
+SUMMARY_RECENT_CHUNKS = 50
+SUMMARY_RECENT_CHECKOUTS = 50
+JST = timezone(timedelta(hours=9))
+FOOD_DATA_PATH = Path(__file__).resolve().parents[4] / "data" / "foodData.json"
+
+
+def checkout_id_for(uid: str, records: List[Tuple[str, Dict[str, Any]]]) -> str:
+    """Idempotency key of one cart -> history move (same cart contents -> same id)."""
+    h = hashlib.sha1(uid.encode("utf-8"))
+    for doc_id, data in sorted(records, key=lambda r: r[0]):
+        h.update(f"|{doc_id}:{data.get('quantity') or data.get('qty') or 1}".encode("utf-8"))
+    return h.hexdigest()[:20]
+
+
+def history_items_from_records(records: List[Tuple[str, Dict[str, Any]]], checkout_id: str = "",
+                               ts: Optional[str] = None,
+                               substitutions: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    substitutions: checkout_items()["substituted"]; the line of a replaced product records the
+    substitute that was actually put in the AEON cart (price from foodData.json) + substituteFor.
+    """
+    # one timestamp per checkout so a replayed ArrayUnion writes byte-identical elements (no-op)
+    ts = ts or datetime.now(timezone.utc).isoformat()
+    swaps = {s["id"]: s for s in (substitutions or [])}
     items = []
-    doc_ids = []
-    for d in docs:
-        data = d.to_dict() or {}
-        doc_ids.append(d.id)
+    for doc_id, data in records:
+        orig = str(data.get("id") or data.get("pid") or doc_id or "")
+        sw = swaps.get(normalize_id(data.get("id") or data.get("pid") or doc_id, data.get("url") or ""))
+        if sw:
+            data = {"id": sw["substitute"], "url": sw.get("substituteUrl") or "",
+                    "name": sw.get("substituteName") or "", "image": sw.get("substituteImage") or "",
+                    "price": sw.get("substitutePrice"), "quantity": data.get("quantity") or data.get("qty") or 1}
         it = {
-            "id": str(data.get("id") or data.get("pid") or "") ,
+            "id": str(data.get("id") or data.get("pid") or doc_id or ""),
             "url": data.get("url") or "",
             "name": data.get("name") or data.get("title") or "",
             "image": data.get("image") or data.get("imgUrl") or "",
             "price": (data.get("price") if isinstance(data.get("price"), (int,float)) else None),
             "quantity": int(data.get("quantity") or data.get("qty") or 1),
             # store ISO timestamp string (serverTimestamp cannot be inside array element)
-            "timeStamp": datetime.now(timezone.utc).isoformat()
+            "timeStamp": ts,
         }
+        if checkout_id:
+            it["checkoutId"] = checkout_id
+        if sw:
+            it["substituteFor"] = orig
         items.append(it)
+    return items
+
+
+def plan_history_move(cart_col: str, history_doc_path: str, records: List[Tuple[str, Dict[str, Any]]],
+                      checkout_id: str, ts: Optional[str] = None,
+                      reserved: int = HISTORY_WRITE_COST,
+                      substitutions: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    Split a cart -> history move into as few batches as possible.
+    Every batch appends its own items to the history doc AND deletes the same cart docs,
+    so each chunk moves atomically: a crash between batches never leaves an item both
+    in history and in the cart, and a re-run only sees the docs that were not moved yet.
+    Returns [{"items": [...], "deletes": [cart doc paths]}]
+    """
+    items = history_items_from_records(records, checkout_id, ts, substitutions)
+    per_batch = BATCH_WRITE_LIMIT - reserved
+    plan = []
+    for i in range(0, len(records), per_batch):
+        plan.append({
+            "items": items[i:i+per_batch],
+            "deletes": [f"{cart_col}/{doc_id}" for doc_id, _ in records[i:i+per_batch]],
+        })
+    return plan
+
+
+def commit_history_chunk(db: fb_firestore.Client, history_doc_path: str, chunk: Dict[str, Any],
+                         checkout_id: str, retries: int = COMMIT_RETRIES) -> None:
+    """
+    Commit one planned chunk. Replaying a chunk is safe (ArrayUnion of identical
+    elements and deletes of missing docs are no-ops), so failed commits are simply retried.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        batch = db.batch()
+        batch.set(db.document(history_doc_path), {
+            "items": fb_firestore.ArrayUnion(chunk["items"]),
+            "lastCheckoutId": checkout_id,
+            "updatedAt": fb_firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        for path in chunk["deletes"]:
+            batch.delete(db.document(path))
+        try:
+            batch.commit()
+            return
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            logger.warning("history batch commit 失敗 (%d/%d) → 再試行: %s", attempt, retries, e)
+            time.sleep(0.5 * (2 ** (attempt - 1)))
+
+
+@lru_cache(maxsize=1)
+def _food_prices() -> Dict[str, float]:
+    """priceTax by product id (cart docs usually carry no price)."""
+    try:
+        with open(FOOD_DATA_PATH, "r", encoding="utf-8") as f:
+            return {str(x.get("id")): float(x.get("priceTax") or 0) for x in json.load(f)}
+    except Exception as e:
+        logger.warning("foodData.json を読めません（価格は 0 扱い）: %s", e)
+        return {}
+
+
+def history_item_spent(it: Dict[str, Any]) -> float:
+    price = it.get("price")
+    if not isinstance(price, (int, float)) or price <= 0:
+        price = _food_prices().get(it.get("id") or "", 0.0)
+    return float(price) * int(it.get("quantity") or 1)
+
+
+def history_shard_id(ts: datetime, checkout_id: str) -> str:
+    return f"{ts.astimezone(JST):%Y%m%dT%H%M%S}-{checkout_id}"
+
+
+def summary_item_shard(pid: str) -> str:
+    return f"items-{zlib.crc32(pid.encode('utf-8')) % SUMMARY_ITEM_SHARDS:02d}"
+
+
+def summary_shard_refs(db, uid: str, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Counter shard refs {shard: ref} of the products in items."""
+    shards = sorted({summary_item_shard(str(it.get("id"))) for it in items if it.get("id")})
+    return {sh: db.document(f"users/{uid}/historySummary/{sh}") for sh in shards}
+
 
-    log(f"[INFO] collected {len(items)} cart item(s) from {cart_col}")
+def summary_updates_by_shard(updates: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    out: Dict[str, Dict[str, Any]] = {}
+    for pid, c in updates.items():
+        out.setdefault(summary_item_shard(pid), {})[pid] = c
+    return out
+
+
+def apply_history_summary(rolling: Dict[str, Any], counts: Dict[str, Any], items: List[Dict[str, Any]],
+                          month: Optional[str], token: Optional[str], new_checkout: bool,
+                          shard_id: str = "") -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Fold one chunk of history items into the rolling summary.
+    counts only needs the counters of the products in items (their shards); topItems is kept
+    incrementally since counters only grow. month=None counts in the totals only (undated
+    legacy items), token=None records no chunk token (backfill).
+    Returns (new rolling doc, per-product counter updates). Pure: no Firestore access.
+    """
+    spent = sum(history_item_spent(it) for it in items)
+    qty = sum(int(it.get("quantity") or 1) for it in items)
+
+    months = dict(rolling.get("months") or {})
+    if month:
+        m = dict(months.get(month) or {"spent": 0, "quantity": 0, "checkouts": 0})
+        m["spent"] = round(m["spent"] + spent, 2)
+        m["quantity"] += qty
+        m["checkouts"] += 1 if new_checkout else 0
+        months[month] = m
+        for old in sorted(months)[:-SUMMARY_MONTHS_KEPT]:
+            months.pop(old)
+
+    updates: Dict[str, Any] = {}
+    for it in items:
+        pid = it.get("id") or ""
+        if not pid:
+            continue
+        c = dict(updates.get(pid) or counts.get(pid) or {"quantity": 0, "spent": 0, "name": ""})
+        c["quantity"] += int(it.get("quantity") or 1)
+        c["spent"] = round(c["spent"] + history_item_spent(it), 2)
+        c["name"] = it.get("name") or c.get("name") or ""
+        updates[pid] = c
+
+    merged = {t["id"]: {k: v for k, v in t.items() if k != "id"} for t in rolling.get("topItems") or []}
+    merged.update(updates)
+    top = sorted(merged.items(), key=lambda kv: (-kv[1].get("quantity", 0), kv[0]))[:SUMMARY_TOP_ITEMS]
+
+    recent = list(rolling.get("recentCheckouts") or [])
+    if new_checkout and shard_id and shard_id not in recent:
+        recent.append(shard_id)
+    new_rolling = {
+        "months": months,
+        "totalSpent": round(float(rolling.get("totalSpent") or 0) + spent, 2),
+        "totalQuantity": int(rolling.get("totalQuantity") or 0) + qty,
+        "checkouts": int(rolling.get("checkouts") or 0) + (1 if new_checkout else 0),
+        "topItems": [{"id": pid, **c} for pid, c in top],
+        "recentChunks": (list(rolling.get("recentChunks") or []) + ([token] if token else []))[-SUMMARY_RECENT_CHUNKS:],
+        "recentCheckouts": recent[-SUMMARY_RECENT_CHECKOUTS:],
+        "backfilled": bool(rolling.get("backfilled")),
+    }
+    return new_rolling, updates
+
+
+def history_item_month(it: Dict[str, Any], fallback: Any = None) -> Optional[str]:
+    """JST yyyy-mm of a history item's timeStamp (ISO string or datetime); None if undated."""
+    ts = it.get("timeStamp") or fallback
+    if isinstance(ts, str):
+        try:
+            ts = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if not isinstance(ts, datetime):
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return f"{ts.astimezone(JST):%Y-%m}"
+
+
+def fold_history_backfill(rolling: Dict[str, Any], counts: Dict[str, Any],
+                          docs: List[Tuple[str, Dict[str, Any]]]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Fold history written before the summary existed (legacy items arrays or one-item docs) into
+    rolling and mark it backfilled. Sharded docs (they carry "month") are already counted and only
+    join recentCheckouts. Returns (new rolling doc, per-product counter updates). Pure.
+    """
+    base = dict(rolling)
+    base["recentCheckouts"] = []
+    updates: Dict[str, Any] = {}
+    for doc_id, data in sorted(docs, key=lambda d: d[0]):
+        if data.get("month"):
+            base["recentCheckouts"].append(doc_id)
+            continue
+        raw = data.get("items") if isinstance(data.get("items"), list) else [data]
+        by_month: Dict[Optional[str], List[Dict[str, Any]]] = {}
+        for it in raw:
+            if isinstance(it, dict):
+                it = {**it, "id": str(it.get("id") or it.get("pid") or (doc_id if it is data else ""))}
+                by_month.setdefault(history_item_month(it, data.get("updatedAt")), []).append(it)
+        for n, (month, its) in enumerate(sorted(by_month.items(), key=lambda kv: kv[0] or "")):
+            base, up = apply_history_summary(base, {**counts, **updates}, its, month, None,
+                                             new_checkout=(n == 0), shard_id=doc_id)
+            updates.update(up)
+    recent = base["recentCheckouts"] + [r for r in rolling.get("recentCheckouts") or []
+                                        if r not in base["recentCheckouts"]]
+    return {**base, "recentCheckouts": recent[-SUMMARY_RECENT_CHECKOUTS:], "backfilled": True}, updates
+
+
+def run_in_transaction(db, fn):
+    """fn(transaction) inside a Firestore transaction (retried by the client on contention)."""
+    return fb_firestore.transactional(fn)(db.transaction())
+
+
+def read_summary_counts(refs: Dict[str, Any], transaction) -> Dict[str, Any]:
+    counts: Dict[str, Any] = {}
+    for ref in refs.values():
+        snap = ref.get(transaction=transaction)
+        counts.update((snap.to_dict() if snap.exists else None) or {})
+    return counts
+
+
+# Transaction bodies shared by the sync driver (below) and cart_async.py: given what the
+# transaction read, return its writes as [(doc path, data or None for a delete, merge)].
+# The ArrayUnion / SERVER_TIMESTAMP sentinels are the same objects in both clients.
+def apply_transaction_writes(db, transaction, writes: List[Tuple[str, Optional[Dict[str, Any]], bool]]) -> None:
+    for path, data, merge in writes:
+        if data is None:
+            transaction.delete(db.document(path))
+        else:
+            transaction.set(db.document(path), data, merge=merge)
+
+
+def history_backfill_shard_refs(db, uid: str, docs: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Any]:
+    """Counter shards a backfill of docs may touch (all of them if there is legacy history)."""
+    if all(data.get("month") for _, data in docs):
+        return {}
+    return {sh: db.document(f"users/{uid}/historySummary/{sh}")
+            for sh in [f"items-{n:02d}" for n in range(SUMMARY_ITEM_SHARDS)]}
+
+
+def history_backfill_writes(uid: str, rolling: Dict[str, Any], counts: Dict[str, Any],
+                            docs: List[Tuple[str, Dict[str, Any]]]) -> Optional[list]:
+    """Writes of the one-time summary backfill; None if rolling is already backfilled."""
+    if rolling.get("backfilled"):
+        return None
+    if not _load_firebase():
+        raise RuntimeError("firebase-admin not installed. Install via: pip install firebase-admin")
+    new_rolling, updates = fold_history_backfill(rolling, counts, docs)
+    writes = [(f"users/{uid}/historySummary/rolling", {**new_rolling, "updatedAt": fb_firestore.SERVER_TIMESTAMP}, False)]
+    writes += [(f"users/{uid}/historySummary/{sh}", fields, True)
+               for sh, fields in summary_updates_by_shard(updates).items()]
+    return writes
+
+
+def history_shard_chunk_writes(uid: str, shard_path: str, chunk: Dict[str, Any], checkout_id: str,
+                               month: str, chunk_no: int, rolling: Dict[str, Any],
+                               counts: Dict[str, Any]) -> Optional[list]:
+    """
+    Writes of one chunk of the sharded layout: append to the checkout shard, delete the cart docs
+    and fold the chunk into the summary docs. None if the chunk is already recorded in
+    rolling.recentChunks, so counters are never applied twice on retry.
+    """
+    token = f"{checkout_id}:{chunk_no}"
+    if token in (rolling.get("recentChunks") or []):
+        return None
+    if not _load_firebase():
+        raise RuntimeError("firebase-admin not installed. Install via: pip install firebase-admin")
+    new_rolling, updates = apply_history_summary(rolling, counts, chunk["items"], month, token,
+                                                 new_checkout=(chunk_no == 0),
+                                                 shard_id=shard_path.rsplit("/", 1)[-1])
+    writes = [(shard_path, {
+        "checkoutId": checkout_id,
+        "month": month,
+        "items": fb_firestore.ArrayUnion(chunk["items"]),
+        "updatedAt": fb_firestore.SERVER_TIMESTAMP,
+    }, True)]
+    writes += [(path, None, False) for path in chunk["deletes"]]
+    writes.append((f"users/{uid}/historySummary/rolling",
+                   {**new_rolling, "updatedAt": fb_firestore.SERVER_TIMESTAMP}, False))
+    writes += [(f"users/{uid}/historySummary/{sh}", fields, True)
+               for sh, fields in summary_updates_by_shard(updates).items()]
+    return writes
+
+
+def backfill_history_summary(db: fb_firestore.Client, uid: str) -> bool:
+    """
+    Once per user: fold users/{uid}/history written before the summary existed into
+    historySummary, so readers can trust rolling.months when rolling.backfilled is set.
+    """
+    rolling_ref = db.document(f"users/{uid}/historySummary/rolling")
+    snap = rolling_ref.get()
+    if snap.exists and (snap.to_dict() or {}).get("backfilled"):
+        return False
+    docs = [(d.id, d.to_dict() or {}) for d in db.collection(f"users/{uid}/history").stream()]
+    refs = history_backfill_shard_refs(db, uid, docs)
+
+    def _tx(transaction):
+        rs = rolling_ref.get(transaction=transaction)
+        rolling = (rs.to_dict() if rs.exists else None) or {}
+        writes = history_backfill_writes(uid, rolling, read_summary_counts(refs, transaction), docs)
+        if writes is None:
+            return False
+        apply_transaction_writes(db, transaction, writes)
+        return True
+
+    return run_in_transaction(db, _tx)
+
+
+def commit_history_shard_chunk(db: fb_firestore.Client, uid: str, shard_path: str, chunk: Dict[str, Any],
+                               checkout_id: str, month: str, chunk_no: int) -> bool:
+    """Commit history_shard_chunk_writes() in a transaction. False if the chunk was already applied."""
+    rolling_ref = db.document(f"users/{uid}/historySummary/rolling")
+    shard_refs = summary_shard_refs(db, uid, chunk["items"])
+
+    def _tx(transaction):
+        rolling_snap = rolling_ref.get(transaction=transaction)
+        rolling = (rolling_snap.to_dict() if rolling_snap.exists else None) or {}
+        writes = history_shard_chunk_writes(uid, shard_path, chunk, checkout_id, month, chunk_no,
+                                            rolling, read_summary_counts(shard_refs, transaction))
+        if writes is None:
+            return False
+        apply_transaction_writes(db, transaction, writes)
+        return True
+
+    return run_in_transaction(db, _tx)
+
+
+def move_cart_to_history(db: fb_firestore.Client, uid: str, history_doc: str,
+                         dry: bool = False, logger_obj: Optional[logging.Logger] = None,
+                         snapshot: Optional[Dict[str, Any]] = None, layout: str = "sharded",
+                         substitutions: Optional[List[Dict[str, Any]]] = None) -> dict:
+    """
+    - Reads users/{uid}/cart (all docs) unless a snapshot from read_cart() is passed in
+    - substitutions (checkout_items()["substituted"]): history and the spend summary record the
+      substitute placed in the AEON cart instead of the original product
+    - layout="sharded": writes one users/{uid}/history/{time}-{checkoutId} doc per checkout and
+      keeps users/{uid}/historySummary/{rolling,items-NN} up to date in the same transaction
+      (history from before the summary is folded in first, once per user)
+    - layout="single": appends items to users/{uid}/history/{history_doc}.items (ArrayUnion)
+    - Moved cart docs are deleted in the same write as their history append (<= 500 ops each)
+    """
+    log = (logger_obj.info if logger_obj else print)
+    errlog = (logger_obj.error if logger_obj else print)
+    if not _load_firebase():
+        raise RuntimeError("firebase-admin not installed. Install via: pip install firebase-admin")
+
+    cart_col = f"users/{uid}/cart"
+
+    if snapshot is None or snapshot.get("path") != cart_col:
+        snapshot = read_cart(db, cart_col, from_all=True)
+    records = snapshot["records"]
+    if not records:
+        log(f"[INFO] cart is empty: {cart_col}")
+        return {"appended": 0, "deleted": 0, "historyDocPath": f"users/{uid}/history/{history_doc}"}
+
+    now = datetime.now(timezone.utc)
+    checkout_id = checkout_id_for(uid, records)
+    sharded = (layout == "sharded")
+    if sharded:
+        history_doc_path = f"users/{uid}/history/{history_shard_id(now, checkout_id)}"
+        reserved = HISTORY_WRITE_COST + SUMMARY_WRITE_COST
+    else:
+        history_doc_path = f"users/{uid}/history/{history_doc}"
+        reserved = HISTORY_WRITE_COST
+    plan = plan_history_move(cart_col, history_doc_path, records, checkout_id, now.isoformat(), reserved,
+                             substitutions)
+    month = f"{now.astimezone(JST):%Y-%m}"
+    total = len(records)
+    result = {"appended": 0, "deleted": 0, "historyDocPath": history_doc_path,
+              "checkoutId": checkout_id, "batches": len(plan), "layout": layout}
+
+    log(f"[INFO] collected {total} cart item(s) from {cart_col} (checkoutId={checkout_id}, batches={len(plan)})")
     if dry:
-        log("[DRY] would append to history doc:", history_doc_path)
-        log("[DRY] items sample:", items[:3])
-        log("[DRY] would delete cart docs:", len(doc_ids))
-        return {"appended": len(items), "deleted": 0, "historyDocPath": history_doc_path}
+        log(f"[DRY] would append to history doc: {history_doc_path}")
+        log(f"[DRY] items sample: {plan[0]['items'][:3]}")
+        log(f"[DRY] would delete cart docs: {total}")
+        result["appended"] = total
+        return result
+
+    if sharded:
+        try:
+            if backfill_history_summary(db, uid):
+                log(f"[INFO] backfilled users/{uid}/historySummary from existing history")
+        except Exception as e:
+            # readers fall back to scanning history until the backfill succeeds
+            errlog(f"[ERROR] history summary backfill failed: {e}")
+
+    moved = 0
+    for n, chunk in enumerate(plan):
+        try:
+            if sharded:
+                commit_history_shard_chunk(db, uid, history_doc_path, chunk, checkout_id, month, n)
+            else:
+                commit_history_chunk(db, history_doc_path, chunk, checkout_id)
+        except Exception as e:
+            errlog(f"[ERROR] failed to move cart chunk to history: {e}")
+            if moved == 0:
+                raise
+            break
+        moved += len(chunk["deletes"])
+        log(f"[INFO] moved {len(chunk['deletes'])} cart docs to {history_doc_path} (progress {moved}/{total})")
+
+    result["appended"] = result["deleted"] = moved
+    return result
+
+
+def move_cart_to_history_async(executor: ThreadPoolExecutor, db: fb_firestore.Client, uid: str,
+                               history_doc: str, **kwargs) -> Future:
+    """Run move_cart_to_history on executor (e.g. while the browser does its final navigation)."""
+    return executor.submit(move_cart_to_history, db, uid, history_doc, **kwargs)
+
+
+# ====== Resume: AEON cart diff / checkpoints ======
+# One execute_script call: (href, qty) for every row of the cart page (or the minicart).
+_SCRAPE_CART_JS = r"""
+const rowSels = ['#shopping-cart-table tbody.cart.item', 'tbody.cart.item', '[data-role="cart-item"]',
+                 '#mini-cart li.product-item', '.minicart-items li.product-item'];
+for (const sel of rowSels) {
+  const rows = [];
+  for (const row of document.querySelectorAll(sel)) {
+    const a = row.querySelector('a[href*=".html"]');
+    if (!a) continue;
+    const q = row.querySelector('input.qty, input[name*="qty"], input[data-role="cart-item-qty"]');
+    let qty = q ? parseInt(q.value, 10) : NaN;
+    if (isNaN(qty)) {
+      const t = row.querySelector('.item-qty, .details-qty .value, .qty');
+      qty = t ? parseInt((t.textContent || '').replace(/[^0-9]/g, ''), 10) : 1;
+    }
+    rows.push({href: a.href, qty: isNaN(qty) ? 1 : qty});
+  }
+  if (rows.length) return rows;
+}
+return [];
+"""
+
+
+def scrape_aeon_cart(driver: webdriver.Chrome, wait: WebDriverWait) -> Dict[str, int]:
+    """
+    Open the AEON cart page once and return what is already in it: {stable_key: qty}
+    """
+    driver.get(CART_URL)
+    wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+    wait_dom_stable(driver, duration=0.6, timeout=10)
+    rows = driver.execute_script(_SCRAPE_CART_JS) or []
+    out: Dict[str, int] = {}
+    for r in rows:
+        pid = id_from_url(r.get("href") or "")
+        if not pid:
+            continue
+        k = f"id:{pid}"
+        out[k] = out.get(k, 0) + max(0, int(r.get("qty") or 0))
+    logger.info("AEON カート現状: %d 商品 / %d 点", len(out), sum(out.values()))
+    return out
+
+
+def plan_cart_diff(items: List[Dict[str, Any]], in_cart: Dict[str, int],
+                   done: Optional[Dict[str, int]] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Compare the wanted items against the AEON cart (and the checkpoint of a previous run).
+    Returns (todo, skipped): todo items carry only the missing quantity.
+    Items with more units in the AEON cart than wanted are left alone (logged).
+    """
+    done = done or {}
+    pool: Dict[str, int] = {}
+    todo: List[Dict[str, Any]] = []
+    skipped: List[Dict[str, Any]] = []
+    for it in items:
+        k = stable_key(it)
+        if k not in pool:
+            # a unit counted by the checkpoint is also visible in the cart -> max, not sum
+            pool[k] = max(in_cart.get(k, 0), done.get(k, 0))
+        want = max(1, int(it.get("quantity") or 1))
+        have = min(pool[k], want)
+        pool[k] -= have
+        if have >= want:
+            skipped.append(it)
+        else:
+            todo.append({**it, "quantity": want - have})
+    for k, extra in pool.items():
+        if extra > 0 and in_cart.get(k, 0) > 0:
+            logger.info("AEON カートに余分: %s +%d（削除はしません）", k, extra)
+    return todo, skipped
+
+
+class CartCheckpoint:
+    """
+    Per-user JSON file of items already added in this checkout (written after each success).
+    Bound to the cart contents via run_key, so a new cart never reuses an old checkpoint.
+    """
 
-    history_ref = db.document(history_doc_path)
+    def __init__(self, path: str, run_key: str):
+        self.path = os.path.expanduser(path)
+        self.run_key = run_key
+        self.data: Dict[str, Any] = {"runKey": run_key, "added": {}, "substitutes": {}}
+        with contextlib.suppress(Exception):
+            with open(self.path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            if loaded.get("runKey") == run_key:
+                self.data = loaded
+
+    @property
+    def added(self) -> Dict[str, int]:
+        return self.data["added"]
+
+    @property
+    def substitutes(self) -> Dict[str, Dict[str, Any]]:
+        """original pid -> substitute cart item chosen for it (kept so a resumed run reuses it)"""
+        return self.data.setdefault("substitutes", {})
+
+    def mark(self, key: str, qty: int) -> None:
+        self.added[key] = self.added.get(key, 0) + int(qty)
+        self._save()
+
+    def mark_substitute(self, pid: str, sub: Dict[str, Any]) -> None:
+        self.substitutes[pid] = sub
+        self._save()
+
+    def _save(self) -> None:
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def clear(self) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+def checkpoint_path(args: argparse.Namespace, uid: str) -> str:
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", uid)
+    return os.path.join(os.path.expanduser(args.checkpoint_dir), f"{safe}.json")
+
+
+def prepare_resume(driver: webdriver.Chrome, wait: WebDriverWait, uid: str, cart: Dict[str, Any],
+                   items: List[Dict[str, Any]], args: argparse.Namespace
+                   ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], CartCheckpoint, Optional[Dict[str, int]]]:
+    """(todo, skipped, checkpoint, AEON cart snapshot or None if it could not be read)"""
+    checkpoint = CartCheckpoint(checkpoint_path(args, uid), checkout_id_for(uid, cart["records"]))
     try:
-        history_ref.set({
-            "items": fb_firestore.ArrayUnion(items),
-            "updatedAt": fb_firestore.SERVER_TIMESTAMP
-        }, merge=True)
-        log(f"[INFO] appended {len(items)} item(s) to {history_doc_path}")
+        in_cart = scrape_aeon_cart(driver, wait)
     except Exception as e:
-        errlog(f"[ERROR] failed to write history doc: {e}")
-        raise
+        logger.warning("AEON カートの読み取りに失敗（チェックポイントのみで差分）: %s", e)
+        in_cart = None
+    todo, skipped = plan_cart_diff(items, in_cart or {}, checkpoint.added)
+    logger.info("差分: 追加 %d / 投入済みスキップ %d", len(todo), len(skipped))
+    return todo, skipped, checkpoint, in_cart
+
+
+# ====== Substitutes ======
+COMBOS_DIR = Path(__file__).resolve().parents[2] / "combos"
+
 
-    # delete docs in batches
-    deleted = 0
-    batch_size = 400
+@lru_cache(maxsize=1)
+def _food_index():
+    """
+    Nearest-neighbour index over foodData.json, built on first use. combos/food_index.py is
+    loaded by path (like FOOD_DATA_PATH), so neither sys.path nor the working directory matters.
+    """
+    spec = importlib.util.spec_from_file_location("kaitasu_food_index", COMBOS_DIR / "food_index.py")
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod.FoodIndex.load(FOOD_DATA_PATH)
+
+
+def pick_substitute(it: Dict[str, Any], pid: str, exclude: Set[str], price_slack: float) -> Optional[Dict[str, Any]]:
+    """
+    Closest product to pid in the same genre that costs at most its price * (1 + price_slack),
+    as a cart item with the same quantity. None if there is none (or pid is not in foodData.json).
+    """
     try:
-        for i in range(0, len(doc_ids), batch_size):
-            batch = db.batch()
-            chunk = doc_ids[i:i+batch_size]
-            for doc_id in chunk:
-                doc_ref = db.document(f"{cart_col}/{doc_id}")
-                batch.delete(doc_ref)
-            batch.commit()
-            deleted += len(chunk)
-            log(f"[INFO] deleted {len(chunk)} cart docs (progress {deleted}/{len(doc_ids)})")
+        index = _food_index()
     except Exception as e:
-        errlog(f"[ERROR] failed while deleting cart docs: {e}")
-        return {"appended": len(items), "deleted": deleted, "historyDocPath": history_doc_path}
+        logger.warning("代替品インデックスを作れません: %s", e)
+        return None
+    row = index.row.get(pid)
+    if row is None:
+        return None
+    sub = index.substitute(pid, max_price=int(index.prices[row] * (1 + price_slack)), exclude=exclude)
+    if sub is None:
+        return None
+    p = index.products[index.row[sub]]
+    return with_key({"id": sub, "url": p.get("url") or "", "name": p.get("name") or "",
+                     "imgUrl": p.get("imgUrl") or "", "price": int(index.prices[index.row[sub]]),
+                     "quantity": it.get("quantity") or 1, "substituteFor": pid})
+
+
+def swap_record(pid: str, name: str, error: str, sub: Dict[str, Any]) -> Dict[str, Any]:
+    """checkout_items()["substituted"] entry (also what the checkpoint keeps per original)"""
+    return {"id": pid, "name": name, "error": error, "substitute": sub["id"],
+            "substituteName": sub.get("name") or "", "substituteUrl": sub.get("url") or "",
+            "substituteImage": sub.get("imgUrl") or "", "substitutePrice": sub.get("price")}
+
+
+def swap_item(swap: Dict[str, Any], qty: int) -> Dict[str, Any]:
+    """Cart item for the substitute of a swap_record()"""
+    return with_key({"id": swap["substitute"], "url": swap.get("substituteUrl") or "",
+                     "name": swap.get("substituteName") or "", "imgUrl": swap.get("substituteImage") or "",
+                     "price": swap.get("substitutePrice"), "quantity": qty, "substituteFor": swap["id"]})
+
+
+# ====== Per-user checkout ======
+def checkout_items(driver: webdriver.Chrome, wait: WebDriverWait, items: List[Dict[str, Any]],
+                   args: argparse.Namespace, checkpoint: Optional[CartCheckpoint] = None,
+                   in_cart: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """
+    Add every item to the AEON net cart of the logged-in browser session.
+    A failed item goes to the end of the queue (--requeue-rounds) instead of being retried in place,
+    with only its unconfirmed units. Before a requeued attempt the AEON cart is compared with its
+    state at the start of the run (in_cart; read here if not given), so units whose clicks went
+    through unconfirmed are not added twice. Once the failure budget (counted per item) is spent
+    the remaining items are given up.
+    With --substitute-on-fail an item that finally fails is replaced by its closest substitute,
+    which is tried next (once; a failed substitute is not substituted again). The swap is kept in
+    the checkpoint, so a resumed run tops up that substitute instead of picking another one.
+    Returns {"added": [...ids], "failed": [{id,name,error}],
+             "substituted": [swap_record() of every substitute that landed]}
+    """
+    added: List[str] = []
+    failed: List[Dict[str, Any]] = []
+    substituted: List[Dict[str, Any]] = []
+    sched = RetryScheduler.from_args(args, total=len(items))
+    queue = deque((it, 0) for it in items)
+    if in_cart is None and sched.requeue_rounds:
+        try:
+            in_cart = scrape_aeon_cart(driver, wait)
+        except Exception as e:
+            logger.warning("AEON カートを読めません（再投入前の確認なし）: %s", e)
+    # units of each key that reached the AEON cart in this run (confirmed or found on re-check)
+    landed: Dict[str, int] = {}
+
+    def note_landed(it: Dict[str, Any], n: int) -> None:
+        if n <= 0:
+            return
+        k = stable_key(it)
+        landed[k] = landed.get(k, 0) + n
+        if checkpoint is not None:
+            checkpoint.mark(k, n)
+
+    def recheck(it: Dict[str, Any], qty: int) -> int:
+        """Units of a requeued item that are still missing from the AEON cart."""
+        if in_cart is None:
+            return qty
+        try:
+            now = scrape_aeon_cart(driver, wait)
+        except Exception as e:
+            logger.warning("AEON カートの再確認に失敗（未確認分をそのまま再投入）: %s", e)
+            return qty
+        k = stable_key(it)
+        found = min(qty, max(0, now.get(k, 0) - in_cart.get(k, 0) - landed.get(k, 0)))
+        if found:
+            logger.info("%s: 未確認だった %d 点は AEON カートに入っていました。", k, found)
+            note_landed(it, found)
+        return qty - found
+    # swaps of this run (and of the checkpointed run) by original pid
+    swaps: Dict[str, Dict[str, Any]] = dict(checkpoint.substitutes) if checkpoint is not None else {}
+    # never substitute with something the cart already holds (or held in an earlier run)
+    taken: Set[str] = {normalize_id(it.get("id"), it.get("url") or "") for it in items}
+    taken.update(k[3:] for k in list(in_cart or {}) + list(checkpoint.added if checkpoint else {})
+                 if k.startswith("id:"))
+    taken.update(sw["substitute"] for sw in swaps.values())
+
+    def done(it: Dict[str, Any], pid: str, url: str) -> None:
+        added.append(pid or url)
+        if it.get("substituteFor") and it["substituteFor"] in swaps:
+            substituted.append(swaps[it["substituteFor"]])
+
+    def fail(it: Dict[str, Any], rec: Dict[str, Any]) -> None:
+        if it.get("substituteFor"):
+            rec["substituteFor"] = it["substituteFor"]
+        failed.append(rec)
+
+    def give_up(it: Dict[str, Any], pid: str, name: str, error: str) -> None:
+        sub = None
+        if getattr(args, "substitute_on_fail", False) and not it.get("substituteFor"):
+            sub = pick_substitute(it, pid, taken, args.substitute_price_slack)
+        if sub is None:
+            fail(it, {"id": pid, "name": name, "error": error})
+            return
+        taken.add(sub["id"])
+        logger.warning("%s の代わりに類似商品 %s を入れます。", (name or pid), (sub["name"] or sub["id"]))
+        TRACER.count("substitute")
+        swaps[pid] = swap_record(pid, name, error, sub)
+        if checkpoint is not None:
+            checkpoint.mark_substitute(pid, swaps[pid])
+        queue.appendleft((sub, 0))
+    while queue:
+        it, rounds = queue.popleft()
+        url = (it.get("url") or "").strip()
+        pid = normalize_id(it.get("id"), url)
+        name = (it.get("name") or "").strip()
+        qty  = it.get("quantity") or 1
+        if not it.get("substituteFor") and pid in swaps:
+            # replaced in the interrupted run: top up that substitute, never pick a second one
+            sub = swap_item(swaps[pid], qty)
+            left = qty - (checkpoint.added.get(stable_key(sub), 0) if checkpoint is not None else 0)
+            logger.info("%s は前回 %s に置き換え済み（残り %d 点）", (name or pid), swaps[pid]["substitute"], max(0, left))
+            if left <= 0:
+                done(sub, sub["id"], sub["url"])
+            else:
+                sub["quantity"] = left
+                queue.appendleft((sub, 0))
+            continue
+        if rounds:
+            qty = recheck(it, qty)
+            if qty <= 0:
+                sched.record_success()
+                done(it, pid, url)
+                continue
+            it = {**it, "quantity": qty}
+        if sched.budget_exhausted():
+            logger.error("失敗が上限（%d 件）を超えたため残り %d 件を中断します。", sched.failures, len(queue) + 1)
+            for rest, _ in [(it, rounds)] + list(queue):
+                fail(rest, {"id": normalize_id(rest.get("id"), rest.get("url") or ""),
+                            "name": (rest.get("name") or "").strip(), "error": "failure budget exhausted"})
+            break
+        sched.before_item()
+        try:
+            add_to_cart_via_url(driver, wait, url=url, pid=pid, name=name,
+                                qty=qty, max_retries=args.max_retries_per_item, sched=sched,
+                                qty_strategy=args.qty_strategy)
+            sched.record_success()
+            done(it, pid, url)
+            note_landed(it, qty)
+            time.sleep(args.sleep_after_add)
+        except PermanentAddError as e:
+            # a missing product says nothing about the site's health: no requeue, no breaker
+            logger.error("Failed to add %s: %s", (name or pid or "N/A"), e)
+            give_up(it, pid, name, str(e))
+        except Exception as e:
+            confirmed = e.confirmed if isinstance(e, UnconfirmedAddError) else 0
+            note_landed(it, confirmed)
+            requeue = sched.should_requeue(rounds)
+            sched.record_failure(final=not requeue)
+            if requeue:
+                logger.warning("Requeue %s x%d (round %d): %s", (name or pid or "N/A"), qty - confirmed, rounds + 1, e)
+                TRACER.count("requeue")
+                queue.append(({**it, "quantity": qty - confirmed}, rounds + 1))
+                continue
+            logger.error("Failed to add %s: %s", (name or pid or "N/A"), e)
+            give_up(it, pid, name, str(e))
+    return {"added": added, "failed": failed, "substituted": substituted}
+
+
+# ====== Batch mode ======
+class JsonlReport:
+    """Thread-safe JSON lines writer for per-user batch results."""
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._lock = threading.Lock()
 
-    return {"appended": len(items), "deleted": deleted, "historyDocPath": history_doc_path}
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def resolve_batch_uids(args: argparse.Namespace) -> List[str]:
+    uids: List[str] = []
+    if args.uids:
+        uids.extend(u.strip() for u in args.uids.split(",") if u.strip())
+    if args.uids_file:
+        with open(os.path.expanduser(args.uids_file), "r", encoding="utf-8") as f:
+            uids.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    # keep order, drop duplicates
+    return list(dict.fromkeys(uids))
+
+
+def user_profile_dir(base_dir: str, uid: str) -> str:
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", uid)
+    return os.path.join(os.path.expanduser(base_dir), "users", safe)
+
+
+def run_user_checkout(db, uid: str, cart: Dict[str, Any], args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Batch worker: one isolated browser profile per uid (keeps each user's AEON session apart).
+    """
+    started = time.time()
+    items = dedupe_items(cart["items"]) if args.dedupe else cart["items"]
+    rec: Dict[str, Any] = {"uid": uid, "items": len(items), "added": 0, "failed": [], "status": "ok"}
+    if not items:
+        rec["status"] = "empty"
+        rec["elapsedSec"] = 0.0
+        return rec
+
+    driver = None
+    try:
+        driver = build_driver(
+            browser=args.browser,
+            user_data_dir=user_profile_dir(args.user_data_dir, uid),
+            profile_dir=None,
+            headless=args.headless,
+            auto_attach=False,
+            debugger_address=None,
+            fast_profile=args.fast_profile,
+        )
+        wait = WebDriverWait(driver, 20)
+        ensure_logged_in(driver, wait, force=args.force_login, max_wait_sec=args.login_wait)
+
+        checkpoint = None
+        in_cart: Optional[Dict[str, int]] = None
+        skipped: List[Dict[str, Any]] = []
+        if args.resume:
+            items, skipped, checkpoint, in_cart = prepare_resume(driver, wait, uid, cart, items, args)
+            rec["skipped"] = len(skipped)
+
+        res = checkout_items(driver, wait, items, args, checkpoint, in_cart)
+        rec["added"] = len(res["added"])
+        rec["failed"] = res["failed"]
+        if res["substituted"]:
+            rec["substituted"] = res["substituted"]
+        if res["failed"]:
+            rec["status"] = "partial" if (res["added"] or skipped) else "failed"
+        elif checkpoint is not None:
+            checkpoint.clear()
+
+        if args.call_postprocess and (res["added"] or skipped):
+            rec["postprocess"] = move_cart_to_history(db, uid, args.postprocess_history_doc,
+                                                      dry=args.dry, logger_obj=logger, snapshot=cart,
+                                                      layout=args.history_layout,
+                                                      substitutions=res["substituted"])
+    except Exception as e:
+        logger.error("uid=%s の処理に失敗: %s", uid, e)
+        rec["status"] = "error"
+        rec["error"] = str(e)
+    finally:
+        if driver is not None:
+            with contextlib.suppress(Exception):
+                driver.quit()
+    rec["elapsedSec"] = round(time.time() - started, 3)
+    return rec
+
+
+def run_batch(db, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    uids = resolve_batch_uids(args)
+    if args.uids_from_carts:
+        carts = read_carts_by_collection_group(db, uids or None)
+        uids = uids or sorted(carts)
+    else:
+        carts = read_carts_bulk(db, uids, args.from_all)
+    logger.info("batch: users=%d concurrency=%d report=%s", len(uids), args.concurrency, args.report)
+    if uids:
+        # resolve (and download) chromedriver once, before the workers race for it
+        logger.info("chromedriver: %s", resolve_chromedriver() or "Selenium Manager")
+
+    report = JsonlReport(args.report)
+    results: List[Dict[str, Any]] = []
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as ex:
+        futs = {}
+        for u in uids:
+            cart = carts.get(u) or {"path": f"users/{u}/cart", "reads": 0, "records": [], "items": []}
+            futs[ex.submit(run_user_checkout, db, u, cart, args)] = u
+        for fut in as_completed(futs):
+            rec = fut.result()
+            report.write(rec)
+            results.append(rec)
+            logger.info("batch: uid=%s status=%s added=%d failed=%d (%.1fs)",
+                        rec["uid"], rec["status"], rec["added"], len(rec["failed"]), rec["elapsedSec"])
+    return results
 
 
 # ====== CLI ======
-def parse_args():
-    p = argparse.ArgumentParser(description="AEON / Firestore cart -> add to AEON cart and optionally move to history")
+COMMANDS = ("add", "postprocess", "dry-plan")
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    """
+    [add|postprocess|dry-plan] [options]; without a command the legacy flags mean "add".
+      add         : browser run (Firestore cart -> AEON cart, optional history move)
+      postprocess : cart -> history move only, no browser
+      dry-plan    : read carts and print what add/postprocess would do, no browser, no writes
+    """
+    argv = list(sys.argv[1:] if argv is None else argv)
+    command = argv.pop(0) if argv and argv[0] in COMMANDS else "add"
+    p = argparse.ArgumentParser(usage="%(prog)s [add|postprocess|dry-plan] [options]",
+                                description="AEON / Firestore cart -> add to AEON cart and optionally move to history")
     p.add_argument("--browser", default="auto", choices=["auto","chrome","brave"])
     p.add_argument("--user-data-dir", default=DEFAULT_USER_DATA_DIR)
     p.add_argument("--profile-dir", default=None)
     p.add_argument("--auto-attach", action="store_true")
     p.add_argument("--debugger-address", default="127.0.0.1:9222")
     p.add_argument("--headless", action="store_true")
+    p.add_argument("--chromedriver", default="", help="pinned chromedriver binary (default: CHROMEDRIVER or cached)")
+    p.add_argument("--fast-profile", action="store_true",
+                   help="block images/media/fonts/trackers, eager page loads, fewer Chrome features")
     # Firebase
     p.add_argument("--use-firebase", action="store_true")
     p.add_argument("--fb-cred", default=os.environ.get("GOOGLE_APPLICATION_CREDENTIALS",""))
@@ -721,22 +2112,153 @@ def parse_args():
     p.add_argument("--dedupe", action="store_true")
     p.add_argument("--sleep-after-add", type=float, default=0.6)
     p.add_argument("--force-login", action="store_true")
+    p.add_argument("--login-wait", type=int, default=300, help="seconds to wait for a manual login")
     p.add_argument("--max-retries-per-item", type=int, default=3)
+    p.add_argument("--qty-strategy", default="auto", choices=QTY_STRATEGIES,
+                   help="no qty field on the product page: pipeline clicks + one badge check, "
+                        "cart = one add then set the quantity on the cart page, click = one cycle per unit")
+    p.add_argument("--requeue-rounds", type=int, default=1, help="times a failed item is retried at the end of the run")
+    p.add_argument("--failure-budget", type=float, default=0.3,
+                   help="give up the rest of the run once this share of items has failed")
+    p.add_argument("--breaker-threshold", type=int, default=5, help="failed items in a row before pausing")
+    p.add_argument("--backoff-base", type=float, default=0.3, help="seconds; grows with the observed page latency")
+    p.add_argument("--backoff-cap", type=float, default=20.0)
+    p.add_argument("--substitute-on-fail", action="store_true",
+                   help="replace an item that cannot be added by its closest product (same genre, nutrients, price)")
+    p.add_argument("--substitute-price-slack", type=float, default=0.0,
+                   help="a substitute may cost up to the original price * (1 + this)")
     p.add_argument("--keep-open", action="store_true")
     p.add_argument("--no-home-return", action="store_true")
     # postprocess
     p.add_argument("--call-postprocess", action="store_true",
                    help="If set, after adding to AEON cart, move Firestore cart -> history")
-    p.add_argument("--postprocess-history-doc", default="last-checkout")
+    p.add_argument("--postprocess-history-doc", default="last-checkout",
+                   help="history doc id for --history-layout single")
+    p.add_argument("--history-layout", default="sharded", choices=HISTORY_LAYOUTS,
+                   help="sharded: one history doc per checkout + rolling summary / single: one ever-growing doc")
+    p.add_argument("--postprocess-async", action="store_true",
+                   help="run the cart -> history move concurrently with the final browser navigation")
+    # resume
+    p.add_argument("--resume", action="store_true",
+                   help="read the AEON cart first and add only missing items/quantities (checkpointed per item)")
+    p.add_argument("--checkpoint-dir", default=DEFAULT_CHECKPOINT_DIR)
     # runtime
-    p.add_argument("--uid", required=True, help="user id to process")
+    p.add_argument("--uid", default="", help="user id to process")
+    p.add_argument("--aeon-origin", default="", help="storefront origin (default: AEON_ORIGIN or https://shop.aeon.com)")
     p.add_argument("--python-debug", action="store_true")
     p.add_argument("--dry", action="store_true", help="dry-run: no writes to Firestore")
-    return p.parse_args()
+    p.add_argument("--trace-file", default="",
+                   help="write one JSON line per step span (OpenTelemetry-like); "
+                        "the p50/p95 summary per step is logged at the end either way")
+    # batch
+    p.add_argument("--uids", default="", help="batch: comma separated user ids")
+    p.add_argument("--uids-file", default="", help="batch: file with one user id per line")
+    p.add_argument("--uids-from-carts", action="store_true",
+                   help="batch: pick users from a collection-group query over users/*/cart")
+    p.add_argument("--concurrency", type=int, default=2, help="batch: browsers running at the same time")
+    p.add_argument("--report", default="checkout-report.jsonl", help="batch: per-user result file (JSON lines)")
+    args = p.parse_args(argv)
+    args.command = command
+    args.batch = bool(args.uids or args.uids_file or args.uids_from_carts)
+    if not args.uid and not args.batch and not (command == "dry-plan" and args.cart_path):
+        p.error("--uid (or --uids / --uids-file / --uids-from-carts) is required")
+    return args
+
+
+def init_db_from_args(args: argparse.Namespace):
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        return init_firebase_admin("", args.fb_project or None)
+    credp = os.path.expanduser(args.fb_cred) if args.fb_cred else os.environ.get("GOOGLE_APPLICATION_CREDENTIALS","")
+    if not credp or not os.path.exists(credp):
+        logger.error("サービスアカウントJSONが見つかりません: %s", credp)
+        return None
+    return init_firebase_admin(credp, args.fb_project or None)
+
+
+def main(argv: Optional[List[str]] = None):
+    global TRACER, CHROMEDRIVER_PATH
+    args = parse_args(argv)
+    # always aggregate per-stage timings so the summary table is logged at the end;
+    # the span records are written only with --trace-file
+    TRACER = Tracer(args.trace_file)
+    if args.aeon_origin:
+        configure_site(args.aeon_origin)
+    if args.chromedriver:
+        CHROMEDRIVER_PATH = args.chromedriver
+    try:
+        if args.command == "postprocess":
+            _run_postprocess(args)
+        elif args.command == "dry-plan":
+            _run_dry_plan(args)
+        else:
+            _run(args)
+    finally:
+        TRACER.log_summary(logger)
+        TRACER.close()
+
+
+def _command_carts(db, args: argparse.Namespace, from_all: bool) -> Dict[str, Dict[str, Any]]:
+    """{uid: cart snapshot} for the uids the options name (postprocess / dry-plan)."""
+    if not args.batch:
+        return {args.uid: read_cart(db, args.cart_path or f"users/{args.uid}/cart", from_all)}
+    uids = resolve_batch_uids(args)
+    if args.uids_from_carts:
+        carts = read_carts_by_collection_group(db, uids or None)
+        return {u: carts[u] for u in (uids or sorted(carts)) if u in carts}
+    return read_carts_bulk(db, uids, from_all)
 
 
-def main():
-    args = parse_args()
+def _run_postprocess(args: argparse.Namespace):
+    db = init_db_from_args(args)
+    if db is None:
+        sys.exit(1)
+    failed = 0
+    # the move always covers the whole cart (same as move_cart_to_history's own read)
+    for uid, cart in _command_carts(db, args, from_all=True).items():
+        try:
+            res = move_cart_to_history(db, uid, args.postprocess_history_doc, dry=args.dry, logger_obj=logger,
+                                       snapshot=cart, layout=args.history_layout)
+            logger.info("postprocess uid=%s: %s", uid, res)
+        except Exception as e:
+            failed += 1
+            logger.error("postprocess failed uid=%s: %s", uid, e)
+    if failed:
+        sys.exit(2)
+
+
+def _run_dry_plan(args: argparse.Namespace):
+    db = init_db_from_args(args)
+    if db is None:
+        sys.exit(1)
+    for uid, cart in _command_carts(db, args, args.from_all).items():
+        items = dedupe_items(cart["items"]) if args.dedupe else cart["items"]
+        plan: Dict[str, Any] = {"uid": uid, "cartPath": cart["path"], "reads": cart["reads"], "items": len(items),
+                                "units": sum(int(it.get("quantity") or 1) for it in items)}
+        if args.resume:
+            # checkpoint only: the AEON cart itself needs the browser
+            cp = CartCheckpoint(checkpoint_path(args, uid), checkout_id_for(uid, cart["records"]))
+            todo, skipped = plan_cart_diff(items, {}, cp.added)
+            plan.update(todo=len(todo), skippedByCheckpoint=len(skipped))
+        if cart["records"] and uid:
+            plan["postprocess"] = move_cart_to_history(db, uid, args.postprocess_history_doc, dry=True,
+                                                       logger_obj=logger, snapshot=cart,
+                                                       layout=args.history_layout)
+        print(json.dumps(plan, ensure_ascii=False, default=str))
+
+
+def _run(args: argparse.Namespace):
+    _load_selenium()
+    if args.batch:
+        # Firestore is the only source of carts in batch mode; one client shared by every worker
+        db = init_db_from_args(args)
+        if db is None:
+            sys.exit(1)
+        results = run_batch(db, args)
+        bad = [r for r in results if r["status"] in ("failed", "error")]
+        logger.info("batch 完了: users=%d failed=%d", len(results), len(bad))
+        if bad:
+            sys.exit(2)
+        return
 
     # build webdriver
     try:
@@ -747,6 +2269,7 @@ def main():
             headless=args.headless,
             auto_attach=args.auto_attach,
             debugger_address=(args.debugger_address if args.auto_attach else None),
+            fast_profile=args.fast_profile,
         )
         logger.info("ブラウザ準備OK")
     except WebDriverException as e:
@@ -757,23 +2280,22 @@ def main():
 
     try:
         # ensure logged-in (keeps current page)
-        ensure_logged_in(driver, wait, force=args.force_login, max_wait_sec=300)
+        ensure_logged_in(driver, wait, force=args.force_login, max_wait_sec=args.login_wait)
 
         # Firestore setup (required to fetch cart items)
         if not args.use_firebase:
             logger.error("--use-firebase を指定してください。"); return
 
-        credp = os.path.expanduser(args.fb_cred) if args.fb_cred else os.environ.get("GOOGLE_APPLICATION_CREDENTIALS","")
-        if not credp or not os.path.exists(credp):
-            logger.error("サービスアカウントJSONが見つかりません: %s", credp)
+        db = init_db_from_args(args)
+        if db is None:
             # proceed without firebase only if not required
             return
 
-        db = init_firebase_admin(credp, args.fb_project or None)
-
         cart_path = args.cart_path or f"users/{args.uid}/cart"
-        docs_count, items = fetch_cart_items(db, cart_path, args.from_all)
-        logger.info("cart 読み取り: %s docs=%d items=%d", cart_path, docs_count, len(items))
+        # read once; the same snapshot feeds the postprocess step below
+        cart = read_cart(db, cart_path, args.from_all)
+        items = cart["items"]
+        logger.info("cart 読み取り: %s docs=%d items=%d", cart_path, cart["reads"], len(items))
 
         if args.dedupe:
             items = dedupe_items(items)
@@ -782,26 +2304,34 @@ def main():
         if not items:
             logger.info("投入する商品がありません。"); return
 
+        # Resume: only add what the AEON cart (or the last run's checkpoint) does not have yet
+        checkpoint = None
+        in_cart: Optional[Dict[str, int]] = None
+        if args.resume:
+            items, _, checkpoint, in_cart = prepare_resume(driver, wait, args.uid, cart, items, args)
+
         # Add each item to AEON net cart
-        for it in items:
-            url = (it.get("url") or "").strip()
-            pid = normalize_id(it.get("id"), url)
-            name = (it.get("name") or "").strip()
-            qty  = it.get("quantity") or 1
-            try:
-                add_to_cart_via_url(driver, wait, url=url, pid=pid, name=name,
-                                    qty=qty, max_retries=args.max_retries_per_item)
-                time.sleep(args.sleep_after_add)
-            except Exception as e:
-                logger.error("Failed to add %s: %s", (name or pid or "N/A"), e)
+        res = checkout_items(driver, wait, items, args, checkpoint, in_cart)
+        for sub in res["substituted"]:
+            logger.info("代替: %s → %s", (sub["name"] or sub["id"]), sub["substitute"])
+        if checkpoint is not None and not res["failed"]:
+            checkpoint.clear()
 
         # Optionally call postprocess (move cart -> history)
+        post_exec = ThreadPoolExecutor(max_workers=1) if args.postprocess_async else None
+        post_fut = None
         if args.call_postprocess:
-            try:
-                res = move_cart_to_history(db, args.uid, args.postprocess_history_doc, dry=args.dry, logger_obj=logger)
-                logger.info("postprocess result: %s", res)
-            except Exception as e:
-                logger.error("postprocess failed: %s", e)
+            kwargs = dict(dry=args.dry, logger_obj=logger, snapshot=cart, layout=args.history_layout,
+                          substitutions=res["substituted"])
+            if post_exec is not None:
+                # overlaps the Firestore writes with the final browser navigation
+                post_fut = move_cart_to_history_async(post_exec, db, args.uid, args.postprocess_history_doc, **kwargs)
+            else:
+                try:
+                    res = move_cart_to_history(db, args.uid, args.postprocess_history_doc, **kwargs)
+                    logger.info("postprocess result: %s", res)
+                except Exception as e:
+                    logger.error("postprocess failed: %s", e)
 
         # final navigation
         if not args.no_home_return:
@@ -810,6 +2340,14 @@ def main():
                 wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
                 wait_dom_stable(driver, duration=0.5, timeout=6)
 
+        if post_fut is not None:
+            try:
+                logger.info("postprocess result: %s", post_fut.result())
+            except Exception as e:
+                logger.error("postprocess failed: %s", e)
+        if post_exec is not None:
+            post_exec.shutdown(wait=True)
+
         logger.info("完了。ブラウザは開いたままです。" if args.keep_open else "完了。ブラウザを閉じます。")
         if args.keep_open:
             while True:
@@ -822,4 +2360,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
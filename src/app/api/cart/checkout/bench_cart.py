@@ -0,0 +1,119 @@
+# Offline benchmark of the cart driver: fake AEON storefront + in-memory Firestore + real Chrome.
+#
+#   python bench_cart.py --sizes 1,10,100 --latency-ms 120 --add-fail-rate 0.05 --headless
+#
+# For every cart size a fresh user/cart is seeded, run_user_checkout() adds it through the fake
+# site (postprocess into the fake Firestore included) and one JSON line is written per run:
+# items/min, retry rate, fallback rate, add_item p50/p95 and end-to-end seconds.
+
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from typing import Any, Dict, List
+
+import aeon_netsuper_cart as cart
+from cart_trace import Tracer
+from fake_aeon_server import FakeAeonSite, serve_in_thread, add_config_args, config_from_args
+from fake_firestore import FakeFirestore
+
+
+def seed_cart(db: FakeFirestore, uid: str, pids: List[str], qty_max: int, rng: random.Random) -> None:
+    # same shape as the web app's cart docs: doc id = product id, quantity only
+    db.seed({f"users/{uid}/cart/{pid}": {"quantity": rng.randint(1, qty_max)} for pid in pids})
+
+
+def bench_once(site: FakeAeonSite, origin: str, db: FakeFirestore, size: int, run_no: int,
+               opts: argparse.Namespace, rng: random.Random) -> Dict[str, Any]:
+    uid = f"bench-{size}-{run_no}"
+    seed_cart(db, uid, rng.sample(sorted(site.catalog), size), opts.qty_max, rng)
+    argv = ["--uid", uid, "--use-firebase", "--call-postprocess", "--aeon-origin", origin,
+            "--user-data-dir", opts.profile_root, "--sleep-after-add", str(opts.sleep_after_add),
+            "--max-retries-per-item", str(opts.max_retries_per_item), "--qty-strategy", opts.qty_strategy]
+    if opts.headless:
+        argv.append("--headless")
+    if opts.fast_profile:
+        argv.append("--fast-profile")
+    args = cart.parse_args(argv)
+    cart.configure_site(origin)
+    cart.TRACER = tracer = Tracer(opts.trace_file) if opts.trace_file else Tracer()
+    site.reset()
+    stats0 = dict(db.stats)
+
+    started = time.time()
+    snapshot = cart.read_cart(db, f"users/{uid}/cart", from_all=True)
+    rec = cart.run_user_checkout(db, uid, snapshot, args)
+    elapsed = time.time() - started
+
+    s = tracer.summary()
+    tracer.close()
+    add = s["steps"].get("add_item", {})
+    attempts = s["steps"].get("attempt", {}).get("count", 0)
+    return {
+        "size": size,
+        "run": run_no,
+        "status": rec["status"],
+        "added": rec["added"],
+        "failed": len(rec["failed"]),
+        "elapsedSec": round(elapsed, 3),
+        "itemsPerMin": round(rec["added"] / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "retryRate": round(s["retries"] / attempts, 4) if attempts else 0.0,
+        "fallbackRate": round(s["fallbackRate"], 4),
+        "addItemP50Ms": add.get("p50Ms", 0.0),
+        "addItemP95Ms": add.get("p95Ms", 0.0),
+        "site": dict(site.counters),
+        "firestore": {k: db.stats[k] - stats0.get(k, 0) for k in db.stats},
+        "postprocess": rec.get("postprocess"),
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description="benchmark aeon_netsuper_cart.py against a local fake AEON site")
+    p.add_argument("--sizes", default="1,10,100")
+    p.add_argument("--repeat", type=int, default=1)
+    p.add_argument("--qty-max", type=int, default=1)
+    p.add_argument("--qty-strategy", default="auto", choices=cart.QTY_STRATEGIES)
+    p.add_argument("--headless", action="store_true")
+    p.add_argument("--fast-profile", action="store_true")
+    p.add_argument("--sleep-after-add", type=float, default=0.0)
+    p.add_argument("--max-retries-per-item", type=int, default=3)
+    p.add_argument("--firestore-latency-ms", type=float, default=0.0)
+    p.add_argument("--profile-root", default="")
+    p.add_argument("--trace-file", default="")
+    p.add_argument("--out", default="bench-cart.jsonl")
+    add_config_args(p)
+    opts = p.parse_args()
+    opts.profile_root = opts.profile_root or tempfile.mkdtemp(prefix="bench-cart-")
+
+    rng = random.Random(opts.seed)
+    site = FakeAeonSite.from_food_data(config=config_from_args(opts))
+    server, origin = serve_in_thread(site)
+    db = FakeFirestore(latency_ms=opts.firestore_latency_ms)
+    cart.logger.info("fake AEON: %s (%d products)", origin, len(site.catalog))
+
+    results = []
+    try:
+        with open(opts.out, "a", encoding="utf-8") as f:
+            for size in [int(x) for x in opts.sizes.split(",") if x.strip()]:
+                for run_no in range(opts.repeat):
+                    r = bench_once(site, origin, db, size, run_no, opts, rng)
+                    f.write(json.dumps(r, ensure_ascii=False, default=str) + "\n")
+                    f.flush()
+                    results.append(r)
+    finally:
+        server.shutdown()
+
+    cart.logger.info("%6s %4s %8s %10s %8s %9s %10s %10s", "size", "run", "status", "items/min",
+                     "retry%", "fallback%", "p50(ms)", "e2e(s)")
+    for r in results:
+        cart.logger.info("%6d %4d %8s %10.2f %8.1f %9.1f %10.1f %10.2f", r["size"], r["run"], r["status"],
+                         r["itemsPerMin"], r["retryRate"] * 100, r["fallbackRate"] * 100, r["addItemP50Ms"],
+                         r["elapsedSec"])
+    if any(r["status"] in ("failed", "error") for r in results):
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
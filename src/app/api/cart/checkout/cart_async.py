@@ -0,0 +1,546 @@
+# asyncio orchestrator for the AEON cart driver over the Chrome DevTools Protocol.
+#
+# One Chrome (started with --remote-debugging-port, or --launch) drives several tabs
+# concurrently; page loads, confirmation waits and Firestore I/O overlap in one process.
+# Item normalization, dedupe, page-probe scripts and the history write plan are shared
+# with aeon_netsuper_cart.py.
+#
+#   python cart_async.py --uid UID --debugger-address 127.0.0.1:9222 --tabs 4 --call-postprocess
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import itertools
+import subprocess
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import aeon_netsuper_cart as cart
+from cart_ids import normalize_id
+from aeon_netsuper_cart import (
+    logger, dedupe_items, items_from_cart_records, is_collection_path,
+    checkout_id_for, plan_history_move, history_shard_id, summary_shard_refs,
+    history_shard_chunk_writes, history_backfill_shard_refs, history_backfill_writes, apply_transaction_writes,
+    HISTORY_LAYOUTS, HISTORY_WRITE_COST, SUMMARY_WRITE_COST, CART_FIELDS, JST,
+    PROBE_CONFIG, PAGE_PROBE_JS, PICK_OPTIONS_JS, CLOSE_POPUPS_JS,
+)
+
+try:
+    import websockets
+except Exception:
+    websockets = None
+
+
+# ====== CDP client ======
+class CDPError(RuntimeError):
+    pass
+
+
+class CDPConnection:
+    """
+    One browser-level websocket; tabs are flattened sessions on it (Target.attachToTarget flatten=true).
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._closed: Optional[ConnectionError] = None
+        self._listeners: Dict[Tuple[str, str], List[asyncio.Future]] = {}
+        self._reader = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def connect(cls, debugger_address: str) -> "CDPConnection":
+        if websockets is None:
+            raise RuntimeError("websockets not installed. Install via: pip install websockets")
+        url = f"http://{debugger_address}/json/version"
+        info = await asyncio.to_thread(lambda: json.loads(urllib.request.urlopen(url, timeout=10).read()))
+        ws = await websockets.connect(info["webSocketDebuggerUrl"], max_size=None)
+        return cls(ws)
+
+    async def _read_loop(self):
+        # 正常クローズでも例外でも、待っている send()/イベント待ちを即座に失敗させる（30秒のタイムアウトを待たせない）
+        reason = "websocket closed"
+        try:
+            async for raw in self.ws:
+                msg = json.loads(raw)
+                if "id" in msg:
+                    fut = self._pending.pop(msg["id"], None)
+                    if fut is not None and not fut.done():
+                        if "error" in msg:
+                            fut.set_exception(CDPError(msg["error"].get("message", str(msg["error"]))))
+                        else:
+                            fut.set_result(msg.get("result", {}))
+                else:
+                    key = (msg.get("sessionId", ""), msg.get("method", ""))
+                    for fut in self._listeners.pop(key, []):
+                        if not fut.done():
+                            fut.set_result(msg.get("params", {}))
+        except Exception as e:
+            reason = str(e) or type(e).__name__
+        finally:
+            self._closed = ConnectionError(f"CDP connection closed: {reason}")
+            pending = list(self._pending.values()) + [f for futs in self._listeners.values() for f in futs]
+            self._pending.clear()
+            self._listeners.clear()
+            for fut in pending:
+                if not fut.done():
+                    fut.set_exception(self._closed)
+
+    async def send(self, method: str, params: Optional[Dict[str, Any]] = None,
+                   session_id: str = "", timeout: float = 30) -> Dict[str, Any]:
+        if self._closed is not None:
+            raise self._closed
+        mid = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[mid] = fut
+        msg: Dict[str, Any] = {"id": mid, "method": method, "params": params or {}}
+        if session_id:
+            msg["sessionId"] = session_id
+        await self.ws.send(json.dumps(msg))
+        return await asyncio.wait_for(fut, timeout)
+
+    def expect(self, method: str, session_id: str = "") -> asyncio.Future:
+        """Future for the next `method` event (register BEFORE triggering it)."""
+        fut = asyncio.get_running_loop().create_future()
+        if self._closed is not None:
+            fut.set_exception(self._closed)
+            return fut
+        self._listeners.setdefault((session_id, method), []).append(fut)
+        return fut
+
+    async def new_tab(self) -> "CDPTab":
+        target = await self.send("Target.createTarget", {"url": "about:blank"})
+        att = await self.send("Target.attachToTarget", {"targetId": target["targetId"], "flatten": True})
+        tab = CDPTab(self, target["targetId"], att["sessionId"])
+        await tab.send("Page.enable")
+        await tab.send("Runtime.enable")
+        return tab
+
+    async def close(self):
+        self._reader.cancel()
+        await self.ws.close()
+
+
+class CDPTab:
+    def __init__(self, conn: CDPConnection, target_id: str, session_id: str):
+        self.conn = conn
+        self.target_id = target_id
+        self.session_id = session_id
+
+    async def send(self, method: str, params: Optional[Dict[str, Any]] = None, timeout: float = 30):
+        return await self.conn.send(method, params, self.session_id, timeout)
+
+    async def navigate(self, url: str, timeout: float = 20) -> None:
+        loaded = self.conn.expect("Page.domContentEventFired", self.session_id)
+        await self.send("Page.navigate", {"url": url})
+        try:
+            await asyncio.wait_for(loaded, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("[cdp] DOMContentLoaded timeout: %s", url)
+
+    async def evaluate(self, expression: str, timeout: float = 30) -> Any:
+        res = await self.send("Runtime.evaluate", {
+            "expression": expression, "returnByValue": True, "awaitPromise": True,
+        }, timeout)
+        if res.get("exceptionDetails"):
+            raise CDPError(res["exceptionDetails"].get("text", "evaluate failed"))
+        return res.get("result", {}).get("value")
+
+    async def run_script(self, script: str, *args: Any) -> Any:
+        """Run a Selenium-style script body (uses arguments[i]) inside the page."""
+        argv = json.dumps(list(args), ensure_ascii=False)
+        return await self.evaluate(f"(function(){{{script}\n}}).apply(null, {argv})")
+
+    async def wait_stable(self, duration: float = 0.4, timeout: float = 10) -> bool:
+        end = time.time() + timeout
+        last = None
+        while time.time() < end:
+            st = await self.evaluate("[document.readyState, location.href]")
+            if st and st[0] == "complete":
+                if last == st[1]:
+                    return True
+                last = st[1]
+                await asyncio.sleep(duration)
+                continue
+            await asyncio.sleep(0.2)
+        return False
+
+    async def close(self):
+        try:
+            await self.conn.send("Target.closeTarget", {"targetId": self.target_id})
+        except Exception:
+            pass
+
+
+# ====== Page actions (same probe scripts as the Selenium driver) ======
+# element handles cannot cross returnByValue -> report presence only
+_PROBE_VALUE_JS = ("const st = (function(){" + PAGE_PROBE_JS + "\n}).apply(null, arguments);"
+                   "st.button = !!st.button; st.qtyField = !!st.qtyField; return st;")
+
+_SET_QTY_AND_CLICK_JS = ("const st = (function(){" + PAGE_PROBE_JS + "\n}).apply(null, [arguments[0]]);"
+                         r"""
+const qty = arguments[1];
+let qtySet = false;
+if (st.qtyField && qty > 1) {
+  st.qtyField.focus();
+  st.qtyField.value = String(qty);
+  st.qtyField.dispatchEvent(new Event('input', {bubbles: true}));
+  st.qtyField.dispatchEvent(new Event('change', {bubbles: true}));
+  qtySet = true;
+}
+if (!st.button) return {clicked: false, qtySet: qtySet, cartCount: st.cartCount};
+st.button.scrollIntoView({block: 'center'});
+st.button.click();
+return {clicked: true, qtySet: qtySet, cartCount: st.cartCount};
+""")
+
+_PICK_SEARCH_RESULT_JS = r"""
+const pid = arguments[0], name = (arguments[1] || '').toLowerCase();
+const seen = new Set(), cands = [];
+for (const sel of ['a.product-item-link', '.product-item a', "a[href*='.html']", "a[href*='/netsuper/']"]) {
+  for (const a of document.querySelectorAll(sel)) {
+    if (!a.href || seen.has(a.href) || !a.href.endsWith('.html')) continue;
+    seen.add(a.href);
+    let s = 1;
+    if (pid && a.href.includes(pid)) s += 100;
+    if (name && (a.innerText || '').toLowerCase().includes(name)) s += 10;
+    cands.push([s, a.href]);
+  }
+}
+cands.sort((x, y) => y[0] - x[0]);
+return cands.length ? cands[0][1] : null;
+"""
+
+
+async def probe(tab: CDPTab) -> Dict[str, Any]:
+    return (await tab.run_script(_PROBE_VALUE_JS, PROBE_CONFIG)) or {}
+
+
+async def open_page(tab: CDPTab, url: str) -> Dict[str, Any]:
+    await tab.navigate(url)
+    await tab.wait_stable()
+    if await tab.run_script(CLOSE_POPUPS_JS, PROBE_CONFIG):
+        await asyncio.sleep(0.2)
+    return await probe(tab)
+
+
+async def add_item_async(tab: CDPTab, item: Dict[str, Any], *, max_retries: int = 3,
+                         confirm_by_badge: bool = True, confirm_timeout: float = 14) -> None:
+    url = (item.get("url") or "").strip()
+    pid = normalize_id(item.get("id"), url)
+    name = (item.get("name") or "").strip()
+    qty = max(1, int(item.get("quantity") or 1))
+
+    st = await open_page(tab, url)
+    if st.get("loginPage") or not st.get("loggedIn"):
+        raise RuntimeError("未ログイン（ブラウザのプロファイルで先にログインしてください）")
+    if st.get("notFound"):
+        # no search box typing over CDP: go straight to the store's search result page
+        q = pid or name[:20]
+        logger.info("[tab %s] 指定URLが無効っぽい → 検索で再特定: %s", tab.target_id[:6], q)
+        await open_page(tab, f"{cart.BASE}/catalogsearch/result/?q={urllib.parse.quote(q)}")
+        href = await tab.run_script(_PICK_SEARCH_RESULT_JS, pid, name)
+        if not href:
+            raise RuntimeError("検索しても商品ページを特定できない（404 fallback 失敗）")
+        st = await open_page(tab, href)
+        if st.get("notFound"):
+            raise RuntimeError("検索しても商品ページを特定できない（404 fallback 失敗）")
+
+    if st.get("unselectedSelects") or st.get("unselectedRadios"):
+        await tab.run_script(PICK_OPTIONS_JS, PROBE_CONFIG)
+        await asyncio.sleep(0.2)
+
+    clicks_needed = qty if not st.get("qtyField") else 1
+    for _ in range(clicks_needed):
+        for attempt in range(1, max_retries + 1):
+            res = await tab.run_script(_SET_QTY_AND_CLICK_JS, PROBE_CONFIG, qty if clicks_needed == 1 else 1)
+            if not res or not res.get("clicked"):
+                if attempt >= max_retries:
+                    raise RuntimeError("カゴ追加ボタンが見つかりません")
+                await asyncio.sleep(0.8)
+                continue
+            before = res.get("cartCount")
+            end = time.time() + confirm_timeout
+            ok = False
+            while time.time() < end:
+                st = await probe(tab)
+                after = st.get("cartCount")
+                # the badge is shared by all tabs -> only trusted when a single tab runs
+                if st.get("toast") or (confirm_by_badge and before is not None and after is not None
+                                       and after > before):
+                    ok = True
+                    break
+                await asyncio.sleep(0.3)
+            if ok:
+                break
+            if attempt >= max_retries:
+                raise RuntimeError("トースト/バッジ変化が検知できず、投入に失敗した可能性")
+            await asyncio.sleep(0.8)
+
+
+# ====== Firestore (async client) ======
+def init_firestore_async(cred_path: str = "", project_id: Optional[str] = None):
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import firestore as gc_firestore
+        return gc_firestore.AsyncClient(project=project_id or os.environ.get("GCLOUD_PROJECT") or "demo-kaitasu",
+                                        credentials=AnonymousCredentials())
+    import firebase_admin
+    from firebase_admin import credentials as fb_credentials
+    from firebase_admin import firestore_async
+    if not firebase_admin._apps:
+        if cred_path:
+            cp = os.path.expanduser(cred_path)
+            if not os.path.exists(cp):
+                raise FileNotFoundError(f"Service account JSON not found at: {cp}")
+            firebase_admin.initialize_app(fb_credentials.Certificate(cp),
+                                          {"projectId": project_id} if project_id else None)
+        else:
+            firebase_admin.initialize_app()
+    return firestore_async.client()
+
+
+async def read_cart_async(adb, cart_path: str) -> Dict[str, Any]:
+    """Async twin of read_cart(): projected read, same snapshot shape."""
+    records: List[Tuple[str, Dict[str, Any]]] = []
+    if is_collection_path(cart_path):
+        async for d in adb.collection(cart_path).select(CART_FIELDS).stream():
+            records.append((d.id, d.to_dict() or {}))
+    else:
+        d = await adb.document(cart_path).get(field_paths=CART_FIELDS)
+        if d.exists:
+            records.append((d.id, d.to_dict() or {}))
+    return {"path": cart_path, "reads": len(records), "records": records,
+            "items": items_from_cart_records(records)}
+
+
+async def _read_summary_counts_async(refs: Dict[str, Any], transaction) -> Dict[str, Any]:
+    counts: Dict[str, Any] = {}
+    for ref in refs.values():
+        snap = await ref.get(transaction=transaction)
+        counts.update((snap.to_dict() if snap.exists else None) or {})
+    return counts
+
+
+async def backfill_history_summary_aio(adb, uid: str) -> bool:
+    """Async twin of backfill_history_summary() (same writes via history_backfill_writes)."""
+    from google.cloud import firestore as gc_firestore
+
+    rolling_ref = adb.document(f"users/{uid}/historySummary/rolling")
+    snap = await rolling_ref.get()
+    if snap.exists and (snap.to_dict() or {}).get("backfilled"):
+        return False
+    docs = [(d.id, d.to_dict() or {}) async for d in adb.collection(f"users/{uid}/history").stream()]
+    refs = history_backfill_shard_refs(adb, uid, docs)
+
+    @gc_firestore.async_transactional
+    async def _tx(transaction):
+        rs = await rolling_ref.get(transaction=transaction)
+        rolling = (rs.to_dict() if rs.exists else None) or {}
+        writes = history_backfill_writes(uid, rolling, await _read_summary_counts_async(refs, transaction), docs)
+        if writes is None:
+            return False
+        apply_transaction_writes(adb, transaction, writes)
+        return True
+
+    return await _tx(adb.transaction())
+
+
+async def move_cart_to_history_aio(adb, uid: str, snapshot: Dict[str, Any], history_doc: str = "last-checkout",
+                                   layout: str = "sharded", dry: bool = False) -> Dict[str, Any]:
+    """
+    Async-client twin of move_cart_to_history(): same write plan, and the sharded chunks commit
+    history_shard_chunk_writes() (same chunk tokens and summary docs).
+    """
+    from google.cloud import firestore as gc_firestore
+
+    records = snapshot["records"]
+    cart_col = f"users/{uid}/cart"
+    if not records:
+        return {"appended": 0, "deleted": 0}
+    now = datetime.now(timezone.utc)
+    checkout_id = checkout_id_for(uid, records)
+    sharded = (layout == "sharded")
+    path = (f"users/{uid}/history/{history_shard_id(now, checkout_id)}" if sharded
+            else f"users/{uid}/history/{history_doc}")
+    reserved = HISTORY_WRITE_COST + (SUMMARY_WRITE_COST if sharded else 0)
+    plan = plan_history_move(cart_col, path, records, checkout_id, now.isoformat(), reserved)
+    month = f"{now.astimezone(JST):%Y-%m}"
+    result = {"appended": 0, "deleted": 0, "historyDocPath": path, "checkoutId": checkout_id,
+              "batches": len(plan), "layout": layout}
+    if dry:
+        result["appended"] = len(records)
+        return result
+
+    if sharded:
+        try:
+            if await backfill_history_summary_aio(adb, uid):
+                logger.info("backfilled users/%s/historySummary from existing history", uid)
+        except Exception as e:
+            logger.error("history summary backfill failed: %s", e)
+
+    rolling_ref = adb.document(f"users/{uid}/historySummary/rolling")
+    for n, chunk in enumerate(plan):
+        if not sharded:
+            batch = adb.batch()
+            batch.set(adb.document(path), {"items": gc_firestore.ArrayUnion(chunk["items"]),
+                                           "updatedAt": gc_firestore.SERVER_TIMESTAMP,
+                                           "lastCheckoutId": checkout_id}, merge=True)
+            for p in chunk["deletes"]:
+                batch.delete(adb.document(p))
+            await batch.commit()
+        else:
+            shard_refs = summary_shard_refs(adb, uid, chunk["items"])
+
+            @gc_firestore.async_transactional
+            async def _tx(transaction):
+                rs = await rolling_ref.get(transaction=transaction)
+                rolling = (rs.to_dict() if rs.exists else None) or {}
+                counts = await _read_summary_counts_async(shard_refs, transaction)
+                writes = history_shard_chunk_writes(uid, path, chunk, checkout_id, month, n, rolling, counts)
+                if writes is not None:
+                    apply_transaction_writes(adb, transaction, writes)
+
+            await _tx(adb.transaction())
+        result["appended"] += len(chunk["deletes"])
+        result["deleted"] += len(chunk["deletes"])
+    return result
+
+
+# ====== Orchestrator ======
+async def checkout_user_async(conn: CDPConnection, adb, uid: str, args: argparse.Namespace) -> Dict[str, Any]:
+    started = time.time()
+    snapshot = await read_cart_async(adb, f"users/{uid}/cart")
+    items = dedupe_items(snapshot["items"]) if args.dedupe else snapshot["items"]
+    rec: Dict[str, Any] = {"uid": uid, "items": len(items), "added": 0, "failed": [], "status": "ok"}
+    if not items:
+        rec["status"] = "empty"
+        return rec
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for it in items:
+        queue.put_nowait(it)
+    n_tabs = max(1, min(args.tabs, len(items)))
+
+    async def worker():
+        tab = await conn.new_tab()
+        try:
+            while True:
+                try:
+                    it = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await add_item_async(tab, it, max_retries=args.max_retries_per_item,
+                                         confirm_by_badge=(n_tabs == 1))
+                    rec["added"] += 1
+                    logger.info("[tab %s] added %s x%s", tab.target_id[:6], it.get("name") or it.get("id"),
+                                it.get("quantity"))
+                except Exception as e:
+                    logger.error("Failed to add %s: %s", (it.get("name") or it.get("id") or "N/A"), e)
+                    rec["failed"].append({"id": it.get("id"), "name": it.get("name"), "error": str(e)})
+        finally:
+            await tab.close()
+
+    await asyncio.gather(*(worker() for _ in range(n_tabs)))
+    if rec["failed"]:
+        rec["status"] = "partial" if rec["added"] else "failed"
+    if args.call_postprocess and rec["added"]:
+        rec["postprocess"] = await move_cart_to_history_aio(adb, uid, snapshot, args.postprocess_history_doc,
+                                                            args.history_layout, args.dry)
+    rec["elapsedSec"] = round(time.time() - started, 3)
+    return rec
+
+
+def launch_chrome(args: argparse.Namespace) -> Tuple[subprocess.Popen, str]:
+    binary = args.chrome_binary or shutil.which("google-chrome") or shutil.which("chromium") or "google-chrome"
+    port = args.launch_port
+    user_data = os.path.expanduser(args.user_data_dir or tempfile.mkdtemp(prefix="cdp-profile-"))
+    cmd = [binary, f"--remote-debugging-port={port}", f"--user-data-dir={user_data}",
+           "--no-first-run", "--no-default-browser-check", "--disable-dev-shm-usage", "about:blank"]
+    if args.headless:
+        cmd.insert(1, "--headless=new")
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc, f"127.0.0.1:{port}"
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    proc = None
+    address = args.debugger_address
+    if args.launch:
+        proc, address = launch_chrome(args)
+    conn = None
+    try:
+        for _ in range(50):
+            try:
+                conn = await CDPConnection.connect(address)
+                break
+            except Exception:
+                if proc is None:
+                    raise
+                await asyncio.sleep(0.2)
+        if conn is None:
+            raise RuntimeError(f"DevTools に接続できません: {address}")
+        adb = init_firestore_async(args.fb_cred, args.fb_project or None)
+        uids = [u.strip() for u in (args.uids or args.uid).split(",") if u.strip()]
+        # users one after another (they share the browser's AEON session); items run on parallel tabs
+        results = []
+        for uid in uids:
+            try:
+                rec = await checkout_user_async(conn, adb, uid, args)
+            except Exception as e:
+                # one user's Firestore / browser error must not abort the others
+                logger.error("uid=%s の処理に失敗: %s", uid, e)
+                rec = {"uid": uid, "items": 0, "added": 0, "failed": [], "status": "error", "error": str(e)}
+            logger.info("uid=%s status=%s added=%d failed=%d", uid, rec["status"], rec["added"], len(rec["failed"]))
+            results.append(rec)
+        return results
+    finally:
+        if conn is not None:
+            await conn.close()
+        if proc is not None:
+            proc.terminate()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="AEON cart driver: asyncio + CDP, several tabs per browser")
+    p.add_argument("--uid", default="")
+    p.add_argument("--uids", default="", help="comma separated; processed one after another")
+    p.add_argument("--debugger-address", default="127.0.0.1:9222")
+    p.add_argument("--launch", action="store_true", help="start Chrome with remote debugging instead of attaching")
+    p.add_argument("--launch-port", type=int, default=9222)
+    p.add_argument("--chrome-binary", default="")
+    p.add_argument("--user-data-dir", default=cart.DEFAULT_USER_DATA_DIR)
+    p.add_argument("--headless", action="store_true")
+    p.add_argument("--tabs", type=int, default=4)
+    p.add_argument("--dedupe", action="store_true")
+    p.add_argument("--max-retries-per-item", type=int, default=3)
+    p.add_argument("--fb-cred", default=os.environ.get("GOOGLE_APPLICATION_CREDENTIALS", ""))
+    p.add_argument("--fb-project", default="")
+    p.add_argument("--call-postprocess", action="store_true")
+    p.add_argument("--postprocess-history-doc", default="last-checkout")
+    p.add_argument("--history-layout", default="sharded", choices=HISTORY_LAYOUTS)
+    p.add_argument("--dry", action="store_true")
+    args = p.parse_args()
+    if not (args.uid or args.uids):
+        p.error("--uid or --uids is required")
+    return args
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    if any(r["status"] in ("failed", "error") for r in results):
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# Product id / dedupe key normalization for cart items.
+#
+# Patterns are compiled once and url -> pid lookups are memoized. Items get their
+# canonical key once when they are loaded (with_key); stable_key() then is a dict lookup.
+
+import re
+import time
+from functools import lru_cache
+from typing import Any, Dict
+
+PID_RE = re.compile(r"\d{6,}")
+PID_IN_URL_RE = re.compile(r"/(\d{6,})\.html(?:[?#].*)?$")
+KEY_FIELD = "key"
+
+
+@lru_cache(maxsize=65536)
+def id_from_url(url: str) -> str:
+    if not url:
+        return ""
+    m = PID_IN_URL_RE.search(url)
+    return m.group(1) if m else ""
+
+
+def normalize_id(v: Any, url: str = "") -> str:
+    if url:
+        u = id_from_url(url)
+        if u:
+            return u
+    if isinstance(v, str):
+        s = v.strip()
+        return s if PID_RE.fullmatch(s) else ""
+    if isinstance(v, int) and not isinstance(v, bool):
+        s = str(v)
+        return s if PID_RE.fullmatch(s) else ""
+    return ""
+
+
+def compute_key(item: Dict[str, Any]) -> str:
+    pid = normalize_id(item.get("id"), item.get("url") or "")
+    if pid:
+        return f"id:{pid}"
+    nm = (item.get("name") or "").strip().lower()
+    return f"name:{nm}" if nm else f"row:{time.time_ns()}"
+
+
+def with_key(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Store the canonical key on the item (in place) and return it."""
+    item[KEY_FIELD] = compute_key(item)
+    return item
+
+
+def stable_key(item: Dict[str, Any]) -> str:
+    return item.get(KEY_FIELD) or compute_key(item)
@@ -0,0 +1,115 @@
+# Retry scheduling for the cart driver.
+#
+# One RetryScheduler per checkout run:
+#   - backoff(attempt): exponential with jitter; the base follows the observed page latency (EWMA),
+#     so a slow storefront gets longer pauses and a fast one is not kept waiting
+#   - circuit breaker: after N failed items in a row, pause before the next one (half-open)
+#   - failure budget: once too many items failed, the rest of the run is given up (counted per item,
+#     so one item failing again on every requeue round uses up one unit of budget, not several)
+# Items that failed are requeued to the end of the run by checkout_items() (only their unconfirmed units).
+
+import time
+import random
+import logging
+import argparse
+from typing import Callable, Optional
+
+logger = logging.getLogger("aeon-cart")
+
+
+class PermanentAddError(RuntimeError):
+    """The item cannot be added (e.g. product no longer exists); never requeued."""
+
+
+class UnconfirmedAddError(RuntimeError):
+    """Clicks were fired but only `confirmed` units were seen landing; the rest may or may not be in the cart."""
+
+    def __init__(self, message: str, confirmed: int = 0):
+        super().__init__(message)
+        self.confirmed = confirmed
+
+
+class LatencyEWMA:
+    def __init__(self, alpha: float = 0.3, initial: float = 1.0):
+        self.alpha = alpha
+        self.value = initial
+        self.samples = 0
+
+    def observe(self, seconds: float) -> None:
+        if seconds < 0:
+            return
+        self.value = seconds if self.samples == 0 else (self.alpha * seconds + (1 - self.alpha) * self.value)
+        self.samples += 1
+
+
+class RetryScheduler:
+    def __init__(self, *, base: float = 0.3, cap: float = 20.0, latency_factor: float = 0.5,
+                 breaker_threshold: int = 5, failure_budget: float = 0.3, requeue_rounds: int = 1,
+                 total: int = 0, rng: Optional[random.Random] = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.base = base
+        self.cap = cap
+        self.latency_factor = latency_factor
+        self.breaker_threshold = max(1, breaker_threshold)
+        self.failure_budget = failure_budget
+        self.requeue_rounds = max(0, requeue_rounds)
+        self.total = total
+        self.latency = LatencyEWMA()
+        self.rng = rng or random.Random()
+        self.sleep = sleep
+        self.failures = 0
+        self.consecutive = 0
+        self.trips = 0
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace, total: int) -> "RetryScheduler":
+        return cls(
+            base=getattr(args, "backoff_base", 0.3),
+            cap=getattr(args, "backoff_cap", 20.0),
+            breaker_threshold=getattr(args, "breaker_threshold", 5),
+            failure_budget=getattr(args, "failure_budget", 0.3),
+            requeue_rounds=getattr(args, "requeue_rounds", 1),
+            total=total,
+        )
+
+    # --- latency ---
+    def observe(self, seconds: float) -> None:
+        self.latency.observe(seconds)
+
+    # --- backoff ---
+    def backoff(self, attempt: int) -> float:
+        """Seconds to pause before retry `attempt` (2, 3, ...): equal jitter over base * 2^(n-1)."""
+        base = max(self.base, self.latency.value * self.latency_factor)
+        d = min(self.cap, base * (2 ** max(0, attempt - 2)))
+        return self.rng.uniform(d / 2, d)
+
+    def wait(self, attempt: int) -> None:
+        self.sleep(self.backoff(attempt))
+
+    # --- circuit breaker / budget ---
+    def record_success(self) -> None:
+        self.consecutive = 0
+
+    def record_failure(self, final: bool = True) -> None:
+        """Every failed attempt feeds the breaker; only an item that is given up (final) spends budget."""
+        if final:
+            self.failures += 1
+        self.consecutive += 1
+
+    def before_item(self) -> None:
+        """Half-open pause once the breaker has tripped (grows with every trip)."""
+        if self.consecutive < self.breaker_threshold:
+            return
+        self.trips += 1
+        pause = self.backoff(self.trips + 3)
+        logger.warning("連続失敗 %d 件 → %.1f 秒待ってから再開します（サーキットブレーカー）", self.consecutive, pause)
+        self.sleep(pause)
+        # one more failure re-trips immediately
+        self.consecutive = self.breaker_threshold - 1
+
+    def budget_exhausted(self) -> bool:
+        limit = max(self.breaker_threshold, int(self.failure_budget * self.total))
+        return self.failures > limit
+
+    def should_requeue(self, rounds: int) -> bool:
+        return rounds < self.requeue_rounds
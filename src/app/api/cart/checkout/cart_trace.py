@@ -0,0 +1,160 @@
+# Step-level tracing for aeon_netsuper_cart.py
+#
+# Spans are written as JSON lines shaped like OpenTelemetry span records
+# (traceId / spanId / parentSpanId / name / start+end unix nanos / attributes / status),
+# so the file can be inspected with jq or converted for an OTLP collector.
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import contextlib
+from typing import Any, Dict, List, Optional
+
+
+def _percentile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    i = min(len(sorted_vals) - 1, max(0, int(round(q * (len(sorted_vals) - 1)))))
+    return sorted_vals[i]
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "status")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = dict(attributes)
+        self.status = "OK"
+
+    def set(self, **attrs) -> None:
+        self.attributes.update(attrs)
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "durationMs": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "status": self.status,
+        }
+
+
+class Tracer:
+    """
+    span("step", **attrs) context manager; nesting is tracked per thread so the
+    batch workers each get their own trace tree. enabled=False makes every span a no-op.
+    """
+
+    def __init__(self, path: str = "", enabled: bool = True):
+        self.enabled = enabled
+        self.path = os.path.expanduser(path) if path else ""
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._durations: Dict[str, List[float]] = {}
+        self._errors: Dict[str, int] = {}
+        self._counters: Dict[str, int] = {}
+        self._fh = None
+        if self.enabled and self.path:
+            d = os.path.dirname(self.path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            self._fh = open(self.path, "a", encoding="utf-8")
+
+    def _stack(self) -> List[Span]:
+        st = getattr(self._local, "stack", None)
+        if st is None:
+            st = self._local.stack = []
+        return st
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            yield None
+            return
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        sp = Span(name, parent.trace_id if parent else uuid.uuid4().hex, parent.span_id if parent else None, attrs)
+        stack.append(sp)
+        try:
+            yield sp
+        except BaseException as e:
+            sp.status = "ERROR"
+            sp.attributes.setdefault("error", str(e)[:200])
+            raise
+        finally:
+            sp.end_ns = time.time_ns()
+            stack.pop()
+            self._record(sp)
+
+    def count(self, name: str, n: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def _record(self, sp: Span) -> None:
+        with self._lock:
+            self._durations.setdefault(sp.name, []).append(sp.duration_ms)
+            if sp.status != "OK":
+                self._errors[sp.name] = self._errors.get(sp.name, 0) + 1
+            if self._fh is not None:
+                self._fh.write(json.dumps(sp.to_record(), ensure_ascii=False, default=str) + "\n")
+                self._fh.flush()
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            steps = {}
+            for name, vals in self._durations.items():
+                sv = sorted(vals)
+                steps[name] = {
+                    "count": len(sv),
+                    "errors": self._errors.get(name, 0),
+                    "p50Ms": round(_percentile(sv, 0.50), 1),
+                    "p95Ms": round(_percentile(sv, 0.95), 1),
+                    "totalMs": round(sum(sv), 1),
+                }
+            counters = dict(self._counters)
+        items = steps.get("add_item", {}).get("count", 0)
+        return {
+            "steps": steps,
+            "counters": counters,
+            "retries": counters.get("retry", 0),
+            "fallbackRate": (steps.get("fallback_search", {}).get("count", 0) / items) if items else 0.0,
+        }
+
+    def log_summary(self, log: logging.Logger) -> None:
+        if not self.enabled:
+            return
+        s = self.summary()
+        if not s["steps"]:
+            return
+        log.info("%-18s %6s %6s %9s %9s %10s", "step", "count", "errors", "p50(ms)", "p95(ms)", "total(ms)")
+        for name, st in sorted(s["steps"].items(), key=lambda kv: -kv[1]["totalMs"]):
+            log.info("%-18s %6d %6d %9.1f %9.1f %10.1f", name, st["count"], st["errors"],
+                     st["p50Ms"], st["p95Ms"], st["totalMs"])
+        log.info("retries=%d fallbackRate=%.1f%% counters=%s", s["retries"], s["fallbackRate"] * 100, s["counters"])
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+NOOP_TRACER = Tracer(enabled=False)
@@ -0,0 +1,377 @@
+# Local stand-in for the AEON net super storefront (benchmarks / offline runs of the cart driver).
+#
+# Serves product, 404, search result, login and cart pages with the selectors aeon_netsuper_cart.py
+# targets (button.tocart, input#qty, span.header-cart-count, logout link, success toast, cart rows).
+# Latency and failures are injected per request:
+#
+#   python fake_aeon_server.py --port 8765 --latency-ms 150 --add-fail-rate 0.1 --not-found-rate 0.05
+#   python aeon_netsuper_cart.py --aeon-origin http://127.0.0.1:8765 --uid ... --use-firebase
+
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import html as htmlmod
+import urllib.parse
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+STORE_ID = "01050000036000"
+FOOD_DATA_PATH = Path(__file__).resolve().parents[4] / "data" / "foodData.json"
+SESSION_COOKIE = "fake_aeon_sid"
+
+
+@dataclass
+class FakeSiteConfig:
+    latency_ms: float = 0.0           # added to every response
+    jitter_ms: float = 0.0            # uniform +- jitter
+    add_latency_ms: float = 0.0       # extra delay of the add-to-cart XHR
+    add_fail_rate: float = 0.0        # add XHR answers 500 (no toast, badge unchanged)
+    not_found_rate: float = 0.0       # share of products whose canonical URL is a 404 (search still finds them)
+    qty_field: bool = True            # product pages carry input#qty
+    popup: bool = False               # cookie banner with a 同意 button on every page
+    auto_login: bool = True           # new sessions start logged in
+    seed: int = 0
+
+
+@dataclass
+class Session:
+    logged_in: bool
+    cart: Dict[str, int] = field(default_factory=dict)
+
+
+class FakeAeonSite:
+    """Catalog + sessions + counters; the HTTP handler only renders."""
+
+    def __init__(self, catalog: Dict[str, Dict[str, Any]], config: Optional[FakeSiteConfig] = None):
+        self.catalog = catalog
+        self.config = config or FakeSiteConfig()
+        self.rng = random.Random(self.config.seed)
+        self.sessions: Dict[str, Session] = {}
+        self.counters: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_food_data(cls, path: Path = FOOD_DATA_PATH, config: Optional[FakeSiteConfig] = None) -> "FakeAeonSite":
+        with open(path, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+        catalog = {str(r["id"]): {"name": r.get("name") or "", "price": r.get("priceTax") or 0}
+                   for r in rows if r.get("id")}
+        return cls(catalog, config)
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def session(self, sid: str) -> Session:
+        with self.lock:
+            s = self.sessions.get(sid)
+            if s is None:
+                s = self.sessions[sid] = Session(logged_in=self.config.auto_login)
+            return s
+
+    def is_missing(self, pid: str) -> bool:
+        """Deterministic per pid, so retries and repeated runs see the same 404s."""
+        if self.config.not_found_rate <= 0:
+            return False
+        h = int(hashlib.sha1(f"{self.config.seed}:{pid}".encode()).hexdigest()[:8], 16)
+        return h / 0xFFFFFFFF < self.config.not_found_rate
+
+    def add(self, sid: str, pid: str, qty: int) -> Tuple[bool, int]:
+        s = self.session(sid)
+        with self.lock:
+            fail = self.rng.random() < self.config.add_fail_rate
+            if not fail and pid in self.catalog:
+                s.cart[pid] = s.cart.get(pid, 0) + max(1, qty)
+            total = sum(s.cart.values())
+        self.count("add_failed" if fail else "add_ok")
+        return (not fail and pid in self.catalog), total
+
+    def update_cart(self, sid: str, form: Dict[str, str]) -> None:
+        """cart[{pid}][qty] fields of the cart page form; 0 removes the row."""
+        s = self.session(sid)
+        with self.lock:
+            for k, v in form.items():
+                if not (k.startswith("cart[") and k.endswith("][qty]")):
+                    continue
+                pid = k[len("cart["):-len("][qty]")]
+                try:
+                    q = int(v)
+                except ValueError:
+                    continue
+                if q <= 0:
+                    s.cart.pop(pid, None)
+                elif pid in s.cart:
+                    s.cart[pid] = q
+        self.count("cart_update")
+
+    def search(self, q: str, limit: int = 20) -> List[str]:
+        q = (q or "").strip()
+        if not q:
+            return []
+        if q in self.catalog:
+            return [q]
+        return [pid for pid, p in self.catalog.items() if q in p["name"]][:limit]
+
+    def reset(self) -> None:
+        with self.lock:
+            self.sessions.clear()
+            self.counters.clear()
+
+
+# ====== HTML ======
+_PAGE = """<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8"><title>{title}</title>
+<style>.hidden{{display:none}} .message-success{{padding:8px;background:#e5f6e0}}</style></head>
+<body>
+<header class="page-header">
+  <a href="/netsuper/{store}/">イオンネットスーパー</a>
+  <form action="/netsuper/{store}/catalogsearch/result/" method="get">
+    <input type="search" name="q" placeholder="商品を検索">
+  </form>
+  <a class="header-cart" href="/netsuper/checkout/cart/">カート <span class="header-cart-count">{count}</span></a>
+  {account}
+</header>
+{popup}
+<main>{main}</main>
+</body></html>"""
+
+_POPUP = """<div class="cookie-banner" id="cookie"><p>Cookie を使用します</p>
+<button type="button" onclick="document.getElementById('cookie').remove()">同意する</button></div>"""
+
+_PRODUCT = """<div class="product-info-main">
+<h1 class="page-title">{name}</h1>
+<div class="price">{price}円</div>
+<form id="product_addtocart_form" action="/netsuper/checkout/cart/add/" method="post">
+  <input type="hidden" name="product" value="{pid}">
+  {qty}
+  <button type="submit" class="action tocart primary" id="product-addtocart-button">カゴに入れる</button>
+</form>
+<div id="messages"></div>
+</div>
+<script>
+document.getElementById('product_addtocart_form').addEventListener('submit', function (ev) {{
+  ev.preventDefault();
+  const q = document.getElementById('qty');
+  const btn = document.getElementById('product-addtocart-button');
+  const body = new URLSearchParams({{product: '{pid}', qty: q ? q.value : '1'}});
+  // like the real store: the button is disabled while the add request runs
+  btn.disabled = true;
+  btn.innerText = '追加中...';
+  fetch('/netsuper/checkout/cart/add/', {{method: 'POST', body: body, credentials: 'same-origin'}})
+    .then(r => r.ok ? r.json() : Promise.reject(r.status))
+    .then(d => {{
+      document.querySelector('span.header-cart-count').innerText = String(d.count);
+      document.getElementById('messages').innerHTML =
+        '<div class="message-success">カートに入れました</div>';
+    }})
+    .catch(() => {{}})
+    .finally(() => {{ btn.disabled = false; btn.innerText = 'カゴに入れる'; }});
+}});
+</script>"""
+
+_QTY = '<label for="qty">数量</label><input type="number" name="qty" id="qty" class="qty" value="1" min="1">'
+
+_NOT_FOUND = """<div class="page-not-found"><h1>ページが見つかりません</h1>
+<p>指定のページが見つかりませんでした。</p></div>"""
+
+_LOGIN = """<form action="/netsuper/customer/account/loginPost/" method="post" id="login-form">
+<input type="email" name="login[username]"><input type="password" name="login[password]">
+<button type="submit" class="action login primary">ログイン</button></form>"""
+
+_CART = """<form action="/netsuper/checkout/cart/updatePost/" method="post" id="form-validate">
+<table id="shopping-cart-table">{rows}</table>
+<button type="submit" name="update_cart_action" value="update_qty" class="action update">ショッピングカートを更新</button>
+</form>"""
+
+_CART_ROW = """<tbody class="cart item"><tr>
+<td><a href="/netsuper/{store}/{pid}.html">{name}</a></td>
+<td><input class="input-text qty" name="cart[{pid}][qty]" value="{qty}"></td></tr></tbody>"""
+
+
+class FakeAeonHandler(BaseHTTPRequestHandler):
+    site: FakeAeonSite = None  # set by make_server()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    # --- plumbing ---
+    def _sid(self) -> Tuple[str, bool]:
+        for part in (self.headers.get("Cookie") or "").split(";"):
+            k, _, v = part.strip().partition("=")
+            if k == SESSION_COOKIE and v:
+                return v, False
+        return hashlib.sha1(f"{time.time_ns()}:{id(self)}".encode()).hexdigest()[:16], True
+
+    def _delay(self, extra_ms: float = 0.0) -> None:
+        cfg = self.site.config
+        ms = cfg.latency_ms + extra_ms
+        if cfg.jitter_ms:
+            ms += self.site.rng.uniform(-cfg.jitter_ms, cfg.jitter_ms)
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    def _send(self, status: int, body: str, ctype: str = "text/html; charset=utf-8",
+              headers: Optional[Dict[str, str]] = None) -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        if self._new_sid:
+            self.send_header("Set-Cookie", f"{SESSION_COOKIE}={self._sid_value}; Path=/")
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _redirect(self, location: str) -> None:
+        self._send(302, "", headers={"Location": location})
+
+    def _page(self, status: int, title: str, main: str) -> None:
+        s = self.site.session(self._sid_value)
+        account = ('<a href="/netsuper/customer/account/logout/">ログアウト</a>' if s.logged_in
+                   else '<a href="/netsuper/customer/account/login/">ログイン</a>')
+        self._send(status, _PAGE.format(title=htmlmod.escape(title), store=STORE_ID, count=sum(s.cart.values()),
+                                        account=account, popup=(_POPUP if self.site.config.popup else ""),
+                                        main=main))
+
+    def _form(self) -> Dict[str, str]:
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n).decode("utf-8") if n else ""
+        return {k: v[0] for k, v in urllib.parse.parse_qs(raw).items()}
+
+    # --- routes ---
+    def do_GET(self):
+        self._sid_value, self._new_sid = self._sid()
+        self._delay()
+        u = urllib.parse.urlsplit(self.path)
+        path = u.path
+        site = self.site
+        s = site.session(self._sid_value)
+        store = f"/netsuper/{STORE_ID}"
+
+        if path.startswith("/netsuper/customer/account/login"):
+            site.count("login_page")
+            if s.logged_in:
+                return self._redirect(f"{store}/")
+            return self._page(200, "ログイン", _LOGIN)
+        if path.startswith("/netsuper/customer/account/logout"):
+            s.logged_in = False
+            return self._redirect(f"{store}/")
+        if path.startswith("/netsuper/checkout/cart"):
+            site.count("cart_page")
+            rows = "".join(_CART_ROW.format(store=STORE_ID, pid=pid, qty=q,
+                                            name=htmlmod.escape(site.catalog.get(pid, {}).get("name", pid)))
+                           for pid, q in s.cart.items())
+            return self._page(200, "ショッピングカート", _CART.format(rows=rows))
+        if path.startswith(f"{store}/catalogsearch/result"):
+            site.count("search")
+            q = urllib.parse.parse_qs(u.query).get("q", [""])[0]
+            links = "".join(
+                f'<li class="product-item"><a class="product-item-link" href="{store}/item/{pid}.html">'
+                f'{htmlmod.escape(site.catalog[pid]["name"])}</a></li>'
+                for pid in site.search(q))
+            return self._page(200, "検索結果", f'<ol class="products">{links}</ol>')
+        if path in (store, f"{store}/"):
+            site.count("home")
+            return self._page(200, "イオンネットスーパー", "<h1>トップ</h1>")
+        if path.startswith(f"{store}/") and path.endswith(".html"):
+            tail = path[len(store) + 1:-len(".html")]
+            alt = tail.startswith("item/")
+            pid = tail[len("item/"):] if alt else tail
+            p = site.catalog.get(pid)
+            # canonical URL of a "missing" product 404s; the search result URL still works
+            if p is None or (not alt and site.is_missing(pid)):
+                site.count("not_found")
+                return self._page(404, "404 ページが見つかりません", _NOT_FOUND)
+            site.count("product")
+            main = _PRODUCT.format(pid=pid, name=htmlmod.escape(p["name"]), price=p["price"],
+                                   qty=(_QTY if site.config.qty_field else ""))
+            return self._page(200, p["name"], main)
+        site.count("not_found")
+        return self._page(404, "404 ページが見つかりません", _NOT_FOUND)
+
+    def do_POST(self):
+        self._sid_value, self._new_sid = self._sid()
+        u = urllib.parse.urlsplit(self.path)
+        form = self._form()
+        s = self.site.session(self._sid_value)
+        if u.path.startswith("/netsuper/customer/account/loginPost"):
+            self._delay()
+            s.logged_in = True
+            return self._redirect(f"/netsuper/{STORE_ID}/")
+        if u.path.startswith("/netsuper/checkout/cart/updatePost"):
+            self._delay(self.site.config.add_latency_ms)
+            self.site.update_cart(self._sid_value, form)
+            return self._redirect("/netsuper/checkout/cart/")
+        if u.path.startswith("/netsuper/checkout/cart/add"):
+            self._delay(self.site.config.add_latency_ms)
+            if not s.logged_in:
+                return self._send(401, json.dumps({"error": "login"}), "application/json")
+            try:
+                qty = int(form.get("qty") or 1)
+            except ValueError:
+                qty = 1
+            ok, total = self.site.add(self._sid_value, form.get("product", ""), qty)
+            if not ok:
+                return self._send(500, json.dumps({"error": "add failed"}), "application/json")
+            return self._send(200, json.dumps({"count": total}), "application/json")
+        self._send(404, "", "text/plain")
+
+
+def make_server(site: FakeAeonSite, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    handler = type("BoundFakeAeonHandler", (FakeAeonHandler,), {"site": site})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve_in_thread(site: FakeAeonSite, host: str = "127.0.0.1", port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """Start the server on a daemon thread; returns (server, origin)."""
+    server = make_server(site, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_config_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--latency-ms", type=float, default=0.0)
+    p.add_argument("--jitter-ms", type=float, default=0.0)
+    p.add_argument("--add-latency-ms", type=float, default=0.0)
+    p.add_argument("--add-fail-rate", type=float, default=0.0)
+    p.add_argument("--not-found-rate", type=float, default=0.0)
+    p.add_argument("--no-qty-field", action="store_true")
+    p.add_argument("--popup", action="store_true")
+    p.add_argument("--require-login", action="store_true", help="new sessions start logged out")
+    p.add_argument("--seed", type=int, default=0)
+
+
+def config_from_args(args: argparse.Namespace) -> FakeSiteConfig:
+    return FakeSiteConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, add_latency_ms=args.add_latency_ms,
+        add_fail_rate=args.add_fail_rate, not_found_rate=args.not_found_rate,
+        qty_field=not args.no_qty_field, popup=args.popup, auto_login=not args.require_login, seed=args.seed,
+    )
+
+
+def main():
+    p = argparse.ArgumentParser(description="fake AEON net super storefront")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    add_config_args(p)
+    args = p.parse_args()
+    site = FakeAeonSite.from_food_data(config=config_from_args(args))
+    server = make_server(site, args.host, args.port)
+    print(f"fake AEON: http://{args.host}:{args.port}/netsuper/{STORE_ID}/ ({len(site.catalog)} products)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+# In-memory stand-in for the Firestore client, covering what the cart driver uses:
+# collection / document / collection_group, select / order_by / limit / start_after / stream,
+# get(field_paths=..., transaction=...), set(merge=...), delete, batch() and transaction()
+# (driven by the real firebase_admin.firestore.transactional, like the production client).
+# ArrayUnion / SERVER_TIMESTAMP transforms are applied; every RPC can be delayed (latency_ms)
+# and reads / writes / commits are counted for the benchmark report.
+
+import copy
+import time
+import itertools
+import threading
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+def _segments(path: str) -> List[str]:
+    return [s for s in path.split("/") if s]
+
+
+def _is_array_union(v: Any) -> bool:
+    return type(v).__name__ == "ArrayUnion" and hasattr(v, "values")
+
+
+def _is_server_timestamp(v: Any) -> bool:
+    return type(v).__name__ == "Sentinel" and "server timestamp" in repr(v).lower()
+
+
+def _apply(old: Any, new: Any) -> Any:
+    if _is_array_union(new):
+        cur = list(old) if isinstance(old, list) else []
+        for x in new.values:
+            if x not in cur:
+                cur.append(copy.deepcopy(x))
+        return cur
+    if _is_server_timestamp(new):
+        return datetime.now(timezone.utc)
+    if isinstance(new, dict):
+        return {k: _apply(None, v) for k, v in new.items()}
+    return copy.deepcopy(new)
+
+
+def _merge(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(old)
+    for k, v in new.items():
+        if isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k] = _merge(out[k], v)
+        else:
+            out[k] = _apply(out.get(k), v)
+    return out
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, ref: "FakeDocumentReference", data: Optional[Dict[str, Any]]):
+        self.reference = ref
+        self.id = ref.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field: str) -> Any:
+        return (self._data or {}).get(field)
+
+
+class FakeDocumentReference:
+    def __init__(self, client: "FakeFirestore", path: str):
+        self._client = client
+        self.path = "/".join(_segments(path))
+        self.id = _segments(path)[-1]
+
+    @property
+    def parent(self) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, "/".join(_segments(self.path)[:-1]))
+
+    def collection(self, name: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths: Optional[List[str]] = None, transaction=None) -> FakeDocumentSnapshot:
+        c = self._client
+        c._rpc()
+        with c._lock:
+            data = c._docs.get(self.path)
+            c.stats["reads"] += 1
+            if data is not None and field_paths is not None:
+                data = {k: v for k, v in data.items() if k in field_paths}
+            return FakeDocumentSnapshot(self, copy.deepcopy(data))
+
+    def set(self, data: Dict[str, Any], merge: bool = False) -> None:
+        b = self._client.batch()
+        b.set(self, data, merge=merge)
+        b.commit()
+
+    def delete(self) -> None:
+        b = self._client.batch()
+        b.delete(self)
+        b.commit()
+
+
+class FakeQuery:
+    def __init__(self, client: "FakeFirestore", match: Callable[[List[str]], bool],
+                 fields: Optional[List[str]] = None, orders: Optional[List[Tuple[str, str]]] = None,
+                 limit: Optional[int] = None, after: Optional[FakeDocumentSnapshot] = None):
+        self._client = client
+        self._match = match
+        self._fields = fields
+        self._orders = orders or []
+        self._limit = limit
+        self._after = after
+
+    def _copy(self, **kw) -> "FakeQuery":
+        args = dict(match=self._match, fields=self._fields, orders=self._orders, limit=self._limit, after=self._after)
+        args.update(kw)
+        return FakeQuery(self._client, **args)
+
+    def select(self, fields: List[str]) -> "FakeQuery":
+        return self._copy(fields=list(fields))
+
+    def order_by(self, field: str, direction: str = "ASCENDING") -> "FakeQuery":
+        return self._copy(orders=self._orders + [(field, direction)])
+
+    def limit(self, n: int) -> "FakeQuery":
+        return self._copy(limit=n)
+
+    def start_after(self, snapshot: FakeDocumentSnapshot) -> "FakeQuery":
+        return self._copy(after=snapshot)
+
+    def _sort_key(self, path: str, data: Dict[str, Any]) -> Tuple:
+        return tuple((path if f == "__name__" else data.get(f)) for f, _ in self._orders)
+
+    def stream(self):
+        c = self._client
+        c._rpc()
+        with c._lock:
+            rows = [(p, d) for p, d in c._docs.items() if self._match(_segments(p))]
+            # like Firestore: ordering by a field drops documents without it
+            for f, _ in self._orders:
+                if f != "__name__":
+                    rows = [(p, d) for p, d in rows if d.get(f) is not None]
+            rows.sort(key=lambda r: r[0])
+            for f, direction in reversed(self._orders):
+                rows.sort(key=lambda r: (r[0] if f == "__name__" else r[1].get(f)),
+                          reverse=(str(direction).upper() == "DESCENDING"))
+            if self._after is not None:
+                ap = self._after.reference.path
+                idx = next((i for i, (p, _) in enumerate(rows) if p == ap), None)
+                rows = rows[idx + 1:] if idx is not None else rows
+            if self._limit is not None:
+                rows = rows[:self._limit]
+            out = []
+            for p, d in rows:
+                data = {k: v for k, v in d.items() if k in self._fields} if self._fields is not None else d
+                out.append(FakeDocumentSnapshot(FakeDocumentReference(c, p), copy.deepcopy(data)))
+            c.stats["reads"] += max(1, len(out))
+        return iter(out)
+
+    def get(self) -> List[FakeDocumentSnapshot]:
+        return list(self.stream())
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client: "FakeFirestore", path: str):
+        self.path = "/".join(_segments(path))
+        segs = _segments(path)
+        self.id = segs[-1] if segs else ""
+        n = len(segs)
+        super().__init__(client, lambda s: len(s) == n + 1 and s[:n] == segs)
+
+    @property
+    def parent(self) -> Optional[FakeDocumentReference]:
+        segs = _segments(self.path)
+        return FakeDocumentReference(self._client, "/".join(segs[:-1])) if len(segs) > 1 else None
+
+    def document(self, doc_id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, f"{self.path}/{doc_id}")
+
+
+class FakeWriteBatch:
+    def __init__(self, client: "FakeFirestore"):
+        self._client = client
+        self._ops: List[Tuple[str, str, Any, bool]] = []
+
+    def set(self, ref: FakeDocumentReference, data: Dict[str, Any], merge: bool = False) -> None:
+        self._ops.append(("set", ref.path, data, merge))
+
+    def delete(self, ref: FakeDocumentReference) -> None:
+        self._ops.append(("delete", ref.path, None, False))
+
+    def commit(self) -> None:
+        c = self._client
+        if len(self._ops) > c.MAX_WRITES:
+            raise ValueError(f"maximum {c.MAX_WRITES} writes allowed per request")
+        c._rpc()
+        c._maybe_fail()
+        with c._lock:
+            for op, path, data, merge in self._ops:
+                if op == "delete":
+                    c._docs.pop(path, None)
+                elif merge:
+                    c._docs[path] = _merge(c._docs.get(path) or {}, data)
+                else:
+                    c._docs[path] = _merge({}, data)
+            c.stats["writes"] += len(self._ops)
+            c.stats["commits"] += 1
+        self._ops = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    The private hooks fb_firestore.transactional() calls on a Transaction:
+    _begin takes the client's transaction lock, _commit / _rollback release it.
+    """
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, client: "FakeFirestore"):
+        super().__init__(client)
+        self._id: Optional[bytes] = None
+
+    def _begin(self, retry_id: Optional[bytes] = None) -> None:
+        self._client._tx_lock.acquire()
+        self._id = f"tx-{next(self._client._tx_ids)}".encode()
+
+    def _end(self) -> None:
+        self._ops = []
+        if self._id is not None:
+            self._id = None
+            self._client._tx_lock.release()
+
+    def _clean_up(self) -> None:
+        self._end()
+
+    def _commit(self) -> list:
+        self.commit()
+        self._end()
+        return []
+
+    def _rollback(self) -> None:
+        self._end()
+
+
+class FakeFirestore:
+    """
+    Thread-safe in-memory Firestore. Transactions run under one lock (serializable by construction).
+    fail_commits=N makes the next N commits raise, to exercise the retry paths.
+    """
+    MAX_WRITES = 500
+
+    def __init__(self, latency_ms: float = 0.0, fail_commits: int = 0):
+        self.latency_ms = latency_ms
+        self.fail_commits = fail_commits
+        self._docs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+        self._tx_lock = threading.Lock()
+        self._tx_ids = itertools.count(1)
+        self.stats = {"reads": 0, "writes": 0, "commits": 0, "rpcs": 0}
+
+    def _rpc(self) -> None:
+        self.stats["rpcs"] += 1
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000.0)
+
+    def _maybe_fail(self) -> None:
+        with self._lock:
+            if self.fail_commits > 0:
+                self.fail_commits -= 1
+                raise RuntimeError("injected commit failure")
+
+    def collection(self, path: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, path)
+
+    def document(self, path: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, path)
+
+    def collection_group(self, name: str) -> FakeQuery:
+        return FakeQuery(self, lambda s: len(s) >= 2 and len(s) % 2 == 0 and s[-2] == name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self) -> FakeTransaction:
+        """Reads go straight to the store, writes are buffered and committed together on _commit."""
+        return FakeTransaction(self)
+
+    # --- test helpers ---
+    def seed(self, docs: Dict[str, Dict[str, Any]]) -> None:
+        with self._lock:
+            for path, data in docs.items():
+                self._docs["/".join(_segments(path))] = copy.deepcopy(data)
+
+    def dump(self, prefix: str = "") -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {p: copy.deepcopy(d) for p, d in self._docs.items() if p.startswith(prefix)}
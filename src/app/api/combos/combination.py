@@ -87,7 +87,21 @@ def normalize_health(data, prefs: dict):
 from math import ceil
 from pulp import LpProblem, LpVariable, LpMaximize, lpSum, LpBinary, PULP_CBC_CMD
 
-def solve_one(Items, budget_yen, selected_categories=None, H_floor_ratio=None, forbid_overlap_with=None):
+def _fix_and_warm(m, x, Items, fixed_ids, warm_ids):
+    """fixed_ids の変数を 1 に固定し、warm_ids を初期解にする。ウォームスタートするなら True"""
+    fixed_ids = set(fixed_ids or ())
+    for i, it in enumerate(Items):
+        if it["id"] in fixed_ids:
+            m += x[i] == 1, f"pin_{i}"
+    if warm_ids is None:
+        return False
+    warm_ids = set(warm_ids)
+    for i, it in enumerate(Items):
+        x[i].setInitialValue(1 if it["id"] in warm_ids else 0)
+    return True
+
+def solve_one(Items, budget_yen, selected_categories=None, H_floor_ratio=None, forbid_overlap_with=None,
+              fixed_ids=None, warm_ids=None):
     """
     1回の最適化を解く。
     - Items: dictのリスト（id, price_yen, category, health_score を含む）
@@ -95,6 +109,8 @@ def solve_one(Items, budget_yen, selected_categories=None, H_floor_ratio=None, f
     - selected_categories: None ならカテゴリ制約なし / listなら各カテゴリ>=1
     - H_floor_ratio: NoneならH最大化、値があれば H >= その値 を下限にして price 最大化
     - forbid_overlap_with: idのset（今回 None 固定で未使用でもOK）
+    - fixed_ids: 必ず入れる id（ピン留め）
+    - warm_ids: CBC の初期解にする id（前回の解など）
     """
     n = len(Items)
     id2idx = {it["id"]: i for i, it in enumerate(Items)}
@@ -131,7 +147,8 @@ def solve_one(Items, budget_yen, selected_categories=None, H_floor_ratio=None, f
         m += lpSum(price[i] * x[i] for i in range(n))
 
     # 解く
-    status = m.solve(PULP_CBC_CMD(msg=False))
+    warm = _fix_and_warm(m, x, Items, fixed_ids, warm_ids)
+    status = m.solve(PULP_CBC_CMD(msg=False, warmStart=warm))
     if status != 1:  # LpStatusOptimal == 1
         return None
 
@@ -145,7 +162,7 @@ def solve_one(Items, budget_yen, selected_categories=None, H_floor_ratio=None, f
         "price_sum": price_sum,
     }
 
-def _solve_price_only(Items, budget_yen, selected_categories=None):
+def _solve_price_only(Items, budget_yen, selected_categories=None, fixed_ids=None, warm_ids=None):
     n = len(Items)
     x = [LpVariable(f"x_{i}", 0, 1, LpBinary) for i in range(n)]
     m = LpProblem("kaitasu_price", LpMaximize)
@@ -158,7 +175,8 @@ def _solve_price_only(Items, budget_yen, selected_categories=None):
             m += lpSum(x[i] for i in range(n) if Items[i].get("category") == cat) >= 1, f"cat_{cat}_ge1"
     
     m += lpSum(price[i] * x[i] for i in range(n))
-    status = m.solve(PULP_CBC_CMD(msg=False))
+    warm = _fix_and_warm(m, x, Items, fixed_ids, warm_ids)
+    status = m.solve(PULP_CBC_CMD(msg=False, warmStart=warm))
     if status != 1:
         return None
     pick_ids = [Items[i]["id"] for i in range(n) if x[i].value() == 1]
@@ -204,49 +222,614 @@ def to_api_shape(products, ids):
 
 def get_genre_value(p): return p.get("genre") or (p.get("genres") or [None])[0]
 
+# ===== 予算カーブ（全予算の最適解を1回のDPで） =====
+# dp[m][c] = 重み（価格 / granularity, 切り上げ）ちょうど c・カバー済みジャンル集合 m で取れる最大 H。
+# 予算 B の解は c <= B のうち H 最大、同点（1e-9 以内）なら c 最大 = solve_one の2段階と同じ基準。
+# 各商品の「取った/取らない」をビット表で持つので、任意の予算のかごを O(商品数) で復元できる。
+import math
+import threading
+from collections import OrderedDict
+
+H_TOLERANCE = 1e-9
+DP_MAX_STATES = 1 << 24  # ジャンル集合数 × 予算刻み数 の上限（超えたら CBC を使う）
+# 復元用ビット表は1商品あたり ジャンル集合数 × (予算刻み数+1)/8 バイト（ジャンル商品は遷移元の表も）。
+# 商品数を掛けると 8 ジャンル・予算 50000 円で 4GB を超えるので、表の合計で上限を切る（超えたら CBC）
+DP_MAX_TABLE_BYTES = 256 << 20
+
+
+class BudgetCurve:
+    """solve_budget_curve() の結果。lookup(budget) で任意予算のかごを復元する。"""
+
+    def __init__(self, Items, weights, bits, granularity, max_budget, full_mask, best_c, best_H, takes, froms):
+        self.Items = Items
+        self.weights = weights
+        self.bits = bits
+        self.granularity = granularity
+        self.max_budget = max_budget
+        self.full_mask = full_mask
+        self.best_c = best_c
+        self.best_H = best_H
+        self.takes = takes
+        self.froms = froms
+
+    @property
+    def nbytes(self):
+        return sum(t.nbytes for t in self.takes if t is not None) + \
+            sum(f.nbytes for f in self.froms if f is not None)
+
+    def _basket(self, c):
+        m = self.full_mask
+        picked = []
+        for i in range(len(self.Items) - 1, -1, -1):
+            tk = self.takes[i]
+            if tk is None:
+                continue
+            byte, shift = c >> 3, 7 - (c & 7)
+            if (tk[m, byte] >> shift) & 1:
+                picked.append(i)
+                fr = self.froms[i]
+                if fr is not None and (fr[m, byte] >> shift) & 1:
+                    m ^= self.bits[i]
+                c -= self.weights[i]
+        return picked[::-1]
+
+    def lookup(self, budget):
+        """予算 budget（円, <= max_budget）の最適かご {"ids", "H", "price_sum"}。解なしは None"""
+        if budget > self.max_budget:
+            raise ValueError(f"budget {budget} exceeds curve max {self.max_budget}")
+        B = int(budget) // self.granularity
+        c = int(self.best_c[B])
+        if c < 0:
+            return None
+        picked = self._basket(c)
+        return {
+            "ids": [self.Items[i]["id"] for i in picked],
+            "H": float(self.best_H[B]),
+            "price_sum": sum(self.Items[i]["price_yen"] for i in picked),
+        }
+
+    def frontier(self):
+        """最適解が変わる予算だけの表 [{"budget", "H", "weight"}]（weight = 価格 / granularity）"""
+        out = []
+        prev = None
+        for B in np.flatnonzero(np.diff(self.best_c, prepend=-2) != 0):
+            c = int(self.best_c[B])
+            if c == prev:
+                continue
+            prev = c
+            out.append({"budget": int(B) * self.granularity,
+                        "H": (float(self.best_H[B]) if c >= 0 else None),
+                        "weight": c})
+        return out
+
+
+def solve_budget_curve(Items, max_budget, selected_categories=None, granularity=1, use_health=True):
+    """
+    0〜max_budget 円の全予算について最適解を1回のDPで求める。
+    - granularity: 予算の刻み（円）。価格は刻みに切り上げるので予算超過はしない（1 なら厳密解）
+    - use_health: False なら価格モード（予算内で合計金額最大化）
+    """
+    g = max(1, int(granularity))
+    C = int(max_budget) // g
+    cats = sorted(selected_categories or [])
+    bit_of = {cat: 1 << j for j, cat in enumerate(cats)}
+    M = 1 << len(cats)
+    if M * (C + 1) > DP_MAX_STATES:
+        raise ValueError(f"budget curve too large: {M} genre sets x {C + 1} buckets")
+
+    weights = [math.ceil(max(0, it["price_yen"]) / g) for it in Items]
+    health = [float(it["health_score"]) if use_health else 0.0 for it in Items]
+    bits = [bit_of.get(it.get("category"), 0) for it in Items]
+    row_bytes = M * ((C + 1 + 7) // 8)
+    table_bytes = sum(row_bytes * (2 if b else 1) for w, b in zip(weights, bits) if w <= C)
+    if table_bytes > DP_MAX_TABLE_BYTES:
+        raise ValueError(f"budget curve too large: {table_bytes >> 20} MiB of tables "
+                         f"({len(Items)} items x {M} genre sets x {C + 1} buckets)")
+
+    dp = np.full((M, C + 1), -np.inf)
+    dp[0, 0] = 0.0
+    takes, froms = [], []
+    for w, h, b in zip(weights, health, bits):
+        if w > C:
+            takes.append(None)
+            froms.append(None)
+            continue
+        take = np.zeros((M, C + 1), dtype=bool)
+        if b == 0:
+            cand = dp[:, :C + 1 - w] + h
+            cur = dp[:, w:]
+            t = cand > cur
+            take[:, w:] = t
+            dp[:, w:] = np.where(t, cand, cur)
+            froms.append(None)
+        else:
+            # 取るとジャンル b がカバーされる: 遷移元は t（既にカバー済み）か t^b（未カバー）
+            T = np.array([m for m in range(M) if m & b])
+            same, other = dp[T], dp[T ^ b]
+            src = np.maximum(same, other)
+            cand = src[:, :C + 1 - w] + h
+            cur = same[:, w:]
+            t = cand > cur
+            tk = np.zeros((len(T), C + 1), dtype=bool)
+            tk[:, w:] = t
+            fr = np.zeros((len(T), C + 1), dtype=bool)
+            fr[:, w:] = t & (other > same)[:, :C + 1 - w]
+            take[T] = tk
+            frm = np.zeros((M, C + 1), dtype=bool)
+            frm[T] = fr
+            new = same.copy()
+            new[:, w:] = np.where(t, cand, cur)
+            dp[T] = new
+            froms.append(np.packbits(frm, axis=1))
+        takes.append(np.packbits(take, axis=1))
+
+    # 予算 B ごと: H 最大（許容 1e-9）の中で重み最大の c
+    full = dp[M - 1]
+    best_so_far = np.maximum.accumulate(full)
+    ok = np.isfinite(full) & (full >= best_so_far - H_TOLERANCE)
+    best_c = np.maximum.accumulate(np.where(ok, np.arange(C + 1), -1))
+    best_H = np.where(best_c >= 0, full[np.maximum(best_c, 0)], np.nan)
+    return BudgetCurve(Items, weights, bits, g, int(max_budget), M - 1, best_c, best_H, takes, froms)
+
+
+# ====== ライブラリAPI ======
+import sys
+import time
+import importlib.util
+
+DEFAULT_DATA = Path(__file__).resolve().parents[3] / "data" / "foodData.json"
+# 代替品インデックス。DEFAULT_DATA と同じく __file__ 基準で読む（sys.path・カレントディレクトリに依存しない）
+FOOD_INDEX_PATH = Path(__file__).resolve().parent / "food_index.py"
+
+
+def load_food_index_module():
+    """combos/food_index.py のモジュール。同じファイルが import 済みならそれを使う"""
+    mod = sys.modules.get("food_index")
+    if mod is not None and Path(getattr(mod, "__file__", "") or "").resolve() == FOOD_INDEX_PATH:
+        return mod
+    spec = importlib.util.spec_from_file_location("kaitasu_food_index", FOOD_INDEX_PATH)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+MODES = ("health", "price")
+
+
+class Catalog:
+    """
+    商品カタログ（foodData.json）を一度だけ読み込んで保持する。
+    サーバ・バッチ・ベンチマークから optimize() に渡して使い回す。
+    """
+
+    def __init__(self, products):
+        self.products = list(products)
+        self.by_id = {p["id"]: p for p in self.products}
+        # 価格・カテゴリは prefs に依存しないので1回だけ作る
+        self.base_items = build_items_for_solver(self.products, require_health=False)
+        self._build_score_columns()
+        # combo_server のワーカーが共有するので、キャッシュと遅延初期化はロックの下で
+        self._lock = threading.Lock()
+        self._curves = OrderedDict()
+        self._building = {}  # key → threading.Event（作成中のカーブ。同じキーの要求は完成を待つ）
+        self._similarity = None
+        self._similarity_lock = threading.Lock()
+
+    def _build_score_columns(self):
+        """
+        normalize_health のスコアは「栄養素・向き・カタログ」だけで決まるので、
+        栄養素ごとの up / down スコア列を先に作っておく（P10/P90 クリップ済み）。
+          up[i, k], down[i, k]: 商品 i の栄養素 k のスコア（使えない値は 0）
+          valid[i, k]         : スコアが有効なら 1（値なし・P10==P90 は 0）
+        """
+        self.keys = sorted({k for p in self.products for k in p})
+        self.key_index = {k: j for j, k in enumerate(self.keys)}
+        n, K = len(self.products), len(self.keys)
+        vals = np.full((n, K), np.nan)
+        for i, p in enumerate(self.products):
+            for k, v in p.items():
+                f = as_float(v)
+                if f is not None:
+                    vals[i, self.key_index[k]] = f
+        p10 = np.full(K, np.nan)
+        p90 = np.full(K, np.nan)
+        for j in range(K):
+            col = vals[:, j][~np.isnan(vals[:, j])]
+            if col.size:
+                p10[j] = float(np.percentile(col, 10))
+                p90[j] = float(np.percentile(col, 90))
+        usable = ~np.isnan(p10) & ~np.isnan(p90) & (p10 != p90)
+        span = np.where(usable, p90 - p10, 1.0)
+        valid = ~np.isnan(vals) & usable
+        with np.errstate(invalid="ignore"):
+            up = np.clip((vals - p10) / span, 0.0, 1.0)
+            down = np.clip((p90 - vals) / span, 0.0, 1.0)
+        self.p10, self.p90 = p10, p90
+        self.up = np.where(valid, up, 0.0)
+        self.down = np.where(valid, down, 0.0)
+        self.valid = valid.astype(np.float64)
+
+    def health_scores(self, prefs):
+        """
+        normalize_health と同じ health_score を配列で返す（None は NaN）。
+        prefs の up/down マスクとの行列ベクトル積だけで計算する。有効キーが無ければ None。
+        """
+        w_up = np.zeros(len(self.keys))
+        w_down = np.zeros(len(self.keys))
+        for k, v in (prefs or {}).items():
+            j = self.key_index.get(k)
+            if j is None:
+                continue
+            if v == "up":
+                w_up[j] = 1.0
+            elif v == "down":
+                w_down[j] = 1.0
+        if not (w_up.any() or w_down.any()):
+            return None
+        total = self.up @ w_up + self.down @ w_down
+        count = self.valid @ (w_up + w_down)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count > 0, total / count, np.nan)
+
+    def health_items(self, prefs):
+        """build_items_for_solver(normalize_health(...), require_health=True) と同じ Items"""
+        scores = self.health_scores(prefs)
+        if scores is None:
+            return []
+        return [{**self.base_items[i], "health_score": float(scores[i])}
+                for i in np.flatnonzero(~np.isnan(scores))]
+
+    @classmethod
+    def load(cls, path=DEFAULT_DATA):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def __len__(self):
+        return len(self.products)
+
+    @property
+    def similarity(self):
+        """代替品さがし用の FoodIndex（初回だけ作る）"""
+        if self._similarity is None:
+            with self._similarity_lock:
+                if self._similarity is None:
+                    self._similarity = load_food_index_module().FoodIndex(self.products)
+        return self._similarity
+
+    CURVE_CACHE_SIZE = 16
+    CURVE_CACHE_BYTES = 1 << 30  # キャッシュ中の BudgetCurve の表の合計
+
+    def budget_curve(self, prefs, genres, mode="health", max_budget=10000, granularity=1):
+        """
+        (prefs, genres, mode, granularity) ごとに BudgetCurve をキャッシュして返す。
+        戻り値: (curve, cached)。キャッシュ済みより大きい max_budget なら作り直す。
+        スレッドセーフ: DP はロックの外で解き、同じキーを作成中なら完成を待つ（同じカーブを2回作らない）。
+        """
+        selected = tuple(sorted(parse_genres(genres)))
+        pref_key = tuple(sorted((k, v) for k, v in (prefs or {}).items() if v in ("up", "down")))
+        key = (mode, pref_key if mode == "health" else (), selected, int(granularity))
+        while True:
+            with self._lock:
+                curve = self._curves.get(key)
+                if curve is not None and curve.max_budget >= max_budget:
+                    self._curves.move_to_end(key)
+                    return curve, True
+                pending = self._building.get(key)
+                if pending is None:
+                    self._building[key] = threading.Event()
+                    break
+            # 作成中 → 完成（か失敗）を待ってからキャッシュを見直す
+            pending.wait()
+        try:
+            Items = self.health_items(prefs) if mode == "health" else self.base_items
+            curve = solve_budget_curve(Items, max_budget, selected or None, granularity,
+                                       use_health=(mode == "health"))
+            with self._lock:
+                self._curves[key] = curve
+                self._curves.move_to_end(key)
+                total = sum(c.nbytes for c in self._curves.values())
+                while len(self._curves) > 1 and (len(self._curves) > self.CURVE_CACHE_SIZE or
+                                                 total > self.CURVE_CACHE_BYTES):
+                    total -= self._curves.popitem(last=False)[1].nbytes
+            return curve, False
+        finally:
+            with self._lock:
+                self._building.pop(key).set()
+
+
+def parse_genres(genres):
+    """[11, "13"] / "11,13" / None → {11, 13}（数値にできないものは捨てる）"""
+    if genres is None:
+        return set()
+    if isinstance(genres, str):
+        genres = [g for g in genres.split(",") if g.strip()]
+    out = set()
+    for g in genres:
+        try:
+            out.add(int(g))
+        except (TypeError, ValueError):
+            continue
+    return out
+
+
+SOLVERS = ("cbc", "dp")
+
+
+def optimize(catalog, prefs=None, budget=2500, genres=None, mode="health",
+             solver="cbc", max_budget=None, granularity=1):
+    """
+    組み合わせ最適化を1回実行して結果を dict で返す（プロセス起動・JSON往復なし）。
+    - catalog: Catalog
+    - prefs: { nutrient_key: "up"|"down" }
+    - budget: 予算（円）
+    - genres: 選択ジャンル（各ジャンル >= 1 品）
+    - mode: "health"（H最大化 → 残額最小化） / "price"（予算内で合計金額最大化）
+    - solver: "cbc"（PuLP） / "dp"（予算カーブを max_budget まで作ってキャッシュし、引くだけ）
+    戻り値: {"mode", "status", "ids", "items", "H", "price_sum", "stats"}
+      status: "ok" / "empty"（候補なし・解なし）
+    """
+    if mode not in MODES:
+        raise ValueError(f"unknown mode: {mode}")
+    if solver not in SOLVERS:
+        raise ValueError(f"unknown solver: {solver}")
+    t0 = time.perf_counter()
+    selected = parse_genres(genres) or None
+    prefs = prefs or {}
+    products = catalog.products
+
+    result = {"mode": mode, "status": "empty", "ids": [], "items": [], "H": None, "price_sum": 0}
+    stats = {"catalog": len(products), "budget": int(budget), "genres": sorted(selected or []),
+             "solver": solver, "solves": 0, "solveMs": 0.0}
+
+    if solver == "dp":
+        try:
+            t = time.perf_counter()
+            curve, cached = catalog.budget_curve(prefs, selected, mode, max(int(budget), int(max_budget or 0)),
+                                                 granularity)
+            best = curve.lookup(budget)
+            stats.update(curveCached=cached, curveMs=round((time.perf_counter() - t) * 1000, 2),
+                         candidates=len(curve.Items))
+            if best is not None and best["ids"]:
+                result.update(status="ok", ids=best["ids"], items=to_api_shape(products, best["ids"]),
+                              H=(best["H"] if mode == "health" else None), price_sum=best["price_sum"])
+            stats["totalMs"] = round((time.perf_counter() - t0) * 1000, 2)
+            result["stats"] = stats
+            return result
+        except ValueError as e:
+            # ジャンル数・予算が大きすぎる → CBC で解く
+            stats["solver"] = "cbc"
+            stats["dpSkipped"] = str(e)
+
+    if mode == "health":
+        Items = catalog.health_items(prefs)
+    else:
+        Items = catalog.base_items
+    stats["candidates"] = len(Items)
+
+    def timed(fn, *a, **kw):
+        t = time.perf_counter()
+        r = fn(*a, **kw)
+        stats["solves"] += 1
+        stats["solveMs"] += (time.perf_counter() - t) * 1000
+        return r
+
+    best = None
+    if Items:
+        if mode == "health":
+            # 第1段：H最大化
+            sol_opt = timed(solve_one, Items, budget, selected_categories=selected)
+            if sol_opt is not None and sol_opt["ids"]:
+                # 第2段：残額最小化（同H）
+                sol_opt2 = timed(solve_one, Items, budget, selected_categories=selected,
+                                 H_floor_ratio=sol_opt["H"] - 1e-9, forbid_overlap_with=None)
+                best = sol_opt2 or sol_opt
+        else:
+            sol_price = timed(_solve_price_only, Items, budget, selected_categories=selected)
+            if sol_price is not None and sol_price["ids"]:
+                best = sol_price
+
+    if best is not None:
+        result.update(status="ok", ids=best["ids"], items=to_api_shape(products, best["ids"]),
+                      H=best.get("H"), price_sum=best["price_sum"])
+    stats["solveMs"] = round(stats["solveMs"], 2)
+    stats["totalMs"] = round((time.perf_counter() - t0) * 1000, 2)
+    result["stats"] = stats
+    return result
+
+
+def greedy_basket(catalog, prefs=None, budget=2500, genres=None, mode="health"):
+    """
+    ソルバーを使わない近似解（混雑時の縮退用, 数ms）。optimize() と同じ形で返す。
+    各選択ジャンルから1品ずつ入れてから、残りを 健康スコア/価格（価格モードは価格の高い順）で詰める。
+    """
+    t0 = time.perf_counter()
+    selected = sorted(parse_genres(genres))
+    Items = catalog.health_items(prefs or {}) if mode == "health" else catalog.base_items
+
+    def rank(it):
+        if mode == "health":
+            return it["health_score"] / max(1, it["price_yen"])
+        return it["price_yen"]
+
+    order = sorted(Items, key=rank, reverse=True)
+    left = int(budget)
+    picked, seen = [], set()
+    for cat in selected:
+        it = next((it for it in order if it["category"] == cat and it["price_yen"] <= left), None)
+        if it is None:
+            picked = []
+            break
+        picked.append(it)
+        seen.add(it["id"])
+        left -= it["price_yen"]
+    if picked or not selected:
+        for it in order:
+            if it["id"] not in seen and it["price_yen"] <= left:
+                picked.append(it)
+                seen.add(it["id"])
+                left -= it["price_yen"]
+
+    ids = [it["id"] for it in picked]
+    result = {"mode": mode, "status": ("ok" if ids else "empty"), "ids": ids,
+              "items": to_api_shape(catalog.products, ids),
+              "H": (sum(it["health_score"] for it in picked) if mode == "health" and ids else None),
+              "price_sum": int(budget) - left if ids else 0}
+    result["stats"] = {"catalog": len(catalog), "budget": int(budget), "genres": selected, "solver": "greedy",
+                       "solves": 0, "solveMs": 0.0, "candidates": len(Items),
+                       "totalMs": round((time.perf_counter() - t0) * 1000, 2)}
+    return result
+
+
+def reoptimize(catalog, previous, prefs=None, budget=2500, genres=None, mode="health", pinned=(), excluded=()):
+    """
+    かごの編集（ピン留め / 除外）に合わせて解き直す。全商品ではなく近傍だけを CBC に渡す:
+      - ピン留め: 変数を 1 に固定 / 除外: 候補から外す
+      - 前回の解の残り: 外すのも自由（予算を空けるため）。ウォームスタートの初期解にする
+      - 影響ジャンル（除外・ピン留めした商品のジャンル）で、前回の1品と入れ替えられる価格の商品
+      - カバーが欠けた選択ジャンルの商品
+      - 予算の空き（予算 - ピン留め - 前回の残り）に収まる商品
+    近傍の最適解なので全体最適とは限らない（H が少し下がることがある）。
+    近傍で解が無ければ全商品で解き直す（stats.fallback）。
+    previous: optimize() の戻り値 か id のリスト（空なら最初から解く）
+    カタログに無いピン留め id は無視して stats.unknownPinned に載せる。
+    """
+    t0 = time.perf_counter()
+    selected = parse_genres(genres) or None
+    prev_ids = list(previous.get("ids", []) if isinstance(previous, dict) else previous)
+    pinned, excluded = set(pinned) - set(excluded), set(excluded)
+
+    Items = catalog.health_items(prefs or {}) if mode == "health" else catalog.base_items
+    Items = [it for it in Items if it["id"] not in excluded]
+    by_id = {it["id"]: it for it in Items}
+    # 健康スコアの無い商品もピン留めされたら入れる（スコア 0 扱い）
+    base = {it["id"]: it for it in catalog.base_items}
+    unknown = pinned - set(base)
+    pinned -= unknown
+    for i in sorted(pinned - set(by_id)):
+        by_id[i] = {**base[i], "health_score": 0.0}
+        Items.append(by_id[i])
+
+    kept = {i for i in prev_ids if i in by_id} | pinned
+    cat_of = {p["id"]: (p.get("genres") or [None])[0] for p in catalog.products}
+    affected = {cat_of.get(i) for i in excluded | pinned}
+    uncovered = set(selected or ()) - {by_id[i]["category"] for i in kept}
+    slack = max(0, int(budget) - sum(by_id[i]["price_yen"] for i in kept))
+    # 影響ジャンルは「前回の1品と入れ替えられる」価格まで、欠けた選択ジャンルは全部
+    swap = slack + max((by_id[i]["price_yen"] for i in kept), default=0)
+    pool = [it for it in Items
+            if it["id"] in kept or it["category"] in uncovered or it["price_yen"] <= slack
+            or (it["category"] in affected and it["price_yen"] <= swap)]
+
+    stats = {"catalog": len(catalog), "budget": int(budget), "genres": sorted(selected or []), "solver": "cbc",
+             "solves": 0, "solveMs": 0.0, "candidates": len(Items), "pool": len(pool), "pinned": sorted(pinned),
+             "excluded": sorted(excluded), "unknownPinned": sorted(unknown), "affectedGenres": sorted(g for g in affected | uncovered if g is not None),
+             "fallback": False}
+
+    def timed(fn, *a, **kw):
+        t = time.perf_counter()
+        r = fn(*a, **kw)
+        stats["solves"] += 1
+        stats["solveMs"] += (time.perf_counter() - t) * 1000
+        return r
+
+    def solve(cands):
+        # 前回の残りが予算・ジャンル条件を満たすときだけ初期解にする（実行不能な初期解は CBC が捨てる）
+        feasible = not uncovered and sum(by_id[i]["price_yen"] for i in kept) <= int(budget)
+        warm = kept if feasible else None
+        if mode == "price":
+            return timed(_solve_price_only, cands, budget, selected, fixed_ids=pinned, warm_ids=warm)
+        first = timed(solve_one, cands, budget, selected, fixed_ids=pinned, warm_ids=warm)
+        if first is None or not first["ids"]:
+            return first
+        second = timed(solve_one, cands, budget, selected, H_floor_ratio=first["H"] - 1e-9,
+                       fixed_ids=pinned, warm_ids=first["ids"])
+        return second or first
+
+    best = solve(pool) if pool else None
+    if (best is None or not best["ids"]) and len(pool) < len(Items):
+        stats["fallback"] = True
+        best = solve(Items)
+
+    result = {"mode": mode, "status": "empty", "ids": [], "items": [], "H": None, "price_sum": 0}
+    if best is not None and best["ids"]:
+        result.update(status="ok", ids=best["ids"], items=to_api_shape(catalog.products, best["ids"]),
+                      H=best.get("H"), price_sum=best["price_sum"])
+    stats["solveMs"] = round(stats["solveMs"], 2)
+    stats["totalMs"] = round((time.perf_counter() - t0) * 1000, 2)
+    result["stats"] = stats
+    return result
+
+
+def repair_basket(catalog, result, unavailable, budget, prefs=None, genres=None, mode="health"):
+    """
+    再最適化せずにかごを直す。result（optimize() の戻り値）から unavailable の商品を外し、
+    それぞれ同じジャンルでいちばん近い商品（FoodIndex）に差し替える。
+    差し替え先は 予算の残り + 外した商品の価格 以内・かご内に無い・unavailable でないもの
+    （健康モードは健康スコアがある商品だけ）。見つからなければ外したまま。
+    戻り値は optimize() と同じ形。stats に repaired [{from, to}] / dropped / uncovered（欠けたジャンル）。
+    """
+    t0 = time.perf_counter()
+    index = catalog.similarity
+    unavailable = set(unavailable)
+    scores = catalog.health_scores(prefs or {}) if mode == "health" else None
+    allowed = None
+    if mode == "health":
+        allowed = ~np.isnan(scores) if scores is not None else np.zeros(len(catalog), dtype=bool)
+    price = {p["id"]: int(round(p.get("price_yen", p.get("priceTax", 0) or 0))) for p in catalog.products}
+
+    ids = [i for i in result.get("ids", []) if i not in unavailable]
+    left = int(budget) - sum(price.get(i, 0) for i in ids)
+    repaired, dropped = [], []
+    for gone in [i for i in result.get("ids", []) if i in unavailable]:
+        sub = index.substitute(gone, max_price=left, exclude=unavailable | set(ids), allowed=allowed)
+        if sub is None:
+            dropped.append(gone)
+            continue
+        ids.append(sub)
+        left -= price[sub]
+        repaired.append({"from": gone, "to": sub})
+
+    have = {get_genre_value(catalog.by_id[i]) for i in ids if i in catalog.by_id}
+    uncovered = sorted(parse_genres(genres) - have)
+    H = None
+    if mode == "health" and scores is not None and ids:
+        rows = [index.row[i] for i in ids if i in index.row]
+        H = float(np.nansum(scores[rows]))
+    out = {"mode": mode, "status": ("ok" if ids else "empty"), "ids": ids,
+           "items": to_api_shape(catalog.products, ids), "H": H, "price_sum": int(budget) - left if ids else 0}
+    out["stats"] = {**result.get("stats", {}), "repaired": repaired, "dropped": dropped, "uncovered": uncovered,
+                    "repairMs": round((time.perf_counter() - t0) * 1000, 2)}
+    return out
+
+
 # ====== main ======
 if __name__ == "__main__":
     import argparse
-    import json
-    from pathlib import Path
-    
-    HERE = Path(__file__).resolve()
-    DATA = HERE.parents[3] / "data" / "foodData.json"
 
     # --- 引数の定義 ---
     parser = argparse.ArgumentParser(description="かいたす: 組み合わせ最適化スクリプト")
     parser.add_argument("--prefs-json", type=str, default="", help="Firebaseから渡す up/down の辞書(JSON文字列)")
-    parser.add_argument("--input", type=str, default="", help="入力JSONファイルパス")
-    parser.add_argument("--genre", type=str,default="", help="ジャンル")
+    parser.add_argument("--input", type=str, default="", help="入力JSONファイルパス（省略時 foodData.json）")
+    parser.add_argument("--genre", type=str,default="", help="ジャンル（カンマ区切り）")
     parser.add_argument("--budget", type=int, default=2500, help="予算（円）")
     parser.add_argument("--health", type=str2bool, default=True, help="健康重視モード true/false")
     parser.add_argument("--genres", type=str, default="", help="選択されたジャンル番号のJSON配列")
+    parser.add_argument("--solver", type=str, default="cbc", choices=SOLVERS, help="cbc / dp（予算カーブ）")
+    parser.add_argument("--max-budget", type=int, default=0, help="dp: カーブを作る予算の上限（円）")
+    parser.add_argument("--granularity", type=int, default=1, help="dp: 予算の刻み（円）")
+    parser.add_argument("--curve", action="store_true", help="dp: かごの代わりに予算カーブの表を出力")
+    parser.add_argument("--previous-ids", type=str, default="", help="解き直し: 前回のかごの id（JSON配列）")
+    parser.add_argument("--pin", type=str, default="", help="解き直し: 必ず入れる id（カンマ区切り）")
+    parser.add_argument("--exclude", type=str, default="", help="解き直し: 外す id（カンマ区切り）")
     args = parser.parse_args()
 
-    # --- 基本設定 ---
-    BUDGET_YEN = args.budget
-    HEALTH_MODE = args.health
-
-    # --- 選択されたジャンルをパース ---
-    selected_genres = []
+    # --- 選択されたジャンル（--genres のJSON配列 と --genre のカンマ区切りを合わせる） ---
+    selected_genres = set()
     if args.genres:
         try:
-            selected_genres = json.loads(args.genres)
-            if not isinstance(selected_genres, list):
-                selected_genres = []
+            g = json.loads(args.genres)
+            selected_genres |= parse_genres(g if isinstance(g, list) else [])
         except Exception:
-            selected_genres = []
-
-    # --- json読み込み ---
-    with open(DATA, "r", encoding="utf-8") as f:
-        products = json.load(f)
-
-    selected_genres = set()
-    if isinstance(args.genre, str) and args.genre.strip():
-        try:
-            selected_genres = {int(x) for x in args.genre.split(",") if x.strip()}
-        except ValueError:
-            selected_genres = set()
+            pass
+    selected_genres |= parse_genres(args.genre)
 
     # --- Firebaseからの prefs を読み取り ---
     user_prefs = {}
@@ -256,51 +839,28 @@ if __name__ == "__main__":
         except Exception:
             user_prefs = {}
 
-    normalized = normalize_health(products, user_prefs)
-            
-    # ==== モード分岐 ====
-    if HEALTH_MODE:
-        Items = build_items_for_solver(normalized, require_health=True)
-
-        if not Items:
-            succeed_with_empty()
-
-        # 第1段：H最大化
-        sol_opt = solve_one(Items, BUDGET_YEN, selected_categories=selected_genres if selected_genres else None)
-        if sol_opt is None or not sol_opt["ids"]:
+    catalog = Catalog.load(args.input or DEFAULT_DATA)
+    mode = "health" if args.health else "price"
+    if args.curve:
+        curve, _ = catalog.budget_curve(user_prefs, selected_genres, mode,
+                                        max(args.budget, args.max_budget), args.granularity)
+        print(json.dumps(curve.frontier(), ensure_ascii=False))
+        raise SystemExit(0)
+    pinned = [x.strip() for x in args.pin.split(",") if x.strip()]
+    excluded = [x.strip() for x in args.exclude.split(",") if x.strip()]
+    if args.previous_ids or pinned or excluded:
+        # --pin / --exclude だけなら前回のかご無し（空）から解く
+        try:
+            previous = json.loads(args.previous_ids) if args.previous_ids else []
+            result = reoptimize(catalog, previous, user_prefs, args.budget, selected_genres,
+                                mode=mode, pinned=pinned, excluded=excluded)
+        except (ValueError, TypeError, AttributeError):
             succeed_with_empty()
-        H_star = sol_opt["H"]
-
-        # 第2段：残額最小化（同H）
-        sol_opt2 = solve_one(
-            Items, BUDGET_YEN, selected_categories=selected_genres if selected_genres else None,
-            H_floor_ratio=H_star - 1e-9, forbid_overlap_with=None
-        )
-        best = sol_opt2 or sol_opt
-
-        result = {
-            "mode": "health",
-            "H": best["H"],
-            "price_sum": best["price_sum"],
-            "ids": best["ids"],
-        }
-
     else:
-        Items = build_items_for_solver(products, require_health=False)
-
-        if not Items:
-            succeed_with_empty()
-
-        sol_price = _solve_price_only(Items, BUDGET_YEN, selected_categories=selected_genres if selected_genres else None)
-        if sol_price is None or not sol_price["ids"]:
-            succeed_with_empty()
-
-        result = {
-            "mode": "price",
-            "price_sum": sol_price["price_sum"],
-            "ids": sol_price["ids"],
-        }
+        result = optimize(catalog, user_prefs, args.budget, selected_genres, mode=mode,
+                          solver=args.solver, max_budget=args.max_budget, granularity=args.granularity)
+    if result["status"] != "ok":
+        succeed_with_empty()
 
     # ==== 出力 ====
-    result_items = to_api_shape(products, result["ids"])
-    print(json.dumps(result_items, ensure_ascii=False))
\ No newline at end of file
+    print(json.dumps(result["items"], ensure_ascii=False))
@@ -0,0 +1,334 @@
+# かいたす: 組み合わせ最適化サーバー（/api/combos の前段）
+#
+# リクエストごとに combination.py を起動すると、混雑時に CBC プロセスがコア数を超えて並び、
+# 全員のレイテンシとメモリが崩れる。ここでは
+#   - ワーカー数 = コア数 の固定プール（同時に走る CBC はワーカー数まで）
+#   - 上限付きの優先度キュー（priority 小さい順 → deadline 早い順）
+#   - キューが満杯 / 締切切れ → 同じ条件の過去解（キャッシュ）か貪欲法で即答（load shedding）
+# を行う。GET /metrics でキュー長・待ち時間などを返す。
+#
+#   python combo_server.py --port 8790 --workers 4 --queue-size 32
+#   COMBOS_SERVER_URL=http://127.0.0.1:8790 npm run dev
+
+import os
+import json
+import math
+import time
+import heapq
+import argparse
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from combination import Catalog, DEFAULT_DATA, SOLVERS, optimize, greedy_basket, parse_genres
+
+
+# ===== キャッシュ =====
+def request_key(params):
+    prefs = tuple(sorted((k, v) for k, v in (params.get("prefs") or {}).items() if v in ("up", "down")))
+    mode = params.get("mode", "health")
+    return (mode, prefs if mode == "health" else (), tuple(sorted(parse_genres(params.get("genres")))),
+            int(params.get("budget", 2500)))
+
+
+class BasketCache:
+    """(mode, prefs, genres, budget) → 直近の最適解（LRU）"""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            r = self.data.get(key)
+            if r is not None:
+                self.data.move_to_end(key)
+            return r
+
+    def put(self, key, result):
+        with self.lock:
+            self.data[key] = result
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+
+# ===== スケジューラ =====
+class Job:
+    def __init__(self, params, priority, deadline):
+        self.params = params
+        self.key = request_key(params)
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.future = Future()
+
+
+def _pct(values, q):
+    if not values:
+        return 0.0
+    v = sorted(values)
+    return round(v[min(len(v) - 1, int(q * len(v)))], 2)
+
+
+class ComboScheduler:
+    """
+    optimize() を固定数のワーカーで実行する。submit() は Future を返す。
+    結果 dict には "source"（solve / cache / greedy）と、縮退時は "shed"（理由）が付く。
+    """
+
+    def __init__(self, catalog, workers=None, queue_size=None, deadline=10.0, solver="cbc",
+                 max_budget=0, cache_size=256):
+        self.catalog = catalog
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.queue_size = max(1, queue_size or self.workers * 4)
+        self.default_deadline = deadline
+        self.solver = solver
+        self.max_budget = max_budget
+        self.cache = BasketCache(cache_size)
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.closed = False
+        self.counters = {"submitted": 0, "solved": 0, "cacheHits": 0, "errors": 0,
+                         "shedQueueFull": 0, "shedDeadline": 0, "shedCache": 0, "shedGreedy": 0}
+        self.max_depth = 0
+        self.wait_ms = deque(maxlen=1024)
+        self.solve_ms = deque(maxlen=1024)
+        self.threads = [threading.Thread(target=self._worker, name=f"combo-worker-{i}", daemon=True)
+                        for i in range(self.workers)]
+        for t in self.threads:
+            t.start()
+
+    # --- 受付 ---
+    def submit(self, params, priority=0, deadline=None):
+        job = Job(params, priority, time.monotonic() + (deadline or self.default_deadline))
+        cached = self.cache.get(job.key)
+        with self.cond:
+            self.counters["submitted"] += 1
+            if cached is not None:
+                self.counters["cacheHits"] += 1
+            elif len(self.heap) >= self.queue_size:
+                self.counters["shedQueueFull"] += 1
+            else:
+                heapq.heappush(self.heap, (priority, job.deadline, next(self.seq), job))
+                self.max_depth = max(self.max_depth, len(self.heap))
+                self.cond.notify()
+                return job.future
+        if cached is not None:
+            job.future.set_result({**cached, "source": "cache"})
+        else:
+            self._shed(job, "queue-full")
+        return job.future
+
+    def run(self, params, priority=0, deadline=None):
+        """submit() して締切まで待つ。締切を過ぎたらキャッシュ / 貪欲法で答える。"""
+        job_deadline = deadline or self.default_deadline
+        fut = self.submit(params, priority, job_deadline)
+        try:
+            return fut.result(timeout=job_deadline)
+        except FutureTimeout:
+            # キューに残っていれば取り消す（ワーカーは cancelled を読み飛ばす）。
+            # 解いている最中なら待たずに答え、解はキャッシュに入って次回使われる
+            fut.cancel()
+            with self.cond:
+                self.counters["shedDeadline"] += 1
+            return self._fallback(params, "deadline")
+
+    # --- 縮退 ---
+    def _fallback(self, params, reason):
+        cached = self.cache.get(request_key(params))
+        if cached is not None:
+            with self.cond:
+                self.counters["shedCache"] += 1
+            return {**cached, "source": "cache", "shed": reason}
+        r = greedy_basket(self.catalog, params.get("prefs"), params.get("budget", 2500),
+                          params.get("genres"), params.get("mode", "health"))
+        with self.cond:
+            self.counters["shedGreedy"] += 1
+        return {**r, "source": "greedy", "shed": reason}
+
+    def _shed(self, job, reason):
+        if job.future.set_running_or_notify_cancel():
+            try:
+                job.future.set_result(self._fallback(job.params, reason))
+            except Exception as e:
+                job.future.set_exception(e)
+
+    # --- ワーカー ---
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.heap and not self.closed:
+                    self.cond.wait()
+                if self.closed and not self.heap:
+                    return
+                _, _, _, job = heapq.heappop(self.heap)
+                if job.future.cancelled():
+                    continue
+                waited = time.monotonic() - job.enqueued
+                self.wait_ms.append(waited * 1000)
+                expired = time.monotonic() > job.deadline
+                if expired:
+                    self.counters["shedDeadline"] += 1
+                else:
+                    self.in_flight += 1
+            if expired:
+                self._shed(job, "deadline")
+                continue
+            try:
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                p = job.params
+                t = time.perf_counter()
+                r = optimize(self.catalog, p.get("prefs"), p.get("budget", 2500), p.get("genres"),
+                             p.get("mode", "health"), solver=self.solver, max_budget=self.max_budget)
+                self.solve_ms.append((time.perf_counter() - t) * 1000)
+                self.cache.put(job.key, r)
+                with self.cond:
+                    self.counters["solved"] += 1
+                job.future.set_result({**r, "source": "solve"})
+            except Exception as e:
+                with self.cond:
+                    self.counters["errors"] += 1
+                job.future.set_exception(e)
+            finally:
+                with self.cond:
+                    self.in_flight -= 1
+
+    def metrics(self):
+        with self.cond:
+            waits, solves = list(self.wait_ms), list(self.solve_ms)
+            return {"workers": self.workers, "queueSize": self.queue_size, "queueDepth": len(self.heap),
+                    "maxQueueDepth": self.max_depth, "inFlight": self.in_flight, **self.counters,
+                    "waitMsP50": _pct(waits, 0.5), "waitMsP95": _pct(waits, 0.95),
+                    "solveMsP50": _pct(solves, 0.5), "solveMsP95": _pct(solves, 0.95)}
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+
+
+# ===== HTTP =====
+def params_from_body(body):
+    """route.ts と同じ入力（budget / isHealthImportance / genres / prefs）を optimize() 用に整える"""
+    prefs = {k: v for k, v in (body.get("prefs") or {}).items() if v in ("up", "down")}
+    return {"budget": int(body.get("budget") or 2500),
+            "mode": ("health" if body.get("isHealthImportance", True) else "price"),
+            "genres": body.get("genres") or [], "prefs": prefs}
+
+
+def _number(v, name):
+    """数値（数値の文字列も可）を float で。それ以外は ValueError"""
+    if isinstance(v, bool) or not isinstance(v, (int, float, str)):
+        raise ValueError(f"{name} must be a number")
+    f = float(v)
+    if not math.isfinite(f):
+        raise ValueError(f"{name} must be finite")
+    return f
+
+
+def parse_request(body):
+    """
+    /optimize のボディ → (params, priority, deadline 秒 or None)。不正な入力は ValueError（→ 400）
+      - deadlineMs: 省略・0 は既定の締切。負は不可（全リクエストが即縮退してしまう）
+      - priority: 整数（小さいほど先）
+    """
+    if not isinstance(body, dict):
+        raise ValueError("body must be a JSON object")
+    params = params_from_body(body)
+    deadline_ms = _number(0 if body.get("deadlineMs") is None else body["deadlineMs"], "deadlineMs")
+    if deadline_ms < 0:
+        raise ValueError("deadlineMs must not be negative")
+    priority = int(_number(0 if body.get("priority") is None else body["priority"], "priority"))
+    return params, priority, (deadline_ms / 1000 or None)
+
+
+class ComboHandler(BaseHTTPRequestHandler):
+    scheduler = None  # make_server() で設定
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status, obj, headers=None):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send(200, self.scheduler.metrics())
+        elif self.path == "/healthz":
+            self._send(200, {"ok": True})
+        else:
+            self._send(404, {"error": "not-found"})
+
+    def do_POST(self):
+        if self.path != "/optimize":
+            self._send(404, {"error": "not-found"})
+            return
+        try:
+            n = int(self.headers.get("Content-Length") or 0)
+            params, priority, deadline = parse_request(json.loads(self.rfile.read(n) or b"{}"))
+        except Exception as e:
+            self._send(400, {"error": "bad-request", "message": str(e)})
+            return
+        try:
+            r = self.scheduler.run(params, priority, deadline)
+        except Exception as e:
+            self._send(500, {"error": "optimize-failed", "message": str(e)})
+            return
+        # 本体は combination.py の標準出力と同じ配列。縮退はヘッダで知らせる
+        headers = {"X-Combos-Source": r["source"]}
+        if r.get("shed"):
+            headers["X-Combos-Shed"] = r["shed"]
+        self._send(200, r["items"], headers)
+
+
+def make_server(scheduler, host="127.0.0.1", port=8790):
+    handler = type("BoundComboHandler", (ComboHandler,), {"scheduler": scheduler})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+# ====== main ======
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="かいたす: 組み合わせ最適化サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--input", type=str, default="", help="入力JSONファイルパス（省略時 foodData.json）")
+    parser.add_argument("--workers", type=int, default=0, help="同時に解く数（省略時 コア数）")
+    parser.add_argument("--queue-size", type=int, default=0, help="待ち行列の上限（省略時 ワーカー数×4）")
+    parser.add_argument("--deadline", type=float, default=10.0, help="既定の締切（秒）")
+    parser.add_argument("--solver", type=str, default="cbc", choices=SOLVERS)
+    parser.add_argument("--max-budget", type=int, default=0, help="dp: 予算カーブの上限（円）")
+    parser.add_argument("--cache-size", type=int, default=256)
+    args = parser.parse_args()
+
+    scheduler = ComboScheduler(Catalog.load(args.input or DEFAULT_DATA), args.workers or None,
+                               args.queue_size or None, args.deadline, args.solver, args.max_budget,
+                               args.cache_size)
+    server = make_server(scheduler, args.host, args.port)
+    print(f"combo server: http://{args.host}:{server.server_port} "
+          f"(workers={scheduler.workers}, queue={scheduler.queue_size})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.close()
@@ -0,0 +1,167 @@
+# かいたす: 商品の類似検索（代替品さがし）
+#
+# foodData.json の栄養素ベクトル・価格・ジャンルから特徴量行列を作り、各商品の近傍 k 件を先に計算しておく。
+#   - カート投入に失敗した商品 → 予算内でいちばん近い代替品（aeon_netsuper_cart.py --substitute-on-fail）
+#   - 最適化結果から商品が欠けた → 再最適化せずにかごを修復（combination.repair_basket）
+# numpy だけに依存する（カート側から pulp なしで読めるように）。
+#
+#   python food_index.py 010500000360000000049708028 --k 5 --max-price 200
+
+import json
+import math
+import argparse
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_DATA = Path(__file__).resolve().parents[3] / "data" / "foodData.json"
+# 栄養素ではない数値項目
+NON_NUTRIENT_KEYS = {"id", "url", "name", "amount", "priceTax", "price_yen", "imgUrl", "genres", "genre",
+                     "health_score"}
+
+
+def _num(v):
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        return None
+    return None if math.isnan(v) else float(v)
+
+
+def product_price(p):
+    return int(round(p.get("price_yen", p.get("priceTax", 0)) or 0))
+
+
+def product_genre(p):
+    return p.get("genre") or (p.get("genres") or [None])[0]
+
+
+class FoodIndex:
+    """
+    商品の k 近傍インデックス。距離は次の特徴量のユークリッド距離:
+      - 栄養素: (値 - 中央値) / (P90 - P10) を ±3 でクリップ、欠損は 0。全体で重み 1 になるよう 1/sqrt(K)
+      - 価格: log(価格) × price_weight
+      - ジャンル: multi-hot × genre_weight/sqrt(2)（ジャンルが1つずつで違えば距離 genre_weight）
+    """
+
+    def __init__(self, products, k=16, price_weight=0.5, genre_weight=1.0):
+        self.products = list(products)
+        self.ids = [p["id"] for p in self.products]
+        self.row = {pid: i for i, pid in enumerate(self.ids)}
+        self.prices = np.array([product_price(p) for p in self.products], dtype=np.int64)
+        self.genres = [product_genre(p) for p in self.products]
+
+        keys = sorted({k for p in self.products for k, v in p.items()
+                       if k not in NON_NUTRIENT_KEYS and _num(v) is not None})
+        n, K = len(self.products), len(keys)
+        vals = np.full((n, K), np.nan)
+        for i, p in enumerate(self.products):
+            for j, key in enumerate(keys):
+                f = _num(p.get(key))
+                if f is not None:
+                    vals[i, j] = f
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # 全欠損の列
+            med = np.nanmedian(vals, axis=0)
+            span = np.nanpercentile(vals, 90, axis=0) - np.nanpercentile(vals, 10, axis=0)
+        span = np.where(np.isfinite(span) & (span > 0), span, 1.0)
+        nutr = np.clip((vals - np.nan_to_num(med)) / span, -3.0, 3.0)
+        nutr = np.nan_to_num(nutr, nan=0.0) / math.sqrt(max(1, K))
+
+        genre_ids = sorted({g for p in self.products for g in (p.get("genres") or [])})
+        gcol = {g: j for j, g in enumerate(genre_ids)}
+        hot = np.zeros((n, len(genre_ids)))
+        for i, p in enumerate(self.products):
+            for g in p.get("genres") or []:
+                hot[i, gcol[g]] = 1.0
+
+        logp = np.log(np.maximum(self.prices, 1)).reshape(-1, 1)
+        self.keys = keys
+        self.X = np.hstack([nutr, logp * price_weight, hot * (genre_weight / math.sqrt(2))]).astype(np.float32)
+        self.sq = (self.X * self.X).sum(axis=1)
+        self.k = min(k, max(0, n - 1))
+        self.table, self.table_dist = self._build_table()
+
+    def _build_table(self, block=512):
+        """全商品の近傍 k 件（自分は除く）を距離の昇順で"""
+        n = len(self.ids)
+        table = np.zeros((n, self.k), dtype=np.int32)
+        dist = np.zeros((n, self.k), dtype=np.float32)
+        if self.k == 0:
+            return table, dist
+        for s in range(0, n, block):
+            d2 = self.sq[s:s + block, None] + self.sq[None, :] - 2.0 * (self.X[s:s + block] @ self.X.T)
+            d2[np.arange(d2.shape[0]), np.arange(s, s + d2.shape[0])] = np.inf
+            part = np.argpartition(d2, self.k - 1, axis=1)[:, :self.k]
+            pd = np.take_along_axis(d2, part, axis=1)
+            order = np.argsort(pd, axis=1)
+            table[s:s + block] = np.take_along_axis(part, order, axis=1)
+            dist[s:s + block] = np.sqrt(np.maximum(np.take_along_axis(pd, order, axis=1), 0.0))
+        return table, dist
+
+    @classmethod
+    def load(cls, path=DEFAULT_DATA, **kw):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f), **kw)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _row_distances(self, i):
+        d2 = self.sq + self.sq[i] - 2.0 * (self.X @ self.X[i])
+        return np.sqrt(np.maximum(d2, 0.0))
+
+    def neighbors(self, pid, k=5, max_price=None, exclude=(), same_genre=True, allowed=None):
+        """
+        pid に近い商品 [(id, 距離)] を近い順に最大 k 件。
+        - max_price: この価格（円）以下だけ
+        - exclude: 除外する id
+        - same_genre: 先頭ジャンル（最適化のカテゴリ）が同じものだけ
+        - allowed: 真偽の配列（行ごと）。False の行は除外（健康スコアなしなど）
+        先に計算した近傍で足りなければ全件から探す。
+        """
+        i = self.row.get(pid)
+        if i is None:
+            return []
+        exclude = set(exclude)
+
+        def ok(j):
+            return (j != i and self.ids[j] not in exclude
+                    and (max_price is None or self.prices[j] <= max_price)
+                    and (not same_genre or self.genres[j] == self.genres[i])
+                    and (allowed is None or allowed[j]))
+
+        out = [(self.ids[j], float(d)) for j, d in zip(self.table[i], self.table_dist[i]) if ok(j)][:k]
+        if len(out) >= k:
+            return out
+        d = self._row_distances(i)
+        out = []
+        for j in np.argsort(d):
+            if ok(j):
+                out.append((self.ids[j], float(d[j])))
+                if len(out) >= k:
+                    break
+        return out
+
+    def substitute(self, pid, max_price=None, exclude=(), same_genre=True, allowed=None):
+        """いちばん近い代替品の id（なければ None）"""
+        nb = self.neighbors(pid, 1, max_price, exclude, same_genre, allowed)
+        return nb[0][0] if nb else None
+
+
+# ====== main ======
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="かいたす: 代替品の検索")
+    parser.add_argument("id", help="商品ID")
+    parser.add_argument("--input", type=str, default="", help="入力JSONファイルパス（省略時 foodData.json）")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--max-price", type=int, default=0, help="この価格（円）以下だけ")
+    parser.add_argument("--any-genre", action="store_true", help="ジャンルが違っても可")
+    args = parser.parse_args()
+
+    index = FoodIndex.load(args.input or DEFAULT_DATA)
+    out = []
+    for pid, d in index.neighbors(args.id, args.k, args.max_price or None, same_genre=not args.any_genre):
+        p = index.products[index.row[pid]]
+        out.append({"id": pid, "name": p.get("name"), "price": product_price(p), "genre": product_genre(p),
+                    "distance": round(d, 4)})
+    print(json.dumps(out, ensure_ascii=False))
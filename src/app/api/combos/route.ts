@@ -8,6 +8,11 @@ import { adminDb } from "@/lib/firebaseAdmin";
 
 const execAsync = promisify(exec);
 const SCRIPT_PATH = path.resolve(process.cwd(), "src/app/api/combos/combination.py");
+// 設定されていれば combo_server.py（ワーカー数固定・混雑時は縮退）に投げる
+const COMBOS_SERVER_URL = process.env.COMBOS_SERVER_URL;
+// サーバー側の締切（過ぎたらキャッシュ / 貪欲法で即答）。fetch はこれに通信分の余裕を足して打ち切る
+const COMBOS_DEADLINE_MS = Number(process.env.COMBOS_DEADLINE_MS) || 10000;
+const COMBOS_FETCH_MARGIN_MS = 2000;
 
 // -1/0/1 でも "up"/"down" でも受け取り、"up"/"down" だけに整形
 function toPrefs(obj: any): Record<string, "up" | "down"> {
@@ -51,6 +56,37 @@ export const POST = withAuth(async (req: NextRequest, uid: string) => {
     
     console.log('[combos] prefs:', prefsJson);
 
+    if (COMBOS_SERVER_URL) {
+      const deadlineMs = Number(body?.deadlineMs) > 0 ? Number(body.deadlineMs) : COMBOS_DEADLINE_MS;
+      let res: Response | null = null;
+      let payload: any = null;
+      try {
+        res = await fetch(`${COMBOS_SERVER_URL}/optimize`, {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ budget, isHealthImportance: isHealthImportance === 'true', genres, prefs, deadlineMs }),
+          signal: AbortSignal.timeout(deadlineMs + COMBOS_FETCH_MARGIN_MS),
+        });
+        payload = await res.json();
+      } catch (err) {
+        // サーバーが落ちている / 応答が締切に間に合わない → 下の combination.py 起動で解く
+        console.warn('[combos] combo server unavailable, falling back to combination.py:', err);
+        res = null;
+      }
+      if (res && !res.ok) {
+        console.error('[combos] combo server failed:', res.status, payload);
+        return NextResponse.json(
+          { error: "Combination server failed.", details: payload },
+          { status: 500 }
+        );
+      }
+      if (res) {
+        console.log('[combos] Success via server, source:', res.headers.get('X-Combos-Source'),
+          'shed:', res.headers.get('X-Combos-Shed'));
+        return NextResponse.json(payload);
+      }
+    }
+
     // JSONをコマンドライン引数として安全に渡すためにエスケープ
     const escapedPrefsJson = prefsJson.replace(/'/g, "'\\''");
     
@@ -1,11 +1,12 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { adminAuth, adminDb } from '@/lib/firebaseAdmin';
 import { withAuth } from '@/lib/middleware';
-import { getCollection, addFoodDetails } from '@/lib/apiUtils';
+import { getRecentHistory, addFoodDetails } from '@/lib/apiUtils';
 
 // GET /api/history - 購入履歴を取得
 export const GET = withAuth(async (_req: NextRequest, uid: string) => {
-	const items = await getCollection(uid, "history");
+	// 集計ドキュメントに載っている直近のチェックアウトだけ読む（履歴全件は読まない）
+	const items = await getRecentHistory(uid);
 	const mergedItems = addFoodDetails(items);
 	return NextResponse.json(mergedItems);
 });
@@ -3,7 +3,7 @@
 
 import { NextRequest, NextResponse } from "next/server";
 import { withAuth } from "@/lib/middleware";
-import { getCollection, addFoodDetails } from "@/lib/apiUtils";
+import { getRecentHistory, addFoodDetails } from "@/lib/apiUtils";
 import foodData from "@/data/foodData.json";
 
 const MAX_RECOMMEND = 5;
@@ -141,8 +141,8 @@ export const GET = withAuth(async (_req: NextRequest, uid: string) =>  {
     let recommendIds: string[] = [];
     const explanations: Array<{ id: string; reason: string; meta?: any }> = [];
 	
-	// historyを取得
-    const history = (await getCollection(uid, "history", 50)) as HistoryItem[];
+	// historyを取得（集計ドキュメントに載っている直近50チェックアウト分）
+    const history = (await getRecentHistory(uid, 50)) as HistoryItem[];
 
     console.log("[RECO] uid=", uid, "history_count=", Array.isArray(history) ? history.length : 0);
 
@@ -26,6 +26,29 @@ export async function getCollection(uid: string, collection: FirestoreCollection
   }));
 }
 
+// 購入履歴（チェックアウト単位のドキュメント）を新しい順に最大 limit 件。
+// historySummary/rolling.recentCheckouts に載っている履歴ドキュメントだけを読む。
+// 集計がまだ無い（backfill 前の）ユーザーは history 全件
+export async function getRecentHistory(uid: string, limit = 50) {
+  const rolling = await adminDb.doc(`users/${uid}/historySummary/rolling`).get();
+  const summary: any = rolling.exists ? rolling.data() : null;
+  if (!summary?.backfilled) {
+    return getCollection(uid, "history");
+  }
+
+  const ids: string[] = (summary.recentCheckouts || []).slice(-limit).reverse();
+  if (ids.length === 0) return [];
+  const col = adminDb.collection("users").doc(uid).collection("history");
+  const snaps = await adminDb.getAll(...ids.map((id) => col.doc(id)));
+
+  return snaps
+    .filter((doc) => doc.exists)
+    .map((doc) => ({
+      id: doc.id,
+      ...doc.data()
+    }));
+}
+
 // foodData.json の name / price / imgUrl を付与
 export function addFoodDetails<T extends { id: string }>(items: T[]) {
   return items.map((item) => {